@@ -4,17 +4,47 @@ This class provides the implementation of the 'apiary' peer relation
 used by the open-apiary charm.
 
 The leader should use this interface to provide the shared JWT token
-to other units in the application.
+to other units in the application.  When the token is rotated the
+previous token is retained alongside it so that tokens issued before
+the rotation continue to validate until the leader expires it.
 
-When the token has been provided, the interface will emit the 'token_available'
-event which charms can then respond to.
+When the token has been provided or changed, the interface will emit the
+'token_available' event which charms can then respond to.
+
+The relation also implements a restart lock so that units roll through
+service restarts rather than all restarting at once.  Units publish a
+'restart-request' nonce in their unit databag; the leader hands out
+restart slots in the application databag, limited by the configured
+concurrency and the minimum number of units that must stay available.
+When a slot is granted the interface will emit the 'restart_granted' event;
+once restarted and ready the unit reports back with 'restart-done' and
+the leader re-uses the slot for the next unit.  Units also publish their
+readiness so that the leader only counts units which are serving towards
+the minimum available.
+
+Units serving from a database on their own storage (SQLite) cannot share
+it, so the leader records the single unit which owns the database in the
+application databag and the other units stay out of service.  When a
+MySQL database is related the leader also records whether the SQLite data
+must first be migrated to it, going by the 'sqlite-data' the owner reports
+holding; the unit which migrates the data reports back with
+'mysql-migrated' and the leader records the migration as done, emitting
+the 'database_changed' event, so every unit switches together.
+
+Units publish a compact summary of their load in their unit databag,
+republished only once it moves beyond a tolerance or grows old; the
+leader aggregates the summaries into a recommendation to scale up or
+down, which only changes once the load has stayed beyond the thresholds
+for a number of consecutive evaluations.
 """
 
+import json
 import logging
+import time
 
-from ops.framework import EventBase, ObjectEvents, EventSource, Object
+from ops.framework import EventBase, ObjectEvents, EventSource, Object, StoredState
 from ops.model import Relation
-from ops.charm import RelationChangedEvent
+from ops.charm import RelationChangedEvent, RelationDepartedEvent
 
 # The unique Charmhub library identifier, never change it
 LIBID = "0e0479a91338413595db88baba97a23e"
@@ -24,7 +54,26 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 1
+LIBPATCH = 9
+
+
+# Load summary fields compared against the scaling thresholds
+LOAD_FIELDS = ("rps", "p95", "cpu", "lag")
+# Relative change in a load field worth publishing to peers
+LOAD_TOLERANCE = 0.1
+
+
+def load_changed(previous: dict, load: dict) -> bool:
+    """Whether any load field moved by more than LOAD_TOLERANCE
+
+    Changes are relative to the previous value, or to 1 for values below
+    it, so idle units do not republish noise.
+    """
+    for field in LOAD_FIELDS:
+        before = previous.get(field, 0)
+        if abs(load.get(field, 0) - before) > LOAD_TOLERANCE * max(abs(before), 1):
+            return True
+    return False
 
 
 class TokenAvailableEvent(EventBase):
@@ -33,10 +82,24 @@ class TokenAvailableEvent(EventBase):
     pass
 
 
+class RestartGrantedEvent(EventBase):
+    """Restart Slot Granted Event"""
+
+    pass
+
+
+class DatabaseChangedEvent(EventBase):
+    """Database Records Changed Event"""
+
+    pass
+
+
 class ApiaryPeersEvents(ObjectEvents):
     """Events class for `on`"""
 
     token_available = EventSource(TokenAvailableEvent)
+    restart_granted = EventSource(RestartGrantedEvent)
+    database_changed = EventSource(DatabaseChangedEvent)
 
 
 class ApiaryPeers(Object):
@@ -45,23 +108,58 @@ class ApiaryPeers(Object):
     """
 
     on = ApiaryPeersEvents()
+    _stored = StoredState()
 
-    def __init__(self, charm, relation_name):
+    def __init__(
+        self,
+        charm,
+        relation_name,
+        restart_concurrency: int = 1,
+        min_available_units: int = 0,
+    ):
         super().__init__(charm, relation_name)
         self.charm = charm
         self.relation_name = relation_name
+        self.restart_concurrency = restart_concurrency
+        self.min_available_units = min_available_units
+        # Database records last acted on, so only changes emit events
+        self._stored.set_default(database=None, tokens=None)
         self.framework.observe(
             self.charm.on[relation_name].relation_changed,
             self._on_apiary_relation_changed,
         )
+        self.framework.observe(
+            self.charm.on[relation_name].relation_departed,
+            self._on_apiary_relation_departed,
+        )
 
     def _on_apiary_relation_changed(self, event: RelationChangedEvent) -> None:
         """Handle for change events on the peer relation"""
-        if self.jwt_token:
+        tokens = json.dumps([self.jwt_token, self.previous_jwt_token])
+        if self.jwt_token and tokens != self._stored.tokens:
+            self._stored.tokens = tokens
             logging.debug(
                 "JWT token provided by leader, emitting TokenAvailableEvent event"
             )
             self.on.token_available.emit()
+        if self.framework.model.unit.is_leader():
+            self.grant_restarts()
+            self._update_migration()
+        database = json.dumps(
+            [self.database_unit, self.mysql_migration], sort_keys=True
+        )
+        if database != self._stored.database:
+            self._stored.database = database
+            logging.debug("Database records changed, emitting DatabaseChangedEvent event")
+            self.on.database_changed.emit()
+        if self.restart_granted:
+            logging.debug("Restart slot granted, emitting RestartGrantedEvent event")
+            self.on.restart_granted.emit()
+
+    def _on_apiary_relation_departed(self, event: RelationDepartedEvent) -> None:
+        """Release any restart slot held by a departed unit"""
+        if self.framework.model.unit.is_leader():
+            self.grant_restarts()
 
     @property
     def jwt_token(self) -> str:
@@ -73,6 +171,312 @@ class ApiaryPeers(Object):
         """The relation associated with this interface"""
         return self.framework.model.get_relation(self.relation_name)
 
+    @property
+    def previous_jwt_token(self) -> str:
+        """JWT token replaced by the most recent rotation, if still valid"""
+        return self.apiary.data[self.apiary.app].get("jwt-token-previous")
+
+    @property
+    def jwt_rotated_at(self) -> float:
+        """Time of the most recent JWT token rotation (seconds since epoch)"""
+        return float(self.apiary.data[self.apiary.app].get("jwt-rotated-at", 0))
+
     def set_token(self, jwt_token: str) -> None:
-        """Share JWT token with peers"""
-        self.apiary.data[self.apiary.app]["jwt-token"] = jwt_token
+        """Share JWT token with peers, retaining the current token as previous"""
+        app_data = self.apiary.data[self.apiary.app]
+        current = app_data.get("jwt-token")
+        if current == jwt_token:
+            return
+        if current:
+            app_data["jwt-token-previous"] = current
+        app_data["jwt-token"] = jwt_token
+        app_data["jwt-rotated-at"] = str(time.time())
+
+    def expire_previous_token(self) -> None:
+        """Stop sharing the previous JWT token with peers"""
+        app_data = self.apiary.data[self.apiary.app]
+        if "jwt-token-previous" in app_data:
+            del app_data["jwt-token-previous"]
+
+    @property
+    def database_unit(self) -> str:
+        """Unit owning the application database held on unit storage"""
+        return self.apiary.data[self.apiary.app].get("database-unit")
+
+    def claim_database(self) -> str:
+        """Make the leader own the database unless a peer already does
+
+        Returns the name of the unit owning the database.
+        """
+        owner = self.database_unit
+        unit = self.framework.model.unit
+        if owner in {u.name for u in self.apiary.units}:
+            return owner
+        if owner != unit.name:
+            self.apiary.data[self.apiary.app]["database-unit"] = unit.name
+        return unit.name
+
+    @property
+    def mysql_migration(self) -> dict:
+        """MySQL database recorded by the leader and whether SQLite data was migrated to it
+
+        'migrated' is None until the owner of the SQLite database has
+        reported whether it holds any data.
+        """
+        if not self.apiary:
+            return {}
+        return json.loads(self.apiary.data[self.apiary.app].get("mysql-migration", "{}"))
+
+    def plan_mysql_migration(self, database: str) -> bool:
+        """Record the MySQL database to switch to (leader only)
+
+        Returns True if the recorded migration changed.
+        """
+        if self.mysql_migration.get("database") == database:
+            return False
+        self._set_mysql_migration(database, None)
+        self._update_migration()
+        return True
+
+    def _set_mysql_migration(self, database: str, migrated: bool) -> None:
+        self.apiary.data[self.apiary.app]["mysql-migration"] = json.dumps(
+            {"database": database, "migrated": migrated}, sort_keys=True
+        )
+
+    def set_sqlite_data(self, present: bool) -> None:
+        """Report whether the SQLite database owned by this unit holds data"""
+        if not self.apiary:
+            return
+        unit_data = self.apiary.data[self.framework.model.unit]
+        value = "true" if present else "false"
+        if unit_data.get("sqlite-data") != value:
+            unit_data["sqlite-data"] = value
+        if self.framework.model.unit.is_leader():
+            self._update_migration()
+
+    def report_migrated(self, database: str) -> None:
+        """Report that this unit migrated its SQLite data to database"""
+        self.apiary.data[self.framework.model.unit]["mysql-migrated"] = database
+        if self.framework.model.unit.is_leader():
+            self._update_migration()
+
+    def _update_migration(self) -> bool:
+        """Resolve the recorded migration from unit reports (leader only)
+
+        Returns True if the recorded migration changed.
+        """
+        migration = self.mysql_migration
+        if not migration or migration["migrated"]:
+            return False
+        units = {u.name: u for u in self.apiary.units | {self.framework.model.unit}}
+        migrated = migration["migrated"]
+        if migrated is None:
+            owner = units.get(self.database_unit)
+            if owner is None:
+                # No unit serves from SQLite so there is nothing to migrate
+                migrated = True
+            else:
+                present = self.apiary.data[owner].get("sqlite-data")
+                if present is None:
+                    return False
+                migrated = present == "false"
+        if not migrated:
+            migrated = any(
+                self.apiary.data[unit].get("mysql-migrated") == migration["database"]
+                for unit in units.values()
+            )
+        if migrated == migration["migrated"]:
+            return False
+        self._set_mysql_migration(migration["database"], migrated)
+        return True
+
+    @property
+    def restart_grants(self) -> dict:
+        """Restart slots handed out by the leader, keyed by unit name"""
+        return json.loads(self.apiary.data[self.apiary.app].get("restart-grants", "{}"))
+
+    @property
+    def restart_granted(self) -> bool:
+        """Whether this unit holds a slot for its outstanding restart request"""
+        if not self.apiary:
+            return False
+        unit = self.framework.model.unit
+        request = self.apiary.data[unit].get("restart-request")
+        if request is None or request == self.apiary.data[unit].get("restart-done"):
+            return False
+        return self.restart_grants.get(unit.name) == request
+
+    def acquire_restart(self, nonce: str) -> bool:
+        """Request a restart slot, returning True if the restart may proceed
+
+        Restarts are not coordinated until the unit has peers.
+        """
+        if not self.apiary or not self.apiary.units:
+            return True
+        unit_data = self.apiary.data[self.framework.model.unit]
+        if unit_data.get("restart-request") != nonce:
+            unit_data["restart-request"] = nonce
+        if self.framework.model.unit.is_leader():
+            self.grant_restarts()
+        return self.restart_granted
+
+    def release_restart(self) -> None:
+        """Report completion of the restart, freeing the slot"""
+        if not self.apiary:
+            return
+        unit_data = self.apiary.data[self.framework.model.unit]
+        request = unit_data.get("restart-request")
+        if request is not None and unit_data.get("restart-done") != request:
+            unit_data["restart-done"] = request
+        if self.framework.model.unit.is_leader():
+            self.grant_restarts()
+
+    def set_ready(self, ready: bool) -> None:
+        """Publish whether this unit is ready to serve requests"""
+        if not self.apiary:
+            return
+        unit_data = self.apiary.data[self.framework.model.unit]
+        value = "true" if ready else "false"
+        if unit_data.get("ready") != value:
+            unit_data["ready"] = value
+
+    def grant_restarts(self) -> None:
+        """Hand out restart slots to units with outstanding requests (leader only)"""
+        if not self.apiary:
+            return
+        units = sorted(
+            self.apiary.units | {self.framework.model.unit}, key=lambda u: u.name
+        )
+        grants = self.restart_grants
+        in_progress = {}
+        pending = []
+        ready = set()
+        for unit in units:
+            if self.apiary.data[unit].get("ready") != "false":
+                ready.add(unit.name)
+            request = self.apiary.data[unit].get("restart-request")
+            if request is None or request == self.apiary.data[unit].get("restart-done"):
+                continue
+            if grants.get(unit.name) == request:
+                in_progress[unit.name] = request
+            else:
+                pending.append((unit.name, request))
+
+        # Units holding a slot are about to go out of service
+        available = len(ready - set(in_progress))
+        slots = min(
+            self.restart_concurrency - len(in_progress),
+            available - self.min_available_units,
+        )
+        for name, request in pending[: max(slots, 0)]:
+            in_progress[name] = request
+        if pending and available - self.min_available_units < 1:
+            logging.warning(
+                "Unable to grant restart: %d unit(s) must remain available",
+                self.min_available_units,
+            )
+        if in_progress != grants:
+            self.apiary.data[self.apiary.app]["restart-grants"] = json.dumps(
+                in_progress, sort_keys=True
+            )
+
+    def set_load(self, report: dict, refresh: float) -> None:
+        """Publish a summary of this unit's load, stamped with the time
+
+        Unchanged load is only republished once the previous summary is
+        refresh seconds old, so peers are not woken on every sample.
+        """
+        if not self.apiary:
+            return
+        unit_data = self.apiary.data[self.framework.model.unit]
+        try:
+            previous = json.loads(unit_data.get("load", ""))
+        except ValueError:
+            previous = None
+        fresh = previous and time.time() - previous.get("at", 0) < refresh
+        if fresh and not load_changed(previous, report):
+            return
+        report = dict(report, at=int(time.time()))
+        unit_data["load"] = json.dumps(report, sort_keys=True, separators=(",", ":"))
+
+    def load_reports(self, max_age: float) -> dict:
+        """Load summaries published within max_age seconds, keyed by unit name"""
+        reports = {}
+        if not self.apiary:
+            return reports
+        now = time.time()
+        for unit in self.apiary.units | {self.framework.model.unit}:
+            try:
+                report = json.loads(self.apiary.data[unit].get("load", ""))
+            except ValueError:
+                continue
+            if now - report.get("at", 0) <= max_age:
+                reports[unit.name] = report
+        return reports
+
+    @property
+    def scaling(self) -> dict:
+        """Most recent scaling recommendation made by the leader"""
+        if not self.apiary:
+            return {}
+        return json.loads(self.apiary.data[self.apiary.app].get("scaling", "{}"))
+
+    def recommend_scaling(
+        self, thresholds: dict, down_ratio: float, hysteresis: int, max_age: float
+    ) -> dict:
+        """Aggregate peer load summaries into a scaling recommendation (leader only)
+
+        The mean of each load field across units is compared against its
+        threshold; a field with a threshold of 0 is ignored, and with every
+        threshold at 0 the recommendation is to hold.  Scaling up is
+        suggested when any mean exceeds its threshold and scaling down when
+        the load spread across one unit fewer would stay below down_ratio
+        of every threshold.  The recommendation only changes once the same
+        suggestion has been made hysteresis times in a row, and starts over
+        when the number of units changes.
+        """
+        units = len(self.apiary.units) + 1
+        reports = self.load_reports(max_age)
+        previous = self.scaling
+        if not reports:
+            return previous
+        load = {
+            field: sum(r.get(field, 0) for r in reports.values()) / len(reports)
+            for field in LOAD_FIELDS
+        }
+        limits = {field: limit for field, limit in thresholds.items() if limit}
+        candidate = "hold"
+        if any(load[field] > limit for field, limit in limits.items()):
+            candidate = "up"
+        elif limits and units > 1 and all(
+            load[field] * units / (units - 1) < limit * down_ratio
+            for field, limit in limits.items()
+        ):
+            candidate = "down"
+
+        if previous.get("units") != units:
+            previous = {}
+        count = previous.get("count", 0) + 1 if previous.get("candidate") == candidate else 1
+        recommendation = previous.get("recommendation", "hold")
+        if count >= hysteresis:
+            recommendation = candidate
+        suggested = {"up": units + 1, "down": units - 1}.get(recommendation, units)
+        scaling = {
+            "recommendation": recommendation,
+            "candidate": candidate,
+            "count": min(count, hysteresis),
+            "units": units,
+            "suggested-units": suggested,
+            "load": {field: round(value, 2) for field, value in load.items()},
+            "reports": len(reports),
+        }
+        # Load moving within the tolerance does not change the recommendation
+        if load_changed(self.scaling.get("load", {}), scaling["load"]) or dict(
+            self.scaling, load=None
+        ) != dict(scaling, load=None):
+            self.apiary.data[self.apiary.app]["scaling"] = json.dumps(scaling, sort_keys=True)
+        if recommendation != "hold":
+            logging.info(
+                "Load recommends scaling %s to %d unit(s): %s", recommendation, suggested, load
+            )
+        return scaling
@@ -0,0 +1,380 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Incremental, deduplicated backups of the Open Apiary storage
+
+Files are streamed in fixed-size chunks which are stored once under the
+SHA-256 hash of their content, compressed unless the file is already
+compressed, so unchanged data is never stored twice. Each backup writes a
+manifest listing the chunks of every file; files whose size and mtime
+match the previous manifest reuse its chunks without being read at all.
+
+The SQLite database is copied through the online backup API into a
+consistent snapshot, so Open Apiary keeps serving while it is taken.
+"""
+
+import datetime
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+import zlib
+
+from s3 import S3Client
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# Chunk encodings, recorded in the first byte of each stored chunk
+RAW = b"r"
+ZLIB = b"z"
+
+# Files which gain nothing from being compressed again
+COMPRESSED_SUFFIXES = frozenset(
+    {".gif", ".gz", ".heic", ".jpeg", ".jpg", ".mp4", ".png", ".webp", ".zip"}
+)
+
+# Pages copied by each step of the SQLite online backup; writers are not
+# blocked between steps
+SNAPSHOT_PAGES = 1024
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+
+
+class BackupError(Exception):
+    """Backup or restore could not be completed"""
+
+
+class DirectoryStore:
+    """Backup objects kept as files under a directory"""
+
+    def __init__(self, root: str):
+        self.root = pathlib.Path(root)
+
+    def exists(self, key: str) -> bool:
+        return (self.root / key).exists()
+
+    def get(self, key: str) -> bytes:
+        try:
+            return (self.root / key).read_bytes()
+        except FileNotFoundError:
+            raise BackupError("{} not found in {}".format(key, self.root))
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + ".partial")
+        partial.write_bytes(data)
+        partial.replace(path)
+
+    def list(self, prefix: str) -> list:
+        directory = self.root / prefix
+        if not directory.is_dir():
+            return []
+        return sorted(prefix + path.name for path in directory.iterdir())
+
+
+class S3Store:
+    """Backup objects kept under a prefix in an S3-compatible bucket"""
+
+    def __init__(self, client: S3Client, prefix: str = ""):
+        self.client = client
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    def exists(self, key: str) -> bool:
+        return self.client.exists(self.prefix + key)
+
+    def get(self, key: str) -> bytes:
+        return self.client.get(self.prefix + key)
+
+    def put(self, key: str, data: bytes) -> None:
+        self.client.put(self.prefix + key, data)
+
+    def list(self, prefix: str) -> list:
+        return sorted(
+            key[len(self.prefix):] for key in self.client.list(self.prefix + prefix)
+        )
+
+
+def open_store(
+    target: str,
+    endpoint: str = None,
+    access_key: str = None,
+    secret_key: str = None,
+    region: str = None,
+):
+    """Store for a target directory or s3://bucket/prefix URL"""
+    url = parse_target(target)
+    if url is None:
+        if not os.path.isabs(target):
+            raise BackupError("Backup target must be an absolute path or s3:// URL")
+        return DirectoryStore(target)
+    bucket, prefix = url
+    if not endpoint:
+        raise BackupError("An S3 endpoint is needed for s3:// targets")
+    client = S3Client(endpoint, bucket, access_key or "", secret_key or "", region or "us-east-1")
+    return S3Store(client, prefix)
+
+
+def parse_target(target: str):
+    """Bucket and prefix of an s3:// target, or None for a directory"""
+    if not target.startswith("s3://"):
+        return None
+    bucket, _, prefix = target[len("s3://"):].partition("/")
+    if not bucket:
+        raise BackupError("No bucket in backup target {}".format(target))
+    return bucket, prefix
+
+
+def chunk_key(digest: str) -> str:
+    return "chunks/{}/{}".format(digest[:2], digest)
+
+
+def encode_chunk(data: bytes, compress: bool, level: int) -> bytes:
+    if compress and level:
+        compressed = zlib.compress(data, level)
+        if len(compressed) < len(data):
+            return ZLIB + compressed
+    return RAW + data
+
+
+def decode_chunk(data: bytes) -> bytes:
+    if data[:1] == ZLIB:
+        return zlib.decompress(data[1:])
+    if data[:1] == RAW:
+        return data[1:]
+    raise BackupError("Unknown chunk encoding {!r}".format(data[:1]))
+
+
+def latest_manifest(store):
+    """Name of the most recent manifest in store, or None"""
+    names = [
+        key[len("manifests/"):-len(".json")]
+        for key in store.list("manifests/")
+        if key.endswith(".json")
+    ]
+    return max(names) if names else None
+
+
+def load_manifest(store, name: str) -> dict:
+    manifest = json.loads(store.get("manifests/{}.json".format(name)))
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise BackupError("Unsupported manifest version {}".format(manifest.get("version")))
+    return manifest
+
+
+def snapshot_sqlite(database: str, destination: str, timeout: float = 5.0) -> None:
+    """Consistent copy of a live SQLite database using the online backup API"""
+    source = sqlite3.connect(database, timeout=timeout)
+    try:
+        target = sqlite3.connect(destination)
+        try:
+            source.backup(target, pages=SNAPSHOT_PAGES)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def walk(root: pathlib.Path, exclude: list):
+    """Relative paths of the regular files under root, sorted"""
+    for directory, dirs, files in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        dirs[:] = sorted(
+            name
+            for name in dirs
+            if not excluded(os.path.normpath(os.path.join(relative, name)), exclude)
+        )
+        for name in sorted(files):
+            path = os.path.normpath(os.path.join(relative, name))
+            if not excluded(path, exclude) and os.path.isfile(os.path.join(root, path)):
+                yield path
+
+
+def excluded(path: str, exclude: list) -> bool:
+    return any(fnmatch.fnmatch(path, pattern) for pattern in exclude)
+
+
+class Backup:
+    """Write a backup of a set of directories to a store"""
+
+    def __init__(self, store, chunk_size: int = 4 * 1024 * 1024, level: int = 6, progress=None):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.level = level
+        self.progress = progress or (lambda *args: None)
+        self.known = set()
+        self.stats = {"files": 0, "changed": 0, "chunks": 0, "bytes-read": 0, "bytes-stored": 0}
+        self.reported = time.monotonic()
+
+    def _report(self, storage: str) -> None:
+        if time.monotonic() - self.reported >= PROGRESS_INTERVAL:
+            self.progress(storage, dict(self.stats))
+            self.reported = time.monotonic()
+
+    def _store_file(self, path: str, entry: dict) -> dict:
+        """Stream path into the store, returning its manifest entry"""
+        compress = pathlib.PurePath(path).suffix.lower() not in COMPRESSED_SUFFIXES
+        chunks = []
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                self.stats["bytes-read"] += len(data)
+                if digest in self.known:
+                    continue
+                key = chunk_key(digest)
+                if not self.store.exists(key):
+                    encoded = encode_chunk(data, compress, self.level)
+                    self.store.put(key, encoded)
+                    self.stats["chunks"] += 1
+                    self.stats["bytes-stored"] += len(encoded)
+                self.known.add(digest)
+        self.stats["changed"] += 1
+        return dict(entry, chunks=chunks)
+
+    def run(
+        self,
+        sources: dict,
+        exclude: dict = None,
+        database: tuple = None,
+        sqlite_timeout: float = 5.0,
+    ) -> dict:
+        """Back up each named source directory, returning the manifest
+
+        database is an optional (source name, relative path) of a SQLite
+        database within a source, which is copied from a snapshot rather
+        than read while it may be written to.
+        """
+        exclude = exclude or {}
+        start = time.monotonic()
+        previous_name = latest_manifest(self.store)
+        previous = load_manifest(self.store, previous_name) if previous_name else {}
+        for storage in previous.get("storages", {}).values():
+            for entry in storage.values():
+                self.known.update(entry["chunks"])
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "name": now.strftime("%Y%m%dT%H%M%S.%fZ"),
+            "created": now.timestamp(),
+            "previous": previous_name,
+            "chunk-size": self.chunk_size,
+            "storages": {},
+        }
+        for name, root in sorted(sources.items()):
+            root = pathlib.Path(root)
+            skip = list(exclude.get(name, []))
+            if database and database[0] == name:
+                skip += [database[1] + suffix for suffix in ("", "-journal", "-shm", "-wal")]
+            unchanged = previous.get("storages", {}).get(name, {})
+            files = manifest["storages"][name] = {}
+            for path in walk(root, skip):
+                stat = os.stat(root / path)
+                entry = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "mode": stat.st_mode & 0o7777,
+                    "uid": stat.st_uid,
+                    "gid": stat.st_gid,
+                }
+                self.stats["files"] += 1
+                old = unchanged.get(path)
+                if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+                    files[path] = dict(entry, chunks=old["chunks"])
+                    continue
+                files[path] = self._store_file(str(root / path), entry)
+                self._report(name)
+            if database and database[0] == name and (root / database[1]).exists():
+                files[database[1]] = self._snapshot(root / database[1], sqlite_timeout)
+
+        self.store.put(
+            "manifests/{}.json".format(manifest["name"]),
+            json.dumps(manifest, sort_keys=True).encode(),
+        )
+        self.stats["seconds"] = round(time.monotonic() - start, 3)
+        logger.info("Backup %s complete: %s", manifest["name"], self.stats)
+        return manifest
+
+    def _snapshot(self, database: pathlib.Path, timeout: float) -> dict:
+        stat = os.stat(database)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            snapshot = os.path.join(tmpdir, database.name)
+            snapshot_sqlite(str(database), snapshot, timeout)
+            self.stats["files"] += 1
+            return self._store_file(
+                snapshot,
+                {
+                    "size": os.path.getsize(snapshot),
+                    "mtime": stat.st_mtime_ns,
+                    "mode": stat.st_mode & 0o7777,
+                    "uid": stat.st_uid,
+                    "gid": stat.st_gid,
+                    "snapshot": True,
+                },
+            )
+
+
+def restore(store, targets: dict, name: str = None, progress=None) -> dict:
+    """Restore the named targets from a backup, the latest by default
+
+    Files already matching the backup by size and mtime are left alone, and
+    files not in the backup are kept. Each file is written beside its
+    destination and renamed into place once its chunks have been verified.
+    """
+    progress = progress or (lambda *args: None)
+    name = name or latest_manifest(store)
+    if not name:
+        raise BackupError("No backups found")
+    manifest = load_manifest(store, name)
+    stats = {"backup": name, "files": 0, "restored": 0, "bytes-written": 0}
+    start = reported = time.monotonic()
+    for storage, root in sorted(targets.items()):
+        if storage not in manifest["storages"]:
+            raise BackupError("Backup {} does not include {}".format(name, storage))
+        root = pathlib.Path(root)
+        for path, entry in sorted(manifest["storages"][storage].items()):
+            stats["files"] += 1
+            destination = root / path
+            if not entry.get("snapshot") and destination.is_file():
+                stat = os.stat(destination)
+                if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]:
+                    continue
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            partial = destination.with_name(destination.name + ".partial")
+            try:
+                with open(partial, "wb") as f:
+                    for digest in entry["chunks"]:
+                        data = decode_chunk(store.get(chunk_key(digest)))
+                        if hashlib.sha256(data).hexdigest() != digest:
+                            raise BackupError("Chunk {} of {} is corrupt".format(digest, path))
+                        f.write(data)
+                        stats["bytes-written"] += len(data)
+            except BaseException:
+                partial.unlink(missing_ok=True)
+                raise
+            os.chmod(partial, entry["mode"])
+            try:
+                os.chown(partial, entry["uid"], entry["gid"])
+            except PermissionError:
+                pass
+            os.utime(partial, ns=(entry["mtime"], entry["mtime"]))
+            partial.replace(destination)
+            stats["restored"] += 1
+            if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                progress(storage, dict(stats))
+                reported = time.monotonic()
+    stats["seconds"] = round(time.monotonic() - start, 3)
+    logger.info("Restore of %s complete: %s", name, stats)
+    return stats
@@ -2,31 +2,192 @@
 # Copyright 2021 James Page
 # See LICENSE file for licensing details.
 
-import hashlib
+import sys
+
+import dispatch
+
+if __name__ == "__main__" and not dispatch.handled():
+    # Nothing observes this event so skip loading ops and the charm
+    sys.exit(0)
+
 import json
 import logging
+import pathlib
 import secrets
+import socket
+import sqlite3
+import time
+import urllib.error
+import urllib.request
 
-from charms.nginx_ingress_integrator.v0.ingress import IngressRequires
-from charms.open_apiary.v0.apiary import ApiaryPeers, TokenAvailableEvent
+from charms.nginx_ingress_integrator.v0.ingress import (
+    OPTIONAL_INGRESS_RELATION_FIELDS,
+    REQUIRED_INGRESS_RELATION_FIELDS,
+    IngressRequires,
+)
+from charms.open_apiary.v0.apiary import (
+    ApiaryPeers,
+    DatabaseChangedEvent,
+    RestartGrantedEvent,
+    TokenAvailableEvent,
+)
 
 from ops.charm import (
+    ActionEvent,
     CharmBase,
     RelationBrokenEvent,
-    RelationChangedEvent,
+    RelationCreatedEvent,
+    RelationEvent,
     LeaderElectedEvent,
+    UpdateStatusEvent,
+    WorkloadEvent,
 )
-from ops.framework import StoredState
+from ops.framework import Object, StoredState
 from ops.main import main
-from ops.model import ActiveStatus
+from ops.model import ActiveStatus, BlockedStatus, StatusBase, WaitingStatus
+from ops.pebble import APIError, ChangeError, CheckLevel, CheckStatus, ExecError
+
+from managed_files import ManagedFile, sync_files
+from reconcile import Reconciler, checksum_dict
 
 logger = logging.getLogger(__name__)
 
+# Port the Open Apiary web application listens on
+APP_PORT = 3000
+
+# Cluster wrapper starting multiple Open Apiary workers
+CLUSTER_WRAPPER = "/opt/charm/cluster.js"
+CLUSTER_WRAPPER_SOURCE = pathlib.Path(__file__).parent / "workload" / "cluster.js"
+LOG_SHIPPER = "/opt/charm/logship.js"
+LOG_SHIPPER_SOURCE = pathlib.Path(__file__).parent / "workload" / "logship.js"
+LOG_FILE = "/data/open-apiary.log"
+LOG_TARGETS = ("file", "stdout")
+
+# Thumbnail service run in the tools container
+THUMBNAILER = "/opt/charm/thumbnailer.py"
+THUMBNAILER_SOURCE = pathlib.Path(__file__).parent / "workload" / "thumbnailer.py"
+THUMBNAIL_PATH = "/uploads/.thumbnails"
+THUMBNAIL_PORT = 3001
+THUMBNAIL_ROUTE = "/thumbnails"
+
+# Caching proxy for the weather API run in the tools container, which the
+# cluster wrapper routes the application's weather requests to
+WEATHER_ROUTER = "/opt/charm/weather.js"
+WEATHER_ROUTER_SOURCE = pathlib.Path(__file__).parent / "workload" / "weather.js"
+WEATHER_PROXY = "/opt/charm/weather_proxy.py"
+WEATHER_PROXY_SOURCE = pathlib.Path(__file__).parent / "workload" / "weather_proxy.py"
+WEATHER_PROXY_PORT = 3002
+WEATHER_API_HOST = "api.openweathermap.org"
+
+# Warm-up run by the cluster wrapper after a restart before it serves users
+WARMUP = "/opt/charm/warmup.js"
+WARMUP_SOURCE = pathlib.Path(__file__).parent / "workload" / "warmup.js"
+
+# Uploads service run in the tools container when related to object
+# storage, keeping the uploads storage as a read-through cache of a bucket
+UPLOADS_SERVICE = "/opt/charm/uploads.py"
+UPLOADS_SERVICE_SOURCE = pathlib.Path(__file__).parent / "workload" / "uploads.py"
+S3_CLIENT = "/opt/charm/s3.py"
+S3_CLIENT_SOURCE = pathlib.Path(__file__).parent / "s3.py"
+UPLOADS_PORT = 3003
+
+# Prometheus exporter run in the tools container, combining the metrics
+# the cluster wrapper serves on localhost with the charm's own counters
+WORKLOAD_METRICS = "/opt/charm/metrics.js"
+WORKLOAD_METRICS_SOURCE = pathlib.Path(__file__).parent / "workload" / "metrics.js"
+WORKLOAD_METRICS_PORT = 9101
+METRICS_EXPORTER = "/opt/charm/metrics_exporter.py"
+METRICS_EXPORTER_SOURCE = pathlib.Path(__file__).parent / "workload" / "metrics_exporter.py"
+METRICS_PORT = 9100
+CHARM_METRICS = "/opt/charm/charm.prom"
+# Charm counters exported as metric name, label and help text
+CHARM_COUNTERS = {
+    "restarts": (
+        "open_apiary_charm_restarts_total",
+        "cause",
+        "Workload restarts by the event which required them",
+    ),
+    "reloads": ("open_apiary_charm_reloads_total", None, "Workload reloads"),
+    "jwt-rotations": ("open_apiary_charm_jwt_rotations_total", None, "JWT token rotations"),
+    "not-ready-seconds": (
+        "open_apiary_charm_not_ready_seconds_total",
+        None,
+        "Time the unit has spent not ready",
+    ),
+}
+
+# Load reports older than this are left out of scaling recommendations,
+# allowing for a few missed update-status hooks
+LOAD_REPORT_MAX_AGE = 900
+
+# Let the ingress retry requests against another unit while one is
+# restarting so rolling restarts do not surface errors to users.
+INGRESS_RETRY_ERRORS = "error,timeout,http_502,http_503"
+
+# SQLite database used when no MySQL database is related
+SQLITE_DATABASE = "/data/db.sql"
+SQLITE_JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal")
+SQLITE_SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+
+# Storages included in backups, with files left out of them: the database
+# is copied from a snapshot, and logs and thumbnails are not worth keeping
+BACKUP_STORAGES = ("data", "uploads")
+BACKUP_EXCLUDES = {
+    "data": ["lost+found", "open-apiary.log*"],
+    "uploads": ["lost+found", ".thumbnails", ".uploads-index.json*"],
+}
+
+
+def probe_http(url: str, timeout: float = 2.0) -> bool:
+    """Whether an HTTP server responds at url without a server error"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout):
+            return True
+    except urllib.error.HTTPError as e:
+        return e.code < 500
+    except (urllib.error.URLError, OSError):
+        return False
+
 
-def checksum_dict(data):
-    return hashlib.sha256(
-        json.dumps(data, sort_keys=True, indent=2).encode()
-    ).hexdigest()
+class ChangedFieldsIngressRequires(IngressRequires):
+    """IngressRequires writing only the fields which differ from the relation data
+
+    Each field written is a separate round-trip to the Juju agent, and
+    IngressRequires writes every field it holds on every relation-changed
+    event and update.  Unlike IngressRequires it can also be used for
+    ingress relations not named ingress.
+    """
+
+    def __init__(self, charm, config_dict: dict, relation_name: str = "ingress"):
+        # IngressRequires only observes the relation named ingress
+        Object.__init__(self, charm, relation_name)
+        self.relation_name = relation_name
+        self.config_dict = config_dict
+        self.framework.observe(
+            charm.on[relation_name].relation_changed, self._on_relation_changed
+        )
+
+    def _write_changed(self, relation) -> list:
+        """Write the fields which differ from the relation data, returning their names"""
+        app_data = relation.data[self.model.app]
+        changed = sorted(
+            key for key, value in self.config_dict.items() if app_data.get(key) != str(value)
+        )
+        for key in changed:
+            app_data[key] = str(self.config_dict[key])
+        return changed
+
+    def _on_relation_changed(self, event) -> None:
+        if self.model.unit.is_leader() and not self._config_dict_errors():
+            self._write_changed(event.relation)
+
+    def apply(self, config_dict: dict) -> list:
+        """Set the fields, already validated, and write those which changed (leader only)"""
+        self.config_dict = config_dict
+        relations = self.model.relations[self.relation_name]
+        if not relations or not self.model.unit.is_leader():
+            return []
+        return self._write_changed(relations[0])
 
 
 class OpenApiaryCharm(CharmBase):
@@ -36,98 +197,1455 @@ class OpenApiaryCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
+        self.profiler = None
+        if self.config["hook-profiling"]:
+            self._enable_profiling()
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.leader_elected, self._on_leader_elected)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(
+            self.on.rotate_jwt_secret_action, self._on_rotate_jwt_secret_action
+        )
+        self.framework.observe(
+            self.on.profile_hooks_action, self._on_profile_hooks_action
+        )
+        self.framework.observe(
+            self.on.sqlite_maintenance_action, self._on_sqlite_maintenance_action
+        )
+        self.framework.observe(
+            self.on.migrate_to_mysql_action, self._on_migrate_to_mysql_action
+        )
+        self.framework.observe(
+            self.on.scaling_recommendation_action, self._on_scaling_recommendation_action
+        )
+        self.framework.observe(self.on.backup_action, self._on_backup_action)
+        self.framework.observe(self.on.restore_action, self._on_restore_action)
+        self.framework.observe(
+            self.on.open_apiary_pebble_ready, self._on_open_apiary_pebble_ready
+        )
+        self.framework.observe(self.on.tools_pebble_ready, self._on_tools_pebble_ready)
 
-        self.apiary = ApiaryPeers(self, "apiary")
+        self.apiary = ApiaryPeers(
+            self,
+            "apiary",
+            restart_concurrency=self.config["restart-concurrency"],
+            min_available_units=self.config["min-available-units"],
+        )
         self.framework.observe(self.apiary.on.token_available, self._on_apiary_changed)
+        self.framework.observe(
+            self.apiary.on.restart_granted, self._on_restart_granted
+        )
+        self.framework.observe(
+            self.apiary.on.database_changed, self._on_database_changed
+        )
+        self.framework.observe(
+            self.on.apiary_relation_created, self._on_apiary_relation_created
+        )
 
         self.framework.observe(
             self.on.mysql_database_relation_changed, self._on_db_changed
         )
+        self.framework.observe(
+            self.on.mysql_database_relation_departed, self._on_db_changed
+        )
         self.framework.observe(
             self.on.mysql_database_relation_broken, self._on_db_broken
         )
-        self.ingress = IngressRequires(
-            self,
-            {
-                "service-hostname": self.config["external-hostname"],
-                "service-name": self.app.name,
-                "service-port": 3000,
-            },
+        self.framework.observe(
+            self.on.object_storage_relation_changed, self._on_object_storage_changed
+        )
+        self.framework.observe(
+            self.on.object_storage_relation_broken, self._on_object_storage_broken
         )
-        self._stored.set_default(jwt_token=secrets.token_hex(16))
+        self.framework.observe(
+            self.on.metrics_endpoint_relation_joined, self._on_metrics_endpoint_changed
+        )
+        self.framework.observe(
+            self.on.metrics_endpoint_relation_broken, self._on_metrics_endpoint_changed
+        )
+        self.ingress = ChangedFieldsIngressRequires(self, self._ingress_config())
+        # Routes /thumbnails straight to the thumbnail service
+        self.thumbnails_ingress = ChangedFieldsIngressRequires(
+            self, self._thumbnails_ingress_config(), "thumbnails-ingress"
+        )
+        self._thumbnails_ingress_broken = False
+        self.framework.observe(
+            self.on.thumbnails_ingress_relation_joined, self._on_thumbnails_ingress_changed
+        )
+        self.framework.observe(
+            self.on.thumbnails_ingress_relation_broken, self._on_thumbnails_ingress_changed
+        )
+        self._stored.set_default(jwt_token=None)
+        # Only generated on the first hook rather than on every hook
+        if self._stored.jwt_token is None:
+            self._stored.jwt_token = secrets.token_hex(16)
+        self._stored.set_default(jwt_previous_token=None)
         self._stored.set_default(mysql_connection=None)
+        self._stored.set_default(mysql_replicas=[])
+        self._stored.set_default(mysql_database=None)
+        # MySQL database this unit migrated its SQLite data to
+        self._stored.set_default(mysql_migrated=None)
+        self._stored.set_default(object_storage=None)
+        self._stored.set_default(applied={})
+        self._stored.set_default(restart_pending=False)
+        self._stored.set_default(awaiting_ready=False)
+        self._stored.set_default(restarted_at=0)
+        self._stored.set_default(workload_version=None)
+        self._stored.set_default(sqlite_maintained_at=0)
+        self._stored.set_default(restart_cause=None)
+        self._stored.set_default(restart_changed_at=0)
+        # Signal of a reload waiting for changes to settle
+        self._stored.set_default(reload_signal=None)
+        self._stored.set_default(counters={})
+        self._stored.set_default(not_ready_since=None)
+        self._stored.set_default(load_sample=None)
+        # Event which triggered this reconcile, recorded against restarts
+        self._trigger = "other"
+        self.reconciler = Reconciler(self._stored.applied)
+
+    def _enable_profiling(self) -> None:
+        """Time Pebble and relation operations for this hook"""
+        import instrumentation
+
+        self.profiler = instrumentation.HookProfiler(
+            instrumentation.profile_path(self.charm_dir)
+        )
+        self.profiler.wrap(
+            self.unit.get_container("open-apiary").pebble,
+            instrumentation.PEBBLE_OPERATIONS,
+            "pebble",
+        )
+        # Relation data is read and written through the model backend; ops
+        # has no public hook around relation-get and relation-set, so its
+        # methods are wrapped, each only if present in this ops version
+        self.profiler.wrap(
+            self.model._backend, instrumentation.RELATION_OPERATIONS, "relation"
+        )
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    def _on_commit(self, event) -> None:
+        """Record the hook profile once the hook has completed"""
+        self.profiler.record(
+            applied=len(self.reconciler.applied),
+            skipped=len(self.reconciler.skipped),
+        )
+
+    def _on_profile_hooks_action(self, event: ActionEvent) -> None:
+        """Report aggregated hook profiling statistics"""
+        import instrumentation
+
+        records = instrumentation.load_records(instrumentation.profile_path(self.charm_dir))
+        if not records:
+            event.fail("No hook profile recorded; enable the hook-profiling option")
+            return
+        event.set_results(
+            {
+                "hooks": str(len(records)),
+                "profile": json.dumps(instrumentation.aggregate(records), sort_keys=True),
+            }
+        )
+
+    def _on_open_apiary_pebble_ready(self, event: WorkloadEvent) -> None:
+        """Reconcile from scratch as the container may have been replaced"""
+        self.reconciler.invalidate()
+        # A replaced container may be running a different image
+        self._stored.workload_version = None
+        self._reconcile()
+
+    def _on_tools_pebble_ready(self, event: WorkloadEvent) -> None:
+        """Reconcile from scratch as the tools container may have been replaced"""
+        self.reconciler.invalidate()
+        self._reconcile()
+
+    def _on_restart_granted(self, event: RestartGrantedEvent) -> None:
+        """Restart the workload now the leader has granted a slot"""
+        self._reconcile()
+
+    def _on_database_changed(self, event: DatabaseChangedEvent) -> None:
+        """Switch to MySQL now the leader has recorded the migration"""
+        self._reconcile()
 
     def _on_leader_elected(self, event: LeaderElectedEvent) -> None:
-        """Regenerate JWT token when new leader elected"""
-        jwt_token = secrets.token_hex(16)
-        self._stored.jwt_token = jwt_token
-        self.apiary.set_token(jwt_token)
-        self._on_config_changed(event)
+        """Share the JWT token with peers when a new leader is elected
+
+        The token is not regenerated so that user sessions survive changes
+        of leadership.
+        """
+        self._share_jwt_token()
+        self._reconcile()
+
+    def _on_apiary_relation_created(self, event: RelationCreatedEvent) -> None:
+        """Share the JWT token with peers once the peer relation exists"""
+        self._share_jwt_token()
+
+    def _on_thumbnails_ingress_changed(self, event: RelationEvent) -> None:
+        """Route /thumbnails through the main ingress unless routed directly"""
+        self._thumbnails_ingress_broken = isinstance(event, RelationBrokenEvent)
+        self._reconcile()
 
     def _on_apiary_changed(self, event: TokenAvailableEvent) -> None:
         """Handle changes on peer relation to cluster"""
         if self.unit.is_leader():
             return
+        self._sync_jwt_tokens()
+        self._reconcile()
+
+    def _on_update_status(self, event: UpdateStatusEvent) -> None:
+        """Refresh workload readiness and run scheduled maintenance"""
+        container = self.unit.get_container("open-apiary")
+        connected = container.can_connect()
+        self._claim_sqlite_database()
+        self._plan_mysql_migration()
+        if connected and not self._sqlite_standby:
+            # Debounced restarts and reloads are applied once the changes have settled
+            if self._stored.restart_pending:
+                self._restart_workload(container)
+            elif self._stored.reload_signal:
+                self._reload_workload(container)
+        self._report_load()
+        if self.unit.is_leader() and self._load_reports_enabled:
+            self._recommend_scaling()
+        self._update_readiness(container)
+        self._publish_charm_metrics()
+        interval = self.config["sqlite-maintenance-interval"] * 3600
+        due = time.time() - self._stored.sqlite_maintained_at >= interval
+        if connected and interval and due and self._sqlite_in_use:
+            try:
+                self._sqlite_maintenance(container)
+            except (APIError, ChangeError, ExecError) as e:
+                logging.warning("SQLite maintenance failed: %s", e)
+        if not self.unit.is_leader() or not self.apiary.apiary:
+            return
+        rotated_at = self.apiary.jwt_rotated_at
+        interval = self.config["jwt-rotation-interval"] * 3600
+        if interval and time.time() - rotated_at >= interval:
+            self._rotate_jwt_token()
+        elif self.apiary.previous_jwt_token and (
+            time.time() - rotated_at >= self.config["jwt-overlap-window"] * 3600
+        ):
+            logging.info("Expiring previous JWT token")
+            self.apiary.expire_previous_token()
+            self._sync_jwt_tokens()
+            self._reconcile()
+
+    @property
+    def _load_reports_enabled(self) -> bool:
+        """Whether units sample the workload metrics and report their load"""
+        return bool(self.config["load-report-interval"]) and not self.config["npm-start"]
+
+    def _report_load(self) -> None:
+        """Publish this unit's load to peers, at most once per interval
+
+        The first sample after the charm or the workload starts only sets
+        the baseline for the next report.
+        """
+        from load import fetch_sample, load_report
+
+        if not self._load_reports_enabled or not self.apiary.apiary:
+            return
+        previous = self._stored.load_sample
+        if previous and time.time() - previous["at"] < self.config["load-report-interval"]:
+            return
+        sample = fetch_sample("http://localhost:{}/metrics".format(WORKLOAD_METRICS_PORT))
+        if sample is None:
+            return
+        self._stored.load_sample = sample
+        report = load_report(previous, sample) if previous else None
+        if report:
+            self.apiary.set_load(report, refresh=self._load_report_max_age / 2)
+
+    def _recommend_scaling(self) -> dict:
+        """Aggregate peer load reports into a scaling recommendation"""
+        return self.apiary.recommend_scaling(
+            {
+                "rps": self.config["scale-up-rps"],
+                "p95": self.config["scale-up-latency"],
+                "cpu": self.config["scale-up-cpu"],
+                "lag": self.config["scale-up-lag"],
+            },
+            down_ratio=self.config["scale-down-ratio"],
+            hysteresis=self.config["scale-hysteresis"],
+            max_age=self._load_report_max_age,
+        )
+
+    @property
+    def _load_report_max_age(self) -> int:
+        return max(3 * self.config["load-report-interval"], LOAD_REPORT_MAX_AGE)
+
+    def _on_scaling_recommendation_action(self, event: ActionEvent) -> None:
+        """Report the scaling recommendation and the load reports behind it"""
+        if not self.apiary.apiary:
+            event.fail("Peer relation not yet available")
+            return
+        scaling = self.apiary.scaling
+        if not scaling:
+            event.fail("No scaling recommendation yet; check load-report-interval")
+            return
+        event.set_results(
+            {
+                "recommendation": scaling["recommendation"],
+                "units": str(scaling["units"]),
+                "suggested-units": str(scaling["suggested-units"]),
+                "load": json.dumps(scaling["load"], sort_keys=True),
+                "reports": json.dumps(
+                    self.apiary.load_reports(self._load_report_max_age), sort_keys=True
+                ),
+            }
+        )
+
+    def _on_rotate_jwt_secret_action(self, event: ActionEvent) -> None:
+        """Rotate the JWT token on demand"""
+        if not self.unit.is_leader():
+            event.fail("JWT secret can only be rotated on the leader unit")
+            return
+        if not self.apiary.apiary:
+            event.fail("Peer relation not yet available")
+            return
+        self._rotate_jwt_token()
+        event.set_results({"rotated-at": str(self.apiary.jwt_rotated_at)})
+
+    def _on_sqlite_maintenance_action(self, event: ActionEvent) -> None:
+        """Run VACUUM and ANALYZE on the SQLite database on demand"""
+        if not self._sqlite_in_use:
+            event.fail("Open Apiary is not using a SQLite database on this unit")
+            return
+        try:
+            results = self._sqlite_maintenance(self.unit.get_container("open-apiary"))
+        except (APIError, ChangeError, ExecError) as e:
+            event.fail("SQLite maintenance failed: {}".format(e))
+            return
+        event.set_results({key: str(value) for key, value in results.items()})
+
+    def _sqlite_maintenance(self, container) -> dict:
+        """VACUUM and ANALYZE the SQLite database through Pebble"""
+        size_before = container.list_files(SQLITE_DATABASE)[0].size
+        start = time.monotonic()
+        process = container.exec(
+            [
+                "sqlite3",
+                "-cmd",
+                ".timeout {}".format(self.config["sqlite-busy-timeout"] * 1000),
+                SQLITE_DATABASE,
+                "VACUUM; ANALYZE;",
+            ],
+            timeout=3600,
+        )
+        process.wait_output()
+        elapsed = time.monotonic() - start
+        size_after = container.list_files(SQLITE_DATABASE)[0].size
+        self._stored.sqlite_maintained_at = time.time()
+        logging.info(
+            "SQLite maintenance complete in %.1fs (%d -> %d bytes)",
+            elapsed,
+            size_before,
+            size_after,
+        )
+        return {
+            "size-before": size_before,
+            "size-after": size_after,
+            "seconds": round(elapsed, 3),
+        }
+
+    @property
+    def _sqlite_in_use(self) -> bool:
+        """Whether this unit serves Open Apiary from its SQLite database"""
+        return not self._mysql_in_use and not self._sqlite_standby
+
+    @property
+    def _sqlite_standby(self) -> bool:
+        """Whether this unit must not serve because SQLite cannot be shared
+
+        Each unit has its own data storage, so a single unit, chosen by the
+        leader and kept across leadership changes, serves from SQLite; the
+        others would write to databases which quietly diverge.
+        """
+        if self._mysql_required:
+            return True
+        if self._mysql_in_use or not self.apiary.apiary:
+            return False
+        owner = self.apiary.database_unit
+        if owner is None:
+            # Peers wait for the leader to claim the database
+            return bool(self.apiary.apiary.units)
+        return owner != self.unit.name
+
+    def _claim_sqlite_database(self) -> None:
+        """Record the unit owning the SQLite database (leader only)"""
+        if self.unit.is_leader() and self.apiary.apiary and not self._mysql_in_use:
+            self.apiary.claim_database()
+
+    def _share_jwt_token(self) -> None:
+        """Share this unit's JWT token with peers unless the leader already has"""
+        if not self.unit.is_leader() or not self.apiary.apiary:
+            return
+        if not self.apiary.jwt_token:
+            self.apiary.set_token(self._stored.jwt_token)
+        self._sync_jwt_tokens()
+
+    def _rotate_jwt_token(self) -> None:
+        """Generate a new JWT token, retaining the current token as previous"""
+        logging.info("Rotating JWT token")
+        if self.config["npm-start"]:
+            logging.warning("Sessions signed with the previous JWT token end with npm-start")
+        self.apiary.set_token(secrets.token_hex(16))
+        self._count("jwt-rotations")
+        self._sync_jwt_tokens()
+        self._reconcile()
+
+    def _sync_jwt_tokens(self) -> None:
+        """Take the current and previous JWT tokens from the peer relation"""
         self._stored.jwt_token = self.apiary.jwt_token
-        self._on_config_changed(event)
+        self._stored.jwt_previous_token = self.apiary.previous_jwt_token
+
+    def _on_db_changed(self, event: RelationEvent) -> None:
+        """Handle connection to MySQL DB
 
-    def _on_db_changed(self, event: RelationChangedEvent) -> None:
-        """Handle connection to MySQL DB"""
+        Every unit on the relation with complete connection data is used;
+        the primary (or first) unit takes writes and any others serve
+        reads as replicas.
+        """
         # TODO(jamespage)
         # refactor into interface library for more general use or
         # consume something more official from a mysql* operator
-        mysql_connection = {
-            "database": event.relation.data[event.unit].get("database"),
-            "host": event.relation.data[event.unit].get("host"),
-            "port": event.relation.data[event.unit].get("port", 3306),
-            "username": event.relation.data[event.unit].get("user"),
-            "password": event.relation.data[event.unit].get("password"),
-        }
-        if all(mysql_connection.values()):
-            self._stored.mysql_connection = mysql_connection
-        else:
-            self._stored.mysql_connection = None
-        self._on_config_changed(event)
+        connections = []
+        primary = None
+        for unit in sorted(event.relation.units, key=lambda u: u.name):
+            data = event.relation.data[unit]
+            mysql_connection = {
+                "database": data.get("database"),
+                "host": data.get("host"),
+                "port": data.get("port", 3306),
+                "username": data.get("user"),
+                "password": data.get("password"),
+            }
+            if not all(mysql_connection.values()):
+                continue
+            if data.get("role") in ("primary", "master") and primary is None:
+                primary = mysql_connection
+            else:
+                connections.append(mysql_connection)
+        if primary is None and connections:
+            primary = connections.pop(0)
+        self._stored.mysql_connection = primary
+        self._stored.mysql_replicas = connections
+        # Identifies the database across changes of primary
+        self._stored.mysql_database = (
+            "{}/{}".format(event.relation.app.name, primary["database"]) if primary else None
+        )
+        self._reconcile()
 
     def _on_db_broken(self, event: RelationBrokenEvent) -> None:
         """Handle removal of relation to DB"""
         self._stored.mysql_connection = None
-        self._on_config_changed(event)
+        self._stored.mysql_replicas = []
+        self._stored.mysql_database = None
+        self._reconcile()
+
+    def _on_object_storage_changed(self, event: RelationEvent) -> None:
+        """Share uploads through the related S3-compatible bucket"""
+        data = event.relation.data[event.app] if event.app else {}
+        object_storage = {
+            "endpoint": data.get("endpoint"),
+            "bucket": data.get("bucket"),
+            "access-key": data.get("access-key"),
+            "secret-key": data.get("secret-key"),
+        }
+        if not all(object_storage.values()):
+            object_storage = None
+        else:
+            object_storage["region"] = data.get("region") or ""
+            object_storage["path"] = data.get("path") or ""
+        self._stored.object_storage = object_storage
+        self._reconcile()
+
+    def _on_object_storage_broken(self, event: RelationBrokenEvent) -> None:
+        """Keep uploads on the local storage only"""
+        self._stored.object_storage = None
+        self._reconcile()
+
+    @property
+    def _shared_uploads_enabled(self) -> bool:
+        """Whether uploads are shared between units through object storage
+
+        Uploads missing from the local cache are only fetched by the
+        cluster wrapper.
+        """
+        return bool(self._stored.object_storage) and not self.config["npm-start"]
+
+    @property
+    def _mysql_in_use(self) -> bool:
+        """Whether Open Apiary is configured to use the related MySQL database
+
+        Units switch once the leader has recorded that no SQLite data needs
+        migrating or that it has been migrated; the unit which migrated the
+        data switches straight away.
+        """
+        key = self._migration_key
+        return key is not None and key == self._migrated_to
+
+    @property
+    def _migrated_to(self) -> str:
+        """MySQL database which Open Apiary data now lives in, if any"""
+        migration = self.apiary.mysql_migration
+        if migration.get("migrated"):
+            return migration["database"]
+        return self._stored.mysql_migrated
+
+    @property
+    def _mysql_required(self) -> bool:
+        """Whether the data lives in a MySQL database which is not related
+
+        The SQLite database is left behind by the migration, so serving it
+        again would split new data from the data in MySQL.
+        """
+        return self._migrated_to is not None and not self._mysql_in_use
+
+    @property
+    def _migration_pending(self) -> bool:
+        """Whether SQLite data must be migrated before switching to MySQL"""
+        key = self._migration_key
+        if key is None or self._mysql_in_use:
+            return False
+        migration = self.apiary.mysql_migration
+        return migration.get("database") == key and migration["migrated"] is False
+
+    def _plan_mysql_migration(self) -> None:
+        """Report SQLite data held and record the MySQL database to switch to
+
+        Only the unit owning the SQLite database knows whether it holds
+        data, so it reports that and every unit follows the leader's
+        decision on whether the data must be migrated first.
+        """
+        key = self._migration_key
+        if not self.apiary.apiary or key is None or self._migrated_to is not None:
+            return
+        if self.apiary.database_unit == self.unit.name:
+            present = self._sqlite_has_rows()
+            if present is not None:
+                self.apiary.set_sqlite_data(present)
+        if self.unit.is_leader() and self.apiary.plan_mysql_migration(key):
+            logging.info("Recorded MySQL database %s", key)
+
+    def _sqlite_has_rows(self) -> bool:
+        """Whether the SQLite database holds any rows, or None if unreadable
+
+        Open Apiary creates its tables on first start, so an empty database
+        needs no migration.
+        """
+        from migration import SQLiteDatabase
+
+        path = self._sqlite_path
+        if path is None or not path.exists():
+            return False
+        try:
+            db = SQLiteDatabase.open(path)
+            try:
+                return db.has_rows()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logging.warning("Unable to read SQLite database: %s", e)
+            return None
+
+    @property
+    def _migration_key(self) -> str:
+        """Identity of the related MySQL database, kept when its primary changes"""
+        if not self._stored.mysql_connection:
+            return None
+        return self._stored.mysql_database
+
+    @property
+    def _sqlite_path(self) -> pathlib.Path:
+        """SQLite database on the data storage as mounted in the charm container"""
+        storages = self.model.storages["data"]
+        if not storages:
+            return None
+        return storages[0].location / pathlib.PurePath(SQLITE_DATABASE).name
+
+    def _on_migrate_to_mysql_action(self, event: ActionEvent) -> None:
+        """Copy the SQLite database into MySQL and switch over once verified
+
+        Open Apiary is stopped for the copy unless online is set, in which
+        case the bulk of the rows are copied while it keeps serving and it
+        is only stopped to copy rows inserted in the meantime.
+        """
+        from migration import MySQLDatabase, SQLiteDatabase, migrate, verify
+
+        if not self._migration_pending:
+            event.fail("No SQLite database waiting to be migrated to MySQL")
+            return
+        if self._sqlite_standby or self._sqlite_path is None:
+            event.fail("SQLite database is owned by {}".format(self.apiary.database_unit))
+            return
+        container = self.unit.get_container("open-apiary")
+        connection = dict(self._stored.mysql_connection)
+        chunk_size = event.params["chunk-size"]
+        batch_size = event.params["batch-size"]
+
+        def progress(table, done, total, rate):
+            event.log("{}: {}/{} rows ({:.0f} rows/s)".format(table, done, total, rate))
+
+        source = SQLiteDatabase.open(self._sqlite_path)
+        try:
+            target = MySQLDatabase.connect(
+                connection["host"],
+                connection["port"],
+                connection["username"],
+                connection["password"],
+                connection["database"],
+            )
+            try:
+                copied, elapsed = 0, 0.0
+                if event.params["online"]:
+                    copied, elapsed = migrate(
+                        source, target, chunk_size, batch_size, progress
+                    )
+                self._stop_workload(container)
+                final_copied, final_elapsed = migrate(
+                    source, target, chunk_size, batch_size, progress
+                )
+                copied += final_copied
+                elapsed += final_elapsed
+                mismatches = verify(source, target)
+            finally:
+                target.close()
+        except Exception as e:
+            logging.exception("Migration to MySQL failed")
+            event.fail("Migration to MySQL failed: {}".format(e))
+            self._reconcile()
+            return
+        finally:
+            source.close()
+
+        if mismatches:
+            event.fail(
+                "Row counts differ after migration: {}".format(
+                    ", ".join("{} ({} != {})".format(*m) for m in mismatches)
+                )
+            )
+            self._reconcile()
+            return
+        logging.info("Migrated %d rows from SQLite to MySQL in %.1fs", copied, elapsed)
+        self._stored.mysql_migrated = self._migration_key
+        # Peers switch once the leader records the migration
+        self.apiary.report_migrated(self._stored.mysql_migrated)
+        self._reconcile()
+        event.set_results(
+            {
+                "rows": str(copied),
+                "seconds": str(round(elapsed, 3)),
+                "rows-per-second": str(round(copied / elapsed if elapsed else 0.0)),
+            }
+        )
+
+    def _storage_paths(self, names: str) -> dict:
+        """Locations in the charm container of a comma separated list of storages
+
+        Raises ValueError for storages which cannot be backed up or are not
+        attached to this unit.
+        """
+        paths = {}
+        for name in filter(None, (name.strip() for name in names.split(","))):
+            if name not in BACKUP_STORAGES:
+                raise ValueError("Unknown storage {}".format(name))
+            storages = self.model.storages[name]
+            if not storages:
+                raise ValueError("Storage {} is not attached".format(name))
+            paths[name] = storages[0].location
+        if not paths:
+            raise ValueError("No storages selected")
+        return paths
+
+    def _backup_store(self, params: dict):
+        """Backup store for the target given in action params"""
+        from backup import open_store
+
+        return open_store(
+            params["target"],
+            endpoint=params.get("s3-endpoint"),
+            access_key=params.get("s3-access-key"),
+            secret_key=params.get("s3-secret-key"),
+            region=params.get("s3-region"),
+        )
+
+    def _on_backup_action(self, event: ActionEvent) -> None:
+        """Back up the data and uploads storages without stopping Open Apiary
+
+        Only files changed since the last backup in the target are read, and
+        the SQLite database is copied from an online snapshot.
+        """
+        import sqlite3
+
+        from backup import Backup, BackupError
+        from s3 import S3Error
+
+        def progress(storage, stats):
+            event.log(
+                "{}: {} files, {} changed, {} bytes read".format(
+                    storage, stats["files"], stats["changed"], stats["bytes-read"]
+                )
+            )
+
+        try:
+            sources = self._storage_paths(event.params["storages"])
+        except ValueError as e:
+            event.fail(str(e))
+            return
+        try:
+            backup = Backup(
+                self._backup_store(event.params),
+                chunk_size=event.params["chunk-size"] * 1024,
+                level=event.params["compression"],
+                progress=progress,
+            )
+            manifest = backup.run(
+                sources,
+                exclude=BACKUP_EXCLUDES,
+                database=("data", pathlib.PurePath(SQLITE_DATABASE).name),
+                sqlite_timeout=self.config["sqlite-busy-timeout"],
+            )
+        except (BackupError, S3Error, OSError, sqlite3.Error) as e:
+            logging.exception("Backup failed")
+            event.fail("Backup failed: {}".format(e))
+            return
+        results = {key: str(value) for key, value in backup.stats.items()}
+        results["backup"] = manifest["name"]
+        event.set_results(results)
+
+    def _on_restore_action(self, event: ActionEvent) -> None:
+        """Restore the data and uploads storages from a backup
+
+        Open Apiary is stopped while the data storage is restored so the
+        database is not replaced underneath it.
+        """
+        from backup import BackupError, restore
+        from s3 import S3Error
+
+        def progress(storage, stats):
+            event.log(
+                "{}: {} files, {} restored, {} bytes written".format(
+                    storage, stats["files"], stats["restored"], stats["bytes-written"]
+                )
+            )
+
+        try:
+            targets = self._storage_paths(event.params["storages"])
+        except ValueError as e:
+            event.fail(str(e))
+            return
+        container = self.unit.get_container("open-apiary")
+        try:
+            store = self._backup_store(event.params)
+            if "data" in targets:
+                self._stop_workload(container)
+            stats = restore(store, targets, event.params.get("backup") or None, progress)
+            if "data" in targets:
+                database = targets["data"] / pathlib.PurePath(SQLITE_DATABASE).name
+                # A journal left by the previous database would corrupt the restored one
+                for suffix in ("-journal", "-shm", "-wal"):
+                    database.with_name(database.name + suffix).unlink(missing_ok=True)
+        except (BackupError, S3Error, OSError) as e:
+            logging.exception("Restore failed")
+            event.fail("Restore failed: {}".format(e))
+            self._reconcile()
+            return
+        self._reconcile()
+        event.set_results({key: str(value) for key, value in stats.items()})
 
     def _on_config_changed(self, event) -> None:
-        """Define and start a workload using the Pebble API"""
-        # NOTE(jamespage):
-        # need to understand how config-change/relations get executed
-        # if it applies to all sidecars at the same time there is a
-        # chance that a service interuption will occur
+        """Handle changes to charm configuration"""
+        self._trigger = "config-changed"
+        self.apiary.restart_concurrency = self.config["restart-concurrency"]
+        self.apiary.min_available_units = self.config["min-available-units"]
+        if self.unit.is_leader():
+            # Restart concurrency limits may have changed
+            self.apiary.grant_restarts()
+        self._reconcile()
+
+    def _reconcile(self) -> None:
+        """Converge the workload on the desired state in a single pass
+
+        The desired state is computed once and each component is only
+        pushed to Pebble or the relation data bags when it differs from
+        the snapshot of what was last applied.
+        """
         container = self.unit.get_container("open-apiary")
+        self._claim_sqlite_database()
+        self._plan_mysql_migration()
+        if not container.can_connect():
+            # Reconciled again once the container is pebble-ready
+            self._update_readiness(container)
+            return
+        reconciler = self.reconciler
+        config = self._open_apiary_config()
         layer = self._open_apiary_layer()
-        services = container.get_plan().to_dict().get("services", {})
-        if services != layer["services"]:
-            container.add_layer("open-apiary", layer, combine=True)
-            logging.info("Added updated layer 'open-apiary' to Pebble plan")
-            if container.get_service("open-apiary").is_running():
-                container.stop("open-apiary")
-            container.push(
+
+        restart = False
+        if reconciler.changed("layer", layer):
+            # Snapshot is missing or stale so consult Pebble directly
+            reconciler.ran("get-plan")
+            plan = container.get_plan().to_dict()
+            services = plan.get("services", {})
+            if services != layer["services"] or plan.get("checks", {}) != layer["checks"]:
+                container.add_layer("open-apiary", layer, combine=True)
+                reconciler.ran("add-layer")
+                logging.info("Added updated layer 'open-apiary' to Pebble plan")
+                # Check changes are picked up by Pebble without a restart
+                restart = services != layer["services"]
+            else:
+                reconciler.skip("add-layer")
+            reconciler.record("layer", layer)
+        else:
+            reconciler.skip("get-plan", "add-layer")
+
+        restarts, reloads = sync_files(container, reconciler, self._managed_files(config))
+        if "open-apiary" in restarts:
+            restart = True
+
+        if restart:
+            self._stored.restart_pending = True
+            self._stored.restart_cause = self._trigger
+        elif "open-apiary" in reloads:
+            self._stored.reload_signal = reloads["open-apiary"]
+        if restart or "open-apiary" in reloads:
+            # Each change restarts the quiet period of a debounced restart or reload
+            self._stored.restart_changed_at = time.time()
+        if self._sqlite_standby:
+            # Started again once a MySQL database is related
+            self._stop_workload(container)
+        elif self._stored.restart_pending:
+            self._restart_workload(container)
+        elif self._stored.reload_signal:
+            self._reload_workload(container)
+
+        self._reconcile_tools()
+
+        workload_version = self._workload_version(container)
+        if reconciler.changed("workload-version", workload_version):
+            self.unit.set_workload_version(workload_version)
+            reconciler.ran("set-workload-version")
+            reconciler.record("workload-version", workload_version)
+        else:
+            reconciler.skip("set-workload-version")
+
+        # Leadership and relation presence are part of the desired state
+        # as IngressRequires only writes when both are in place.
+        ingress = self._ingress_config()
+        ingress_relation = self.model.get_relation("ingress")
+        ingress_state = {
+            "config": ingress,
+            "leader": self.unit.is_leader(),
+            "relation": ingress_relation.id if ingress_relation else None,
+        }
+        if self._ingress_config_errors(ingress):
+            reconciler.skip("update-ingress")
+        elif reconciler.changed("ingress", ingress_state):
+            self._update_ingress(ingress)
+            reconciler.ran("update-ingress")
+            reconciler.record("ingress", ingress_state)
+        else:
+            reconciler.skip("update-ingress")
+
+        thumbnails_ingress = self._thumbnails_ingress_config()
+        thumbnails_ingress_state = {
+            "config": thumbnails_ingress,
+            "leader": self.unit.is_leader(),
+            "related": self._thumbnails_ingress_related,
+        }
+        if reconciler.changed("thumbnails-ingress", thumbnails_ingress_state):
+            changed = self.thumbnails_ingress.apply(thumbnails_ingress)
+            if changed:
+                logging.debug("Updated thumbnails ingress field(s): %s", ", ".join(changed))
+            reconciler.ran("update-thumbnails-ingress")
+            reconciler.record("thumbnails-ingress", thumbnails_ingress_state)
+        else:
+            reconciler.skip("update-thumbnails-ingress")
+
+        metrics_endpoint = self._metrics_endpoint_state()
+        if reconciler.changed("metrics-endpoint", metrics_endpoint):
+            self._update_metrics_endpoint(metrics_endpoint)
+            reconciler.ran("update-metrics-endpoint")
+            reconciler.record("metrics-endpoint", metrics_endpoint)
+        else:
+            reconciler.skip("update-metrics-endpoint")
+
+        self._update_readiness(container)
+        self._publish_charm_metrics()
+        reconciler.report()
+
+    def _ingress_config(self) -> dict:
+        """Ingress relation fields including the performance profile"""
+        ingress = {
+            "service-hostname": self.config["external-hostname"],
+            "service-name": self.app.name,
+            "service-port": APP_PORT,
+            "retry-errors": INGRESS_RETRY_ERRORS,
+            "max-body-size": self.config["ingress-max-body-size"],
+        }
+        if self.config["ingress-limit-rps"]:
+            ingress["limit-rps"] = self.config["ingress-limit-rps"]
+        routes = [r.strip() for r in self.config["ingress-path-routes"].split(",") if r.strip()]
+        routed = not self._thumbnails_enabled or self._thumbnails_ingress_related
+        if not routed and THUMBNAIL_ROUTE not in routes:
+            routes = (routes or ["/"]) + [THUMBNAIL_ROUTE]
+        if routes:
+            ingress["path-routes"] = ",".join(routes)
+        # Session affinity is only useful with more than one unit
+        peers = self.model.get_relation("apiary")
+        if peers and peers.units and self.config["ingress-session-cookie-max-age"]:
+            ingress["session-cookie-max-age"] = self.config[
+                "ingress-session-cookie-max-age"
+            ]
+        return ingress
+
+    @property
+    def _thumbnails_ingress_related(self) -> bool:
+        """Whether the ingress routes /thumbnails to the thumbnail service itself"""
+        related = bool(self.model.relations["thumbnails-ingress"])
+        return related and not self._thumbnails_ingress_broken
+
+    def _thumbnails_ingress_config(self) -> dict:
+        """Thumbnails ingress relation fields, on the same hostname as the application"""
+        return {
+            "service-hostname": self.config["external-hostname"],
+            "service-name": "{}-thumbnails".format(self.app.name),
+            "service-port": THUMBNAIL_PORT,
+            "path-routes": THUMBNAIL_ROUTE,
+        }
+
+    def _update_ingress(self, ingress: dict) -> None:
+        """Write the ingress fields which differ from the relation data"""
+        changed = self.ingress.apply(ingress)
+        if changed:
+            logging.debug("Updated ingress relation field(s): %s", ", ".join(changed))
+
+    def _ingress_config_errors(self, ingress: dict) -> list:
+        """Validate ingress fields before they are written to the relation"""
+        errors = []
+        fields = REQUIRED_INGRESS_RELATION_FIELDS | OPTIONAL_INGRESS_RELATION_FIELDS
+        unknown = sorted(set(ingress) - fields)
+        if unknown:
+            errors.append("unknown field(s) {}".format(", ".join(unknown)))
+        missing = sorted(REQUIRED_INGRESS_RELATION_FIELDS - set(ingress))
+        if missing:
+            errors.append("missing field(s) {}".format(", ".join(missing)))
+        for key in ("max-body-size", "limit-rps", "session-cookie-max-age"):
+            if ingress.get(key, 0) < 0:
+                errors.append("{} must not be negative".format(key))
+        routes = ingress.get("path-routes")
+        if routes and not all(r.strip().startswith("/") for r in routes.split(",")):
+            errors.append("path-routes must start with /")
+        return errors
+
+    def _restart_workload(self, container) -> bool:
+        """Restart the workload once the peers grant a restart slot
+
+        Restarts are coordinated by the leader across the apiary peer
+        relation so that a configuration rollout does not take down every
+        unit at once.  A service which is not running has no capacity to
+        lose so is started straight away.
+
+        With restart-debounce set, a running service is only restarted once
+        no further changes have needed a restart for that many seconds, so
+        a burst of changes results in a single restart.
+        """
+        running = container.get_service("open-apiary").is_running()
+        if running and not self._restart_settled:
+            logging.info("Restart of open_apiary service waiting for changes to settle")
+            return False
+        if running:
+            nonce = checksum_dict(
+                {
+                    key: value
+                    for key, value in self._stored.applied.items()
+                    if key == "layer" or key.startswith("file:")
+                }
+            )
+            if not self.apiary.acquire_restart(nonce):
+                logging.info("Restart of open_apiary service waiting for a slot")
+                return False
+            container.stop("open-apiary")
+            self.reconciler.ran("stop")
+            self._count("restarts", self._stored.restart_cause or "other")
+        container.start("open-apiary")
+        self.reconciler.ran("start")
+        logging.info("Restarted open_apiary service")
+        self._stored.restart_cause = None
+        self._stored.workload_version = None
+        self._stored.restart_pending = False
+        # Started workers read the changed files so no reload is needed
+        self._stored.reload_signal = None
+        # The restart slot is held until the workload reports ready
+        self._stored.awaiting_ready = True
+        self._stored.restarted_at = time.time()
+        return True
+
+    @property
+    def _restart_settled(self) -> bool:
+        """Whether the quiet period since the last change needing a restart or reload is over"""
+        quiet = time.time() - self._stored.restart_changed_at
+        return quiet >= self.config["restart-debounce"]
+
+    def _workload_version(self, container) -> str:
+        """Version of Open Apiary running in the container
+
+        The version only changes with the image, so package.json is read
+        after the container is replaced or the service is (re)started and
+        the cached version is used in every other hook.
+        """
+        if self._stored.workload_version is None:
+            package_info = json.loads(container.pull("/opt/app/package.json").read())
+            self.reconciler.ran("pull-package-info")
+            self._stored.workload_version = package_info.get("version")
+        else:
+            self.reconciler.skip("pull-package-info")
+        return self._stored.workload_version
+
+    def _reconcile_tools(self) -> None:
+        """Converge the helper services run in the tools container
+
+        Helper services are restarted when their layer or scripts change;
+        they do not serve users directly so are not coordinated with peers.
+        """
+        container = self.unit.get_container("tools")
+        if not container.can_connect():
+            return
+        reconciler = self.reconciler
+        layer = self._tools_layer()
+        restarts, _ = sync_files(container, reconciler, self._tools_files())
+        if reconciler.changed("tools-layer", layer):
+            container.add_layer("tools", layer, combine=True)
+            reconciler.ran("add-tools-layer")
+            reconciler.record("tools-layer", layer)
+            restarts.update(layer["services"])
+        else:
+            reconciler.skip("add-tools-layer")
+        for name, service in layer["services"].items():
+            running = container.get_service(name).is_running()
+            if service["startup"] == "disabled":
+                if running:
+                    container.stop(name)
+                    reconciler.ran("stop:{}".format(name))
+            elif name in restarts or not running:
+                if running:
+                    container.stop(name)
+                container.start(name)
+                reconciler.ran("start:{}".format(name))
+                logging.info("Started %s service", name)
+
+    def _tools_files(self) -> list:
+        """Scripts run by the helper services in the tools container"""
+        return [
+            ManagedFile(THUMBNAILER, THUMBNAILER_SOURCE.read_text(), services=["thumbnailer"]),
+            ManagedFile(
+                METRICS_EXPORTER,
+                METRICS_EXPORTER_SOURCE.read_text(),
+                services=["metrics-exporter"],
+            ),
+            ManagedFile(
+                WEATHER_PROXY, WEATHER_PROXY_SOURCE.read_text(), services=["weather-proxy"]
+            ),
+            ManagedFile(S3_CLIENT, S3_CLIENT_SOURCE.read_text(), services=["uploads"]),
+            ManagedFile(
+                UPLOADS_SERVICE, UPLOADS_SERVICE_SOURCE.read_text(), services=["uploads"]
+            ),
+        ]
+
+    def _tools_layer(self) -> dict:
+        """Generate Pebble Layer for the helper services"""
+        thumbnailer_environment = {
+            "UPLOAD_PATH": "/uploads",
+            "THUMBNAIL_PATH": THUMBNAIL_PATH,
+            # Reached by the ingress through the thumbnails-ingress relation
+            "THUMBNAIL_HOST": "0.0.0.0",
+            "THUMBNAIL_PORT": str(THUMBNAIL_PORT),
+            "THUMBNAIL_SIZE": str(self.config["thumbnail-size"]),
+            "THUMBNAIL_CACHE_SIZE": str(self.config["thumbnail-cache-size"]),
+        }
+        object_storage = self._stored.object_storage or {}
+        uploads_environment = {
+            "UPLOAD_PATH": "/uploads",
+            "UPLOADS_PORT": str(UPLOADS_PORT),
+            "UPLOADS_CACHE_SIZE": str(self.config["uploads-cache-size"]),
+            "UPLOADS_SYNC_INTERVAL": str(self.config["uploads-sync-interval"]),
+        }
+        if self._shared_uploads_enabled:
+            thumbnailer_environment["UPLOADS_URL"] = "http://localhost:{}".format(UPLOADS_PORT)
+            uploads_environment.update(
+                {
+                    "S3_ENDPOINT": object_storage["endpoint"],
+                    "S3_BUCKET": object_storage["bucket"],
+                    "S3_REGION": object_storage["region"],
+                    "S3_PREFIX": object_storage["path"],
+                    "S3_ACCESS_KEY": object_storage["access-key"],
+                    "S3_SECRET_KEY": object_storage["secret-key"],
+                }
+            )
+        return {
+            "summary": "Open Apiary tools layer",
+            "description": "pebble config layer for Open Apiary helper services",
+            "services": {
+                "thumbnailer": {
+                    "override": "replace",
+                    "summary": "thumbnailer",
+                    "command": "python3 {}".format(THUMBNAILER),
+                    "startup": "enabled" if self._thumbnails_enabled else "disabled",
+                    "environment": thumbnailer_environment,
+                },
+                "metrics-exporter": {
+                    "override": "replace",
+                    "summary": "metrics-exporter",
+                    "command": "python3 {}".format(METRICS_EXPORTER),
+                    # Only scraped once related to Prometheus
+                    "startup": "enabled"
+                    if self.model.relations["metrics-endpoint"]
+                    else "disabled",
+                    "environment": {
+                        "METRICS_PORT": str(METRICS_PORT),
+                        "WORKLOAD_METRICS_URL": "http://localhost:{}/metrics".format(
+                            WORKLOAD_METRICS_PORT
+                        ),
+                        "CHARM_METRICS": CHARM_METRICS,
+                    },
+                },
+                "weather-proxy": {
+                    "override": "replace",
+                    "summary": "weather-proxy",
+                    "command": "python3 {}".format(WEATHER_PROXY),
+                    "startup": "enabled" if self._weather_cache_enabled else "disabled",
+                    "environment": {
+                        "WEATHER_UPSTREAM": "https://{}".format(WEATHER_API_HOST),
+                        "WEATHER_PROXY_PORT": str(WEATHER_PROXY_PORT),
+                        "WEATHER_CACHE_TTL": str(self.config["weather-cache-ttl"]),
+                        "WEATHER_CACHE_GRID": str(self.config["weather-cache-grid"]),
+                        "WEATHER_CACHE_SIZE": str(self.config["weather-cache-size"]),
+                    },
+                },
+                "uploads": {
+                    "override": "replace",
+                    "summary": "uploads",
+                    "command": "python3 {}".format(UPLOADS_SERVICE),
+                    "startup": "enabled" if self._shared_uploads_enabled else "disabled",
+                    "environment": uploads_environment,
+                },
+            },
+        }
+
+    @property
+    def _thumbnails_enabled(self) -> bool:
+        """Whether thumbnails are generated and served by the thumbnail service"""
+        return self.config["thumbnails"] and not self.config["npm-start"]
+
+    @property
+    def _weather_cache_enabled(self) -> bool:
+        """Whether weather API requests are routed through the caching proxy"""
+        if self.config["npm-start"] or not self.config.get("weather-api-token"):
+            return False
+        return self.config["weather-cache"]
+
+    def _on_metrics_endpoint_changed(self, event: RelationEvent) -> None:
+        """Publish the scrape job and start or stop the metrics exporter"""
+        self._reconcile()
+
+    def _metrics_endpoint_state(self) -> dict:
+        """Desired metrics-endpoint relation data for this unit"""
+        relations = [r.id for r in self.model.relations["metrics-endpoint"]]
+        return {
+            "relations": relations,
+            "leader": self.unit.is_leader(),
+            # Resolving the address can block on DNS, so only when it is needed
+            "address": socket.getfqdn() if relations else None,
+        }
+
+    def _update_metrics_endpoint(self, state: dict) -> None:
+        """Write the Prometheus scrape job and unit address to the relations"""
+        scrape_jobs = [
+            {
+                "metrics_path": "/metrics",
+                "static_configs": [{"targets": ["*:{}".format(METRICS_PORT)]}],
+            }
+        ]
+        scrape_metadata = {
+            "model": self.model.name,
+            "model_uuid": self.model.uuid,
+            "application": self.app.name,
+            "charm_name": self.meta.name,
+        }
+        for relation in self.model.relations["metrics-endpoint"]:
+            unit_data = relation.data[self.unit]
+            unit_data["prometheus_scrape_unit_address"] = state["address"]
+            unit_data["prometheus_scrape_unit_name"] = self.unit.name
+            if state["leader"]:
+                app_data = relation.data[self.app]
+                app_data["scrape_jobs"] = json.dumps(scrape_jobs)
+                app_data["scrape_metadata"] = json.dumps(scrape_metadata)
+
+    def _count(self, name: str, label: str = None, value: float = 1) -> None:
+        """Add to a charm counter exported on the metrics endpoint"""
+        key = name if label is None else "{}:{}".format(name, label)
+        self._stored.counters[key] = self._stored.counters.get(key, 0) + value
+
+    def _charm_metrics(self) -> str:
+        """Charm counters in the Prometheus text format"""
+        lines = []
+        counters = self._stored.counters
+        for name, (metric, label, description) in CHARM_COUNTERS.items():
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} counter".format(metric))
+            if label is None:
+                lines.append("{} {}".format(metric, int(counters.get(name, 0))))
+                continue
+            for key in sorted(counters):
+                if key.startswith(name + ":"):
+                    lines.append(
+                        '{}{{{}="{}"}} {}'.format(
+                            metric, label, key.split(":", 1)[1], int(counters[key])
+                        )
+                    )
+        ready = self._stored.not_ready_since is None
+        lines.append("# HELP open_apiary_charm_ready Whether the unit is ready")
+        lines.append("# TYPE open_apiary_charm_ready gauge")
+        lines.append("open_apiary_charm_ready {}".format(int(ready)))
+        return "\n".join(lines) + "\n"
+
+    def _publish_charm_metrics(self) -> None:
+        """Push the charm counters to the exporter when they have changed"""
+        container = self.unit.get_container("tools")
+        if not container.can_connect():
+            return
+        metrics = self._charm_metrics()
+        # Kept apart from the managed files, which identify restart requests
+        if self.reconciler.changed("charm-metrics", metrics):
+            container.push(CHARM_METRICS, metrics, make_dirs=True)
+            self.reconciler.ran("push-charm-metrics")
+            self.reconciler.record("charm-metrics", metrics)
+        else:
+            self.reconciler.skip("push-charm-metrics")
+
+    def _stop_workload(self, container) -> None:
+        """Stop the workload, starting it again on the next reconcile"""
+        if container.get_service("open-apiary").is_running():
+            container.stop("open-apiary")
+            self.reconciler.ran("stop")
+            logging.info("Stopped open_apiary service")
+        self._stored.restart_pending = True
+
+    def _reload_workload(self, container) -> None:
+        """Signal the workload to reload changed files without a restart
+
+        The cluster wrapper replaces its workers one at a time on reload so
+        the unit keeps serving requests throughout.  With restart-debounce
+        set, the reload waits for changes to settle like a restart.
+        """
+        signal = self._stored.reload_signal
+        if not container.get_service("open-apiary").is_running():
+            # Picked up when the service is started
+            self._stored.reload_signal = None
+            return
+        if not self._restart_settled:
+            logging.info("Reload of open_apiary service waiting for changes to settle")
+            return
+        container.send_signal(signal, "open-apiary")
+        self._stored.reload_signal = None
+        self.reconciler.ran("send-signal")
+        self._count("reloads")
+        logging.info("Reloaded open_apiary service with %s", signal)
+
+    def _managed_files(self, config: dict) -> list:
+        """Files rendered into the open-apiary container"""
+        # The cluster wrapper reloads its workers on SIGHUP; npm does not
+        files = [
+            ManagedFile(
                 "/opt/app/config.json",
-                json.dumps(self._open_apiary_config(), sort_keys=True, indent=2),
-                make_dirs=True,
+                json.dumps(config, sort_keys=True, indent=2),
+                services=["open-apiary"],
+                reload_signal=None if self.config["npm-start"] else "SIGHUP",
             )
-            container.start("open-apiary")
-            logging.info("Restarted open_apiary service")
+        ]
+        if not self.config["npm-start"]:
+            files.extend(
+                [
+                    ManagedFile(
+                        CLUSTER_WRAPPER,
+                        CLUSTER_WRAPPER_SOURCE.read_text(),
+                        services=["open-apiary"],
+                    ),
+                    ManagedFile(
+                        LOG_SHIPPER,
+                        LOG_SHIPPER_SOURCE.read_text(),
+                        services=["open-apiary"],
+                    ),
+                    ManagedFile(
+                        WORKLOAD_METRICS,
+                        WORKLOAD_METRICS_SOURCE.read_text(),
+                        services=["open-apiary"],
+                    ),
+                    ManagedFile(
+                        WEATHER_ROUTER,
+                        WEATHER_ROUTER_SOURCE.read_text(),
+                        services=["open-apiary"],
+                    ),
+                    ManagedFile(
+                        WARMUP,
+                        WARMUP_SOURCE.read_text(),
+                        services=["open-apiary"],
+                    ),
+                ]
+            )
+        return files
 
-        package_info = json.loads(container.pull("/opt/app/package.json").read())
-        self.unit.set_workload_version(package_info.get("version"))
+    def _update_readiness(self, container) -> None:
+        """Set unit status and peer readiness from the workload checks
 
-        self.ingress.update_config(
-            {"service-hostname": self.config["external-hostname"]}
-        )
-        self.unit.status = ActiveStatus()
+        Units which are not ready are reported to peers so that rolling
+        restarts do not take further units out of service, and hold on to
+        their restart slot until ready. Time spent not ready is counted for
+        the metrics endpoint.
+        """
+        self.unit.status = self._readiness_status(container)
+        now = time.time()
+        if self._stored.not_ready_since is not None:
+            self._count("not-ready-seconds", value=now - self._stored.not_ready_since)
+        ready = isinstance(self.unit.status, ActiveStatus)
+        self._stored.not_ready_since = None if ready else now
+
+    def _readiness_status(self, container) -> StatusBase:
+        """Unit status, reporting readiness to peers on the way"""
+        errors = self._ingress_config_errors(self._ingress_config())
+        if errors:
+            return BlockedStatus("Invalid ingress config: {}".format(errors[0]))
+        errors = self._sqlite_config_errors()
+        if errors:
+            return BlockedStatus("Invalid SQLite config: {}".format(errors[0]))
+        errors = self._log_config_errors()
+        if errors:
+            return BlockedStatus("Invalid log config: {}".format(errors[0]))
+        if not container.can_connect():
+            self.apiary.set_ready(False)
+            return WaitingStatus("Waiting for Pebble in workload container")
+        if self._mysql_required:
+            self.apiary.set_ready(False)
+            return BlockedStatus(
+                "Data was migrated to MySQL {}; relate to it to serve".format(self._migrated_to)
+            )
+        if self._sqlite_standby:
+            self.apiary.set_ready(False)
+            return BlockedStatus(
+                "SQLite supports a single unit; relate to mysql-database to scale out"
+            )
+        if self._stored.restart_pending:
+            if not self._restart_settled:
+                return WaitingStatus("Waiting for changes to settle before restarting")
+            return WaitingStatus("Waiting for restart slot")
+        ready = self._workload_ready(container)
+        self.apiary.set_ready(ready)
+        if not ready:
+            # Checked again on later hooks rather than waiting in this one
+            since_restart = time.time() - self._stored.restarted_at
+            if self._stored.awaiting_ready and since_restart > self.config["readiness-timeout"]:
+                return BlockedStatus(
+                    "Open Apiary not ready {}s after restart".format(int(since_restart))
+                )
+            return WaitingStatus("Waiting for Open Apiary to be ready")
+        if self._stored.awaiting_ready:
+            self._stored.awaiting_ready = False
+            self.apiary.release_restart()
+        if self._stored.reload_signal:
+            return ActiveStatus("Waiting for changes to settle before reloading")
+        if self._migration_pending:
+            return ActiveStatus("Run migrate-to-mysql to move data to MySQL")
+        if self.config["npm-start"] and self._stored.jwt_previous_token:
+            # Only the cluster wrapper accepts the previous secret
+            return ActiveStatus("Sessions signed before the JWT rotation need to log in again")
+        if self.unit.is_leader() and self._load_reports_enabled:
+            scaling = self.apiary.scaling
+            if scaling.get("recommendation") in ("up", "down"):
+                return ActiveStatus(
+                    "Load {}: scale to {} unit(s)".format(
+                        "high" if scaling["recommendation"] == "up" else "low",
+                        scaling["suggested-units"],
+                    )
+                )
+        return ActiveStatus()
+
+    def _workload_ready(self, container) -> bool:
+        """Whether the workload passes its readiness checks
+
+        Pebble reports checks as up until the failure threshold is reached,
+        so the web application is also probed directly.
+        """
+        checks = container.get_checks(level=CheckLevel.READY)
+        if any(check.status != CheckStatus.UP for check in checks.values()):
+            return False
+        return probe_http(self._readiness_url)
+
+    @property
+    def _readiness_url(self) -> str:
+        """URL used to check the web application is serving requests"""
+        return "http://localhost:{}/".format(APP_PORT)
 
     def _open_apiary_layer(self) -> dict:
         """Generate Pebble Layer for Open Apiary"""
+        environment = {
+            "PORT": str(APP_PORT),
+            "DATA_PATH": "/data",
+            "UPLOAD_PATH": "/uploads",
+            "LOG_DESTINATION": LOG_FILE,
+            "LOG_LEVEL": "debug" if self.config.get("debug") else "info",
+            "WEATHER_API_KEY": self.config.get("weather-api-token") or "",
+        }
+        if self.config["npm-start"]:
+            command = "/usr/local/bin/npm start"
+            if self.config["log-target"] == "stdout":
+                environment["LOG_DESTINATION"] = "/dev/stdout"
+        else:
+            # Invoke node directly, avoiding npm's wrapper process, with
+            # workers spread across the available CPUs
+            command = "/usr/local/bin/node {}".format(CLUSTER_WRAPPER)
+            if self.config["node-workers"]:
+                environment["APP_WORKERS"] = str(self.config["node-workers"])
+            # Workers log to stdout which the wrapper ships through a
+            # bounded buffer so slow log I/O does not hold up requests
+            environment.update(
+                {
+                    "LOG_DESTINATION": "/dev/stdout",
+                    "LOG_TARGET": self.config["log-target"],
+                    "LOG_FILE": LOG_FILE,
+                    "LOG_MAX_SIZE": str(self.config["log-max-size"] * 1024 * 1024),
+                    "LOG_ROTATE_INTERVAL": str(self.config["log-rotate-interval"] * 3600000),
+                    "LOG_BACKUPS": str(self.config["log-backups"]),
+                    "LOG_BUFFER_SIZE": str(self.config["log-buffer-size"] * 1024),
+                    "METRICS_PORT": str(WORKLOAD_METRICS_PORT),
+                }
+            )
+            if self._thumbnails_enabled:
+                environment["THUMBNAIL_URL"] = "http://localhost:{}".format(THUMBNAIL_PORT)
+                if self.config["thumbnail-redirect"]:
+                    environment["THUMBNAIL_REDIRECT"] = "1"
+            if self.config["warmup-routes"]:
+                environment.update(
+                    {
+                        "WARMUP_ROUTES": self.config["warmup-routes"],
+                        "WARMUP_CONCURRENCY": str(self.config["warmup-concurrency"]),
+                        "WARMUP_TIMEOUT": str(self.config["warmup-timeout"] * 1000),
+                    }
+                )
+                # Read into the page cache so early queries avoid the disk
+                if not self._mysql_in_use:
+                    environment["WARMUP_FILES"] = SQLITE_DATABASE
+            if self._shared_uploads_enabled:
+                environment["UPLOADS_URL"] = "http://localhost:{}".format(UPLOADS_PORT)
+            if self._weather_cache_enabled:
+                environment["WEATHER_HOST"] = WEATHER_API_HOST
+                environment["WEATHER_PROXY_URL"] = "http://localhost:{}".format(
+                    WEATHER_PROXY_PORT
+                )
+        if self.config["node-max-old-space-size"]:
+            environment["NODE_OPTIONS"] = "--max-old-space-size={}".format(
+                self.config["node-max-old-space-size"]
+            )
+        if self.config["uv-threadpool-size"]:
+            environment["UV_THREADPOOL_SIZE"] = str(self.config["uv-threadpool-size"])
         return {
             "summary": "Open Apiary layer",
             "description": "pebble config layer for Open Apiary",
@@ -135,34 +1653,112 @@ class OpenApiaryCharm(CharmBase):
                 "open-apiary": {
                     "override": "replace",
                     "summary": "open-apiary",
-                    "command": "/usr/local/bin/npm start",
+                    "command": command,
                     "startup": "enabled",
-                    "environment": {
-                        "PORT": "3000",
-                        "DATA_PATH": "/data",
-                        "UPLOAD_PATH": "/uploads",
-                        "LOG_DESTINATION": "/data/open-apiary.log",
-                        "LOG_LEVEL": "debug" if self.config.get("debug") else "info",
-                        "WEATHER_API_KEY": self.config.get("weather-api-token") or "",
-                        # NOTE(jamespage): ugly but works - maybe push needs
-                        # restart on change type integration to avoid this type of
-                        # thing.
-                        "CONFIG_CHECKSUM": checksum_dict(self._open_apiary_config()),
-                    },
+                    "environment": environment,
+                    "on-check-failure": {"open-apiary-alive": "restart"},
                 }
             },
+            "checks": {
+                "open-apiary-ready": {
+                    "override": "replace",
+                    "level": "ready",
+                    "period": "{}s".format(self.config["check-period"]),
+                    "threshold": self.config["check-threshold"],
+                    "http": {"url": self._readiness_url},
+                },
+                "open-apiary-alive": {
+                    "override": "replace",
+                    "level": "alive",
+                    "period": "{}s".format(self.config["check-period"]),
+                    "threshold": self.config["check-threshold"],
+                    "tcp": {"port": APP_PORT},
+                },
+            },
         }
 
+    def _mysql_pool_options(self) -> dict:
+        """MySQL driver connection pool options set in charm config"""
+        options = {
+            "connectionLimit": self.config["db-pool-size"],
+            "maxIdle": self.config["db-max-idle"],
+            "idleTimeout": self.config["db-idle-timeout"] * 1000,
+            "acquireTimeout": self.config["db-acquire-timeout"] * 1000,
+            "queueLimit": self.config["db-queue-limit"],
+        }
+        return {key: value for key, value in options.items() if value}
+
+    def _sqlite_config_errors(self) -> list:
+        """Reasons the SQLite options set in charm config are invalid"""
+        errors = []
+        if self.config["sqlite-journal-mode"] not in SQLITE_JOURNAL_MODES:
+            errors.append(
+                "sqlite-journal-mode must be one of {}".format(", ".join(SQLITE_JOURNAL_MODES))
+            )
+        if self.config["sqlite-synchronous"] not in SQLITE_SYNCHRONOUS_LEVELS:
+            errors.append(
+                "sqlite-synchronous must be one of {}".format(
+                    ", ".join(SQLITE_SYNCHRONOUS_LEVELS)
+                )
+            )
+        return errors
+
+    def _log_config_errors(self) -> list:
+        """Reasons the logging options set in charm config are invalid"""
+        errors = []
+        if self.config["log-target"] not in LOG_TARGETS:
+            errors.append("log-target must be one of {}".format(", ".join(LOG_TARGETS)))
+        for key in ("log-max-size", "log-backups", "log-buffer-size"):
+            if self.config[key] < 1:
+                errors.append("{} must be at least 1".format(key))
+        return errors
+
+    def _sqlite_pragmas(self) -> dict:
+        """SQLite pragmas set in charm config, omitting invalid options"""
+        pragmas = {"busy_timeout": self.config["sqlite-busy-timeout"] * 1000}
+        if self.config["sqlite-journal-mode"] in SQLITE_JOURNAL_MODES:
+            pragmas["journal_mode"] = self.config["sqlite-journal-mode"].upper()
+        if self.config["sqlite-synchronous"] in SQLITE_SYNCHRONOUS_LEVELS:
+            pragmas["synchronous"] = self.config["sqlite-synchronous"].upper()
+        if self.config["sqlite-cache-size"]:
+            # Negative cache sizes are in KiB rather than pages
+            pragmas["cache_size"] = -self.config["sqlite-cache-size"] * 1024
+        if self.config["sqlite-mmap-size"]:
+            pragmas["mmap_size"] = self.config["sqlite-mmap-size"] * 1024 * 1024
+        return pragmas
+
     def _open_apiary_config(self) -> dict:
         """Generate configuration for Open Apiary"""
-        db = {"type": "sqlite", "database": "/data/db.sql"}
-        if self._stored.mysql_connection:
+        db = {
+            "type": "sqlite",
+            "database": SQLITE_DATABASE,
+            "pragmas": self._sqlite_pragmas(),
+        }
+        if self._mysql_in_use:
             db = {"type": "mysql"}
             db.update(self._stored.mysql_connection)
+            pool = self._mysql_pool_options()
+            if pool:
+                db["extra"] = pool
+            if self._stored.mysql_replicas:
+                db["replication"] = {
+                    "master": dict(self._stored.mysql_connection),
+                    "slaves": [dict(r) for r in self._stored.mysql_replicas],
+                }
+                logging.info(
+                    "Configuring %d MySQL read replica(s)",
+                    len(self._stored.mysql_replicas),
+                )
             logging.info("Configuring connection to remote MySQL DB")
+        # Tokens signed with the previous secret remain valid during the
+        # overlap window following a rotation; the application only checks
+        # the current secret, so the cluster wrapper checks the previous one.
+        jwt = {"secret": self._stored.jwt_token}
+        if self._stored.jwt_previous_token:
+            jwt["previousSecrets"] = [self._stored.jwt_previous_token]
         return {
             "db": db,
-            "jwt": {"secret": self._stored.jwt_token},
+            "jwt": jwt,
         }
 
 
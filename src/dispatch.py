@@ -0,0 +1,62 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Fast path for events the open-apiary charm does not handle
+
+Importing ops, the charm libraries and the charm itself accounts for most
+of the time taken by a hook, so the charm checks the dispatched event
+against the events it observes before importing anything else and exits
+straight away for the rest.  The charm does not defer events, so there is
+never deferred work to re-emit when it does.
+"""
+
+import os
+import sys
+
+# Events observed by the charm and its libraries; tests keep this in step
+# with the observers registered when the charm is constructed.
+HANDLED_EVENTS = frozenset(
+    {
+        "apiary_relation_changed",
+        "apiary_relation_created",
+        "apiary_relation_departed",
+        "backup_action",
+        "config_changed",
+        "ingress_relation_changed",
+        "leader_elected",
+        "metrics_endpoint_relation_broken",
+        "metrics_endpoint_relation_joined",
+        "migrate_to_mysql_action",
+        "mysql_database_relation_broken",
+        "mysql_database_relation_changed",
+        "mysql_database_relation_departed",
+        "object_storage_relation_broken",
+        "object_storage_relation_changed",
+        "open_apiary_pebble_ready",
+        "profile_hooks_action",
+        "restore_action",
+        "rotate_jwt_secret_action",
+        "scaling_recommendation_action",
+        "sqlite_maintenance_action",
+        "thumbnails_ingress_relation_broken",
+        "thumbnails_ingress_relation_changed",
+        "thumbnails_ingress_relation_joined",
+        "tools_pebble_ready",
+        "update_status",
+    }
+)
+
+
+def dispatched_event() -> str:
+    """Kind of the event Juju is dispatching, as named by ops"""
+    path = os.environ.get("JUJU_DISPATCH_PATH") or sys.argv[0]
+    kind, _, name = path.rpartition("/")
+    name = name.replace("-", "_")
+    if kind.endswith("actions"):
+        return name + "_action"
+    return name
+
+
+def handled() -> bool:
+    """Whether the charm observes the dispatched event"""
+    return dispatched_event() in HANDLED_EVENTS
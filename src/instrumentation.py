@@ -0,0 +1,179 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Opt-in instrumentation of hook execution
+
+When enabled the charm wraps its Pebble client and relation calls with a
+HookProfiler, which records the wall time of each hook along with the
+count and duration of each operation. Records are appended to a rotating
+JSON lines file in the unit's state directory, which unlike the charm
+directory is kept across upgrades, and aggregated by the profile-hooks
+action.
+"""
+
+import functools
+import json
+import logging
+import math
+import os
+import pathlib
+import time
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = ".hook-profile.jsonl"
+PROFILE_MAX_BYTES = 1024 * 1024
+PROFILE_BACKUPS = 2
+
+PEBBLE_OPERATIONS = (
+    "add_layer",
+    "exec",
+    "get_checks",
+    "get_plan",
+    "get_services",
+    "list_files",
+    "pull",
+    "push",
+    "remove_path",
+    "send_signal",
+    "start_services",
+    "stop_services",
+)
+
+RELATION_OPERATIONS = (
+    "relation_get",
+    "relation_ids",
+    "relation_list",
+    "relation_set",
+)
+
+
+def profile_path(charm_dir) -> pathlib.Path:
+    """Profile file in the unit state directory alongside the charm directory"""
+    return pathlib.Path(charm_dir).parent / "state" / PROFILE_FILE
+
+
+def hook_name() -> str:
+    """Name of the hook or action being dispatched"""
+    dispatch_path = os.environ.get("JUJU_DISPATCH_PATH")
+    if dispatch_path:
+        return os.path.basename(dispatch_path)
+    return os.environ.get("JUJU_HOOK_NAME") or os.environ.get(
+        "JUJU_ACTION_NAME", "unknown"
+    )
+
+
+class HookProfiler:
+    """Time operations run during a hook and record them on completion"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.started = time.monotonic()
+        self.operations = {}
+
+    def wrap(self, obj, names, prefix: str) -> None:
+        """Replace methods of obj with timed equivalents"""
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is not None:
+                setattr(obj, name, self._timed("{}.{}".format(prefix, name), method))
+
+    def _timed(self, operation: str, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats = self.operations.setdefault(
+                    operation, {"count": 0, "duration": 0.0}
+                )
+                stats["count"] += 1
+                stats["duration"] += time.monotonic() - start
+
+        return wrapper
+
+    def record(self, hook: str = None, **extra) -> dict:
+        """Append the record for this hook to the profile file"""
+        record = {
+            "hook": hook or hook_name(),
+            "time": time.time(),
+            "duration": time.monotonic() - self.started,
+            "operations": self.operations,
+        }
+        record.update(extra)
+        try:
+            self._rotate()
+            with self.path.open("a") as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        except OSError as e:
+            logger.warning("Unable to write hook profile: %s", e)
+        return record
+
+    def _rotate(self) -> None:
+        """Rotate the profile file once it exceeds the maximum size"""
+        if not self.path.exists() or self.path.stat().st_size < PROFILE_MAX_BYTES:
+            return
+        for index in range(PROFILE_BACKUPS - 1, 0, -1):
+            backup = self.path.with_name("{}.{}".format(self.path.name, index))
+            if backup.exists():
+                backup.rename(self.path.with_name("{}.{}".format(self.path.name, index + 1)))
+        self.path.rename(self.path.with_name("{}.1".format(self.path.name)))
+
+
+def load_records(path) -> list:
+    """Load hook records from the profile file and its backups"""
+    path = pathlib.Path(path)
+    files = [
+        path.with_name("{}.{}".format(path.name, index))
+        for index in range(PROFILE_BACKUPS, 0, -1)
+    ]
+    records = []
+    for f in files + [path]:
+        if not f.exists():
+            continue
+        for line in f.read_text().splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.debug("Skipping malformed hook profile record")
+    return records
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def aggregate(records: list) -> dict:
+    """Aggregate hook records into per hook wall time and operation stats"""
+    hooks = {}
+    for record in records:
+        hook = hooks.setdefault(record["hook"], {"durations": [], "operations": {}})
+        hook["durations"].append(record["duration"])
+        for name, stats in record.get("operations", {}).items():
+            op = hook["operations"].setdefault(name, {"count": 0, "durations": []})
+            op["count"] += stats["count"]
+            op["durations"].append(stats["duration"])
+
+    summary = {}
+    for name, hook in hooks.items():
+        runs = len(hook["durations"])
+        summary[name] = {
+            "count": runs,
+            "p50": round(percentile(hook["durations"], 50), 6),
+            "p95": round(percentile(hook["durations"], 95), 6),
+            "operations": {
+                op_name: {
+                    "calls-per-hook": round(op["count"] / runs, 2),
+                    "p50": round(percentile(op["durations"], 50), 6),
+                    "p95": round(percentile(op["durations"], 95), 6),
+                }
+                for op_name, op in hook["operations"].items()
+            },
+        }
+    return summary
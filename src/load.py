@@ -0,0 +1,83 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Load summaries of the Open Apiary workload
+
+The charm samples the metrics served by the cluster wrapper and reports
+the change since its previous sample to peers: requests per second, p95
+request latency and event loop lag in milliseconds, and CPU use as a
+percentage of the CPUs available to the workload.
+"""
+
+import logging
+import time
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = "open_apiary_http_requests_total"
+BUCKET = "open_apiary_http_request_duration_seconds_bucket"
+
+
+def parse_metrics(text: str) -> dict:
+    """Samples in Prometheus text format keyed by name and labels"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        try:
+            samples[name] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+def fetch_sample(url: str, timeout: float = 2.0) -> dict:
+    """Sample the workload metrics, or None if they are not being served"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            metrics = parse_metrics(response.read().decode())
+    except (urllib.error.URLError, OSError) as e:
+        logger.debug("Unable to sample workload metrics: %s", e)
+        return None
+    buckets = []
+    for name, count in metrics.items():
+        if name.startswith(BUCKET + '{le="') and "+Inf" not in name:
+            buckets.append([float(name[len(BUCKET) + 5:-2]), count])
+    return {
+        "at": time.time(),
+        "requests": sum(v for k, v in metrics.items() if k.startswith(REQUESTS)),
+        "buckets": sorted(buckets),
+        "cpu": metrics.get("open_apiary_cpu_seconds_total", 0.0),
+        "cpus": metrics.get("open_apiary_cpus", 1.0) or 1.0,
+        "lag": metrics.get("open_apiary_event_loop_lag_seconds", 0.0),
+    }
+
+
+def load_report(previous: dict, current: dict) -> dict:
+    """Load over the interval between two samples
+
+    Returns None when the counters went backwards as the workload was
+    restarted between the samples.
+    """
+    elapsed = current["at"] - previous["at"]
+    requests = current["requests"] - previous["requests"]
+    if elapsed <= 0 or requests < 0 or current["cpu"] < previous["cpu"]:
+        return None
+    # Upper bound of the bucket holding the 95th percentile request
+    p95 = 0.0
+    if requests:
+        earlier = dict((bound, count) for bound, count in previous["buckets"])
+        p95 = current["buckets"][-1][0] if current["buckets"] else 0.0
+        for bound, count in current["buckets"]:
+            if count - earlier.get(bound, 0) >= 0.95 * requests:
+                p95 = bound
+                break
+    return {
+        "rps": round(requests / elapsed, 2),
+        "p95": round(p95 * 1000, 1),
+        "cpu": round(100 * (current["cpu"] - previous["cpu"]) / elapsed / current["cpus"], 1),
+        "lag": round(current["lag"] * 1000, 1),
+    }
@@ -0,0 +1,78 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Files rendered by the charm into workload containers
+
+Each managed file is tracked by the checksum of its content in the
+reconcile snapshot. The remote copy is only pulled when no checksum is
+cached (first install or a replaced container) and files are only pushed
+when their content differs. Pebble writes pushed files to a temporary
+file which is renamed into place, so readers never see partial content.
+
+Services depending on a changed file are reported back to the charm so
+that only those services are restarted, or signalled to reload where
+they support it.
+"""
+
+import logging
+
+from ops.pebble import PathError
+
+logger = logging.getLogger(__name__)
+
+
+class ManagedFile:
+    """A file rendered into a workload container by the charm"""
+
+    def __init__(self, path: str, content: str, services=(), reload_signal: str = None):
+        self.path = path
+        self.content = content
+        self.services = tuple(services)
+        self.reload_signal = reload_signal
+
+    @property
+    def key(self) -> str:
+        """Reconcile snapshot key for this file"""
+        return "file:{}".format(self.path)
+
+
+def _remote_matches(container, managed_file: ManagedFile) -> bool:
+    """Whether the file in the container already has the desired content"""
+    try:
+        return container.pull(managed_file.path).read() == managed_file.content
+    except (PathError, FileNotFoundError):
+        return False
+
+
+def sync_files(container, reconciler, files) -> tuple:
+    """Push changed files, returning the services to restart and reload
+
+    Returns a set of service names to restart and a mapping of service
+    name to the signal which reloads it.
+    """
+    restart = set()
+    reload = {}
+    for managed_file in files:
+        if not reconciler.changed(managed_file.key, managed_file.content):
+            reconciler.skip("push:{}".format(managed_file.path))
+            continue
+        if managed_file.key not in reconciler.snapshot:
+            # No cached checksum so check the copy in the container
+            reconciler.ran("pull:{}".format(managed_file.path))
+            if _remote_matches(container, managed_file):
+                reconciler.skip("push:{}".format(managed_file.path))
+                reconciler.record(managed_file.key, managed_file.content)
+                continue
+        container.push(managed_file.path, managed_file.content, make_dirs=True)
+        reconciler.ran("push:{}".format(managed_file.path))
+        reconciler.record(managed_file.key, managed_file.content)
+        logger.info("Updated %s", managed_file.path)
+        for service in managed_file.services:
+            if managed_file.reload_signal:
+                reload[service] = managed_file.reload_signal
+            else:
+                restart.add(service)
+    # A restart also picks up changes to files supporting reload
+    for service in restart:
+        reload.pop(service, None)
+    return restart, reload
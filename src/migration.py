@@ -0,0 +1,439 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Streamed copy of the Open Apiary database from SQLite to MySQL
+
+Tables are read from SQLite in chunks ordered by rowid so that memory use
+is bounded by the chunk size, and written to the target in batched
+multi-row INSERT statements. The last rowid copied for each table is
+written to the target in the same transaction as the rows, so an
+interrupted migration resumes where it stopped without duplicating rows.
+
+Each table is created in the target with its primary key, NOT NULL
+constraints, defaults, indexes and foreign keys, and INTEGER primary keys
+which alias the SQLite rowid become auto-incrementing so that the
+application can keep inserting rows once it has switched over. Tables
+already holding rows which were not copied by a migration are refused
+rather than reused.
+"""
+
+import abc
+import collections
+import logging
+import re
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Table in the target database tracking migration progress
+PROGRESS_TABLE = "charm_migration"
+
+# primary_key is the position of the column in the primary key, or 0
+Column = collections.namedtuple(
+    "Column",
+    ["name", "type", "primary_key", "not_null", "default", "auto_increment"],
+    defaults=(False, None, False),
+)
+Index = collections.namedtuple("Index", ["name", "columns", "unique"])
+ForeignKey = collections.namedtuple(
+    "ForeignKey", ["columns", "table", "references", "on_update", "on_delete"]
+)
+
+
+class MigrationError(Exception):
+    """The source database cannot be migrated to the target"""
+
+
+class Database(abc.ABC):
+    """DB-API connection with the SQL needed to migrate between databases"""
+
+    placeholder = "%s"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @staticmethod
+    def quote(name: str) -> str:
+        """Quote an identifier; backticks are understood by MySQL and SQLite"""
+        return "`{}`".format(name.replace("`", "``"))
+
+    def execute(self, sql: str, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def column_type(self, column: Column) -> str:
+        """Column type in this database for a column declared in SQLite"""
+        return column.type or "TEXT"
+
+    def column_definition(self, column: Column) -> str:
+        """Column type, constraints and default for a column declared in SQLite"""
+        definition = "{} {}".format(self.quote(column.name), self.column_type(column))
+        if column.not_null:
+            definition += " NOT NULL"
+        if column.default is not None:
+            # SQLite reports default expressions without their parentheses
+            definition += " DEFAULT ({})".format(column.default)
+        return definition
+
+    def index_column(self, column: Column) -> str:
+        return self.quote(column.name)
+
+    def foreign_key_action(self, action: str) -> str:
+        return action
+
+    @abc.abstractmethod
+    def table_exists(self, table: str) -> bool:
+        """Whether table exists in this database"""
+
+    def create_table(
+        self,
+        table: str,
+        columns: list,
+        indexes: list = (),
+        foreign_keys: list = (),
+        if_not_exists: bool = False,
+    ) -> None:
+        """Create table with the provided columns, indexes and foreign keys"""
+        definitions = [self.column_definition(c) for c in columns]
+        keys = sorted((c for c in columns if c.primary_key), key=lambda c: c.primary_key)
+        if keys:
+            definitions.append(
+                "PRIMARY KEY ({})".format(", ".join(self.quote(c.name) for c in keys))
+            )
+        for foreign_key in foreign_keys:
+            definitions.append(
+                "FOREIGN KEY ({}) REFERENCES {} ({}) ON UPDATE {} ON DELETE {}".format(
+                    ", ".join(self.quote(c) for c in foreign_key.columns),
+                    self.quote(foreign_key.table),
+                    ", ".join(self.quote(c) for c in foreign_key.references),
+                    self.foreign_key_action(foreign_key.on_update),
+                    self.foreign_key_action(foreign_key.on_delete),
+                )
+            )
+        self.execute(
+            "CREATE TABLE {}{} ({})".format(
+                "IF NOT EXISTS " if if_not_exists else "",
+                self.quote(table),
+                ", ".join(definitions),
+            )
+        )
+        by_name = {c.name: c for c in columns}
+        for index in indexes:
+            self.execute(
+                "CREATE {}INDEX {} ON {} ({})".format(
+                    "UNIQUE " if index.unique else "",
+                    self.quote(index.name),
+                    self.quote(table),
+                    ", ".join(self.index_column(by_name[c]) for c in index.columns),
+                )
+            )
+
+    def insert(self, table: str, columns: list, rows: list) -> None:
+        """Insert rows in a single multi-row INSERT statement"""
+        values = "({})".format(", ".join([self.placeholder] * len(columns)))
+        self.execute(
+            "INSERT INTO {} ({}) VALUES {}".format(
+                self.quote(table),
+                ", ".join(self.quote(c) for c in columns),
+                ", ".join([values] * len(rows)),
+            ),
+            [value for row in rows for value in row],
+        )
+
+    def count(self, table: str) -> int:
+        return self.execute("SELECT COUNT(*) FROM {}".format(self.quote(table))).fetchone()[0]
+
+    def progress(self, table: str) -> int:
+        """Last rowid copied for table, or 0 if not yet started"""
+        self.create_table(
+            PROGRESS_TABLE,
+            [
+                Column("table_name", "VARCHAR(255)", 1, True),
+                Column("last_rowid", "BIGINT", 0),
+            ],
+            if_not_exists=True,
+        )
+        row = self.execute(
+            "SELECT last_rowid FROM {} WHERE table_name = {}".format(
+                self.quote(PROGRESS_TABLE), self.placeholder
+            ),
+            (table,),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_progress(self, table: str, last_rowid: int) -> None:
+        self.execute(
+            "DELETE FROM {} WHERE table_name = {}".format(
+                self.quote(PROGRESS_TABLE), self.placeholder
+            ),
+            (table,),
+        )
+        self.insert(PROGRESS_TABLE, ["table_name", "last_rowid"], [(table, last_rowid)])
+
+
+class SQLiteDatabase(Database):
+    """SQLite database, the source of a migration"""
+
+    placeholder = "?"
+
+    @classmethod
+    def open(cls, path) -> "SQLiteDatabase":
+        return cls(sqlite3.connect(str(path)))
+
+    def tables(self) -> list:
+        """Application tables in creation order"""
+        cursor = self.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' AND name != ? ORDER BY rowid",
+            (PROGRESS_TABLE,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def has_rows(self) -> bool:
+        """Whether any application table holds rows"""
+        return any(
+            self.execute("SELECT 1 FROM {} LIMIT 1".format(self.quote(table))).fetchone()
+            for table in self.tables()
+        )
+
+    def table_exists(self, table: str) -> bool:
+        cursor = self.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        )
+        return cursor.fetchone() is not None
+
+    def columns(self, table: str) -> list:
+        cursor = self.execute("PRAGMA table_info({})".format(self.quote(table)))
+        rows = cursor.fetchall()
+        keys = [row for row in rows if row[5]]
+        # A sole INTEGER primary key is an alias for the rowid, which SQLite
+        # assigns to inserted rows
+        rowid_alias = len(keys) == 1 and (keys[0][2] or "").upper() == "INTEGER"
+        return [
+            Column(
+                name=row[1],
+                type=row[2],
+                primary_key=row[5],
+                # Primary keys are implicitly NOT NULL in MySQL
+                not_null=bool(row[3]) or bool(row[5]),
+                default=row[4],
+                auto_increment=rowid_alias and bool(row[5]),
+            )
+            for row in rows
+        ]
+
+    def indexes(self, table: str) -> list:
+        """Indexes and unique constraints other than the primary key"""
+        indexes = []
+        cursor = self.execute("PRAGMA index_list({})".format(self.quote(table)))
+        for _, name, unique, origin, partial in cursor.fetchall():
+            if origin == "pk":
+                continue
+            columns = [
+                row[2]
+                for row in self.execute(
+                    "PRAGMA index_info({})".format(self.quote(name))
+                ).fetchall()
+            ]
+            if partial or None in columns:
+                logger.warning("Skipping partial or expression index %s", name)
+                continue
+            if name.startswith("sqlite_autoindex_"):
+                name = "{}_{}_unique".format(table, "_".join(columns))
+            indexes.append(Index(name, columns, bool(unique)))
+        return indexes
+
+    def foreign_keys(self, table: str) -> list:
+        keys = collections.OrderedDict()
+        cursor = self.execute("PRAGMA foreign_key_list({})".format(self.quote(table)))
+        for key_id, _, parent, column, reference, on_update, on_delete, _ in sorted(
+            cursor.fetchall()
+        ):
+            key = keys.setdefault(key_id, ForeignKey([], parent, [], on_update, on_delete))
+            key.columns.append(column)
+            key.references.append(reference)
+        foreign_keys = []
+        for key in keys.values():
+            if None in key.references:
+                # References the primary key of the parent table
+                parent = sorted(
+                    (c for c in self.columns(key.table) if c.primary_key),
+                    key=lambda c: c.primary_key,
+                )
+                key = key._replace(references=[c.name for c in parent])
+            foreign_keys.append(key)
+        return foreign_keys
+
+    def chunks(self, table: str, columns: list, after: int, size: int):
+        """Yield lists of (rowid, row) ordered by rowid, size rows at a time"""
+        sql = "SELECT rowid, {} FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?".format(
+            ", ".join(self.quote(c) for c in columns), self.quote(table)
+        )
+        while True:
+            rows = self.execute(sql, (after, size)).fetchall()
+            if not rows:
+                return
+            yield [(row[0], row[1:]) for row in rows]
+            after = rows[-1][0]
+
+
+class MySQLDatabase(Database):
+    """MySQL database, the target of a migration"""
+
+    # SQLite type affinities mapped to MySQL types
+    TYPES = (
+        ("INT", "BIGINT"),
+        ("CHAR", "LONGTEXT"),
+        ("CLOB", "LONGTEXT"),
+        ("TEXT", "LONGTEXT"),
+        ("BLOB", "LONGBLOB"),
+        ("REAL", "DOUBLE"),
+        ("FLOA", "DOUBLE"),
+        ("DOUB", "DOUBLE"),
+    )
+    # Types which MySQL only indexes by prefix and gives expression defaults
+    UNBOUNDED = ("LONGTEXT", "LONGBLOB")
+    # SQLite defaults for the time of insert
+    NOW = ("CURRENT_TIMESTAMP", "DATETIME('NOW')")
+
+    @classmethod
+    def connect(cls, host: str, port: int, user: str, password: str, database: str):
+        # Only needed by the migration action so imported on demand
+        import pymysql
+
+        return cls(
+            pymysql.connect(
+                host=host,
+                port=int(port),
+                user=user,
+                password=password,
+                database=database,
+                charset="utf8mb4",
+                # Tables are copied in creation order rather than by the
+                # foreign keys between them
+                init_command="SET FOREIGN_KEY_CHECKS = 0",
+            )
+        )
+
+    def table_exists(self, table: str) -> bool:
+        cursor = self.execute(
+            "SELECT 1 FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s",
+            (table,),
+        )
+        return cursor.fetchone() is not None
+
+    def column_type(self, column: Column) -> str:
+        declared = (column.type or "").upper()
+        if declared.startswith("VARCHAR("):
+            return declared
+        if declared == "VARCHAR":
+            # The length the application's ORM declares on MySQL
+            return "VARCHAR(255)"
+        if declared in ("BOOLEAN", "DATE", "DATETIME"):
+            return declared
+        for affinity, mysql_type in self.TYPES:
+            if affinity in declared:
+                # MySQL can only index text columns of a bounded length
+                if column.primary_key and mysql_type == "LONGTEXT":
+                    return "VARCHAR(255)"
+                return mysql_type
+        return "DOUBLE" if declared else "LONGBLOB"
+
+    def column_definition(self, column: Column) -> str:
+        column_type = self.column_type(column)
+        definition = "{} {}".format(self.quote(column.name), column_type)
+        if column.not_null:
+            definition += " NOT NULL"
+        if column.auto_increment:
+            return definition + " AUTO_INCREMENT"
+        default = self.default(column, column_type)
+        if default is not None:
+            definition += " DEFAULT {}".format(default)
+        return definition
+
+    def default(self, column: Column, column_type: str) -> str:
+        """MySQL default for the default of a column declared in SQLite"""
+        if column.default is None:
+            return None
+        default = column.default.strip()
+        while default.startswith("(") and default.endswith(")"):
+            default = default[1:-1].strip()
+        if default.upper() == "NULL":
+            return None
+        if default.upper().replace(" ", "") in self.NOW:
+            if column_type in ("DATETIME", "TIMESTAMP"):
+                return "CURRENT_TIMESTAMP"
+        elif re.fullmatch(r"[-+]?\d+(\.\d+)?|'([^']|'')*'", default):
+            # Unbounded types only take defaults given as expressions
+            return "({})".format(default) if column_type in self.UNBOUNDED else default
+        logger.warning(
+            "Dropping default %s of column %s unsupported by MySQL", column.default, column.name
+        )
+        return None
+
+    def index_column(self, column: Column) -> str:
+        if self.column_type(column) in self.UNBOUNDED:
+            return "{}(255)".format(self.quote(column.name))
+        return self.quote(column.name)
+
+    def foreign_key_action(self, action: str) -> str:
+        # Rejected by InnoDB
+        return "NO ACTION" if action.upper() == "SET DEFAULT" else action
+
+
+def migrate(source, target, chunk_size: int = 1000, batch_size: int = 500, progress=None):
+    """Copy every table from source to target, resuming any earlier run
+
+    progress is called after each chunk with the table name, rows copied
+    and total rows for the table, and the overall rows per second.
+    Returns the number of rows copied and the elapsed time in seconds.
+    """
+    copied = 0
+    start = time.monotonic()
+    for table in source.tables():
+        columns = source.columns(table)
+        names = [c.name for c in columns]
+        after = target.progress(table)
+        if not target.table_exists(table):
+            target.create_table(
+                table, columns, source.indexes(table), source.foreign_keys(table)
+            )
+        elif not after and target.count(table):
+            raise MigrationError(
+                "Table {} already holds rows not copied by a migration".format(table)
+            )
+        total = source.count(table)
+        done = target.count(table)
+        for chunk in source.chunks(table, names, after, chunk_size):
+            rows = [row for _, row in chunk]
+            for index in range(0, len(rows), batch_size):
+                target.insert(table, names, rows[index:index + batch_size])
+            target.set_progress(table, chunk[-1][0])
+            target.commit()
+            copied += len(chunk)
+            done += len(chunk)
+            if progress:
+                elapsed = time.monotonic() - start
+                progress(table, done, total, copied / elapsed if elapsed else 0.0)
+        logger.info("Migrated table %s (%d rows)", table, total)
+    return copied, time.monotonic() - start
+
+
+def verify(source, target) -> list:
+    """Tables whose row counts differ between source and target"""
+    mismatches = []
+    for table in source.tables():
+        expected = source.count(table)
+        actual = target.count(table)
+        if expected != actual:
+            mismatches.append((table, expected, actual))
+    return mismatches
@@ -0,0 +1,66 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Single-pass reconciliation of workload state
+
+The charm computes the desired state of the workload once per hook and
+checks each component against a snapshot of the state it last applied,
+only issuing Pebble or relation operations for components which differ.
+"""
+
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def checksum_dict(data) -> str:
+    """Stable SHA256 checksum of JSON serialisable data"""
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, indent=2).encode()
+    ).hexdigest()
+
+
+class Reconciler:
+    """Track applied state and the operations run or skipped in a hook
+
+    The snapshot is a mapping of component key to checksum of the last
+    applied value; the charm persists it in StoredState so that it
+    survives between hook executions.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.applied = []
+        self.skipped = []
+
+    def changed(self, key: str, desired) -> bool:
+        """Whether the desired value differs from the last applied value"""
+        return self.snapshot.get(key) != checksum_dict(desired)
+
+    def record(self, key: str, desired) -> None:
+        """Record the desired value as applied"""
+        self.snapshot[key] = checksum_dict(desired)
+
+    def ran(self, *operations: str) -> None:
+        """Note operations which were executed"""
+        self.applied.extend(operations)
+
+    def skip(self, *operations: str) -> None:
+        """Note operations which were not required"""
+        self.skipped.extend(operations)
+
+    def invalidate(self) -> None:
+        """Forget all applied state, forcing a full reconcile"""
+        for key in list(self.snapshot.keys()):
+            del self.snapshot[key]
+
+    def report(self) -> None:
+        """Log a summary of the operations for this reconcile"""
+        logger.info(
+            "Reconcile complete: %d operation(s) applied, %d skipped (%s)",
+            len(self.applied),
+            len(self.skipped),
+            ", ".join(self.skipped) or "none",
+        )
@@ -0,0 +1,163 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Minimal client for S3-compatible object storage
+
+Only the handful of operations the charm needs are supported, using path
+style addressing and AWS Signature Version 4, so that it works against
+Ceph RGW, MinIO and other S3-compatible stores as well as AWS S3 without
+any dependencies beyond the standard library.
+"""
+
+import datetime
+import hashlib
+import hmac
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+class S3Error(Exception):
+    """Request to the object store failed"""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+class S3Client:
+    """Objects in a single bucket of an S3-compatible store"""
+
+    def __init__(
+        self,
+        endpoint: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+        timeout: float = 30,
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+
+    def _signing_key(self, date: str) -> bytes:
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (date, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        return key
+
+    def _headers(self, method: str, path: str, query: str, body: bytes, now=None) -> dict:
+        """Headers for a request signed with AWS Signature Version 4"""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        timestamp = now.strftime("%Y%m%dT%H%M%SZ")
+        date = timestamp[:8]
+        host = urllib.parse.urlsplit(self.endpoint).netloc
+        headers = {
+            "host": host,
+            "x-amz-content-sha256": hashlib.sha256(body).hexdigest(),
+            "x-amz-date": timestamp,
+        }
+        signed = ";".join(sorted(headers))
+        canonical = "\n".join(
+            [
+                method,
+                path,
+                query,
+                "".join("{}:{}\n".format(name, headers[name]) for name in sorted(headers)),
+                signed,
+                headers["x-amz-content-sha256"],
+            ]
+        )
+        scope = "{}/{}/s3/aws4_request".format(date, self.region)
+        to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                timestamp,
+                scope,
+                hashlib.sha256(canonical.encode()).hexdigest(),
+            ]
+        )
+        signature = hmac.new(self._signing_key(date), to_sign.encode(), hashlib.sha256)
+        headers["Authorization"] = (
+            "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+                self.access_key, scope, signed, signature.hexdigest()
+            )
+        )
+        del headers["host"]
+        return headers
+
+    def request(self, method: str, key: str = "", params: dict = None, body: bytes = b""):
+        """Make a signed request, returning the HTTP response
+
+        Raises S3Error if the store cannot be reached or responds with an
+        error status.
+        """
+        path = urllib.parse.quote("/{}/{}".format(self.bucket, key), safe="/-_.~")
+        query = urllib.parse.urlencode(
+            sorted((params or {}).items()), quote_via=urllib.parse.quote
+        )
+        request = urllib.request.Request(
+            self.endpoint + path + ("?" + query if query else ""),
+            data=body if method == "PUT" else None,
+            method=method,
+            headers=self._headers(method, path, query, body),
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            with e:
+                raise S3Error("{} {}: {}".format(method, key, e.reason), e.code)
+        except (urllib.error.URLError, OSError) as e:
+            raise S3Error("{} {}: {}".format(method, key, e))
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.request("HEAD", key).close()
+        except S3Error as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def get(self, key: str) -> bytes:
+        return self.get_object(key)[0]
+
+    def get_object(self, key: str) -> tuple:
+        """Content and ETag of an object"""
+        with self.request("GET", key) as response:
+            return response.read(), response.headers.get("ETag")
+
+    def put(self, key: str, data: bytes) -> str:
+        """Write an object, returning its ETag"""
+        with self.request("PUT", key, body=data) as response:
+            return response.headers.get("ETag")
+
+    def delete(self, key: str) -> None:
+        self.request("DELETE", key).close()
+
+    def list(self, prefix: str = "") -> list:
+        """Keys starting with prefix, following continuation tokens"""
+        return [key for key in self.etags(prefix)]
+
+    def etags(self, prefix: str = "") -> dict:
+        """ETag of each object with a key starting with prefix"""
+        etags = {}
+        params = {"list-type": "2", "prefix": prefix}
+        while True:
+            with self.request("GET", params=params) as response:
+                root = ElementTree.fromstring(response.read())
+            for contents in root.iter(S3_NAMESPACE + "Contents"):
+                etags[contents.findtext(S3_NAMESPACE + "Key")] = contents.findtext(
+                    S3_NAMESPACE + "ETag"
+                )
+            token = root.findtext(S3_NAMESPACE + "NextContinuationToken")
+            if not token:
+                return etags
+            params["continuation-token"] = token
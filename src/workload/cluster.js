@@ -0,0 +1,490 @@
+// Copyright 2021 James Page
+// See LICENSE file for licensing details.
+//
+// Cluster wrapper for Open Apiary, pushed into the workload container by
+// the open-apiary charm.
+//
+// Forks APP_WORKERS workers (defaulting to the number of CPUs available to
+// the container) which each load the Open Apiary application from APP_ROOT;
+// the workers share the listening port.
+//
+// On SIGHUP the workers are replaced one at a time, each new worker
+// listening before the old one is stopped, so that configuration changes
+// are picked up without the unit dropping requests.
+//
+// When THUMBNAIL_URL is set, the thumbnail service there serves
+// /thumbnails/, normally straight from the ingress; requests for it which
+// reach the workers are passed on to it. With THUMBNAIL_REDIRECT set,
+// workers also redirect requests for photos under /uploads/ which a page
+// embeds as images to /thumbnails/, so the application's own pages show
+// thumbnails while photos opened directly stay full size.
+//
+// When LOG_TARGET is set, worker output is read by the wrapper and shipped
+// through a bounded buffer either to LOG_FILE, rotated and compressed, or
+// to the wrapper's own stdout.
+//
+// When METRICS_PORT is set, workers report request, event loop and memory
+// metrics to the wrapper, which serves them for Prometheus on localhost.
+//
+// When WEATHER_PROXY_URL is set, workers send the application's requests
+// for the weather API at WEATHER_HOST to the caching proxy at that URL.
+//
+// When UPLOADS_URL is set, uploads are shared between units through object
+// storage: workers pass requests under /uploads/ for files missing from
+// UPLOAD_PATH to the uploads service at that URL, which fetches them from
+// the bucket, and ask it to copy new uploads to the bucket after each
+// successful write request.
+//
+// When config.json configures a SQLite database with db.pragmas, workers
+// run the pragmas on each connection the application opens, as the
+// application does not set them itself.
+//
+// When config.json lists jwt.previousSecrets, which the charm does for the
+// overlap window after rotating the JWT secret, workers wrap the verify
+// function of the jsonwebtoken module the application checks its tokens
+// with, so tokens signed with a previous secret are accepted wherever the
+// application reads them from and sessions survive the rotation.
+//
+// When WARMUP_ROUTES is set, the wrapper reads WARMUP_FILES into the page
+// cache before starting the workers, and each worker, including those
+// replacing workers on reload or after a crash, only shares the listening
+// port once it has requested each route WARMUP_CONCURRENCY times over a
+// private loopback listener, giving up after WARMUP_TIMEOUT ms.
+
+"use strict";
+
+const cluster = require("cluster");
+const fs = require("fs");
+const http = require("http");
+const Module = require("module");
+const os = require("os");
+const path = require("path");
+
+const APP_ROOT = process.env.APP_ROOT || "/opt/app";
+
+// Workers exiting sooner than this after being forked are restarted with
+// a delay to avoid a tight crash loop.
+const MIN_UPTIME_MS = 1000;
+
+// Workers replaced on reload are stopped if they have not finished their
+// in-flight requests within this time.
+const RETIRE_TIMEOUT_MS = 30000;
+
+// Interval at which workers report their metrics to the wrapper
+const METRICS_INTERVAL_MS = 5000;
+
+// Time after which warm-up is abandoned unless WARMUP_TIMEOUT is set
+const WARMUP_TIMEOUT_MS = 20000;
+
+const THUMBNAIL_ROUTE = "/thumbnails/";
+const UPLOADS_ROUTE = "/uploads/";
+
+// Writes within this time of one another are copied to the bucket together
+const UPLOADS_SYNC_DELAY_MS = 500;
+// Photos which the thumbnail service makes thumbnails of
+const THUMBNAIL_SUFFIXES = [".gif", ".jpeg", ".jpg", ".png", ".webp"];
+// Redirects to thumbnails depend on how the photo is requested
+const THUMBNAIL_REDIRECT_HEADERS = {
+  "Cache-Control": "public, max-age=86400",
+  Vary: "Sec-Fetch-Dest",
+};
+
+function warmupTimeout() {
+  return Number(process.env.WARMUP_TIMEOUT) || WARMUP_TIMEOUT_MS;
+}
+
+function availableCpus() {
+  // Honour the container CPU quota (cgroup v2 then v1) over host CPUs
+  try {
+    const [quota, period] = fs
+      .readFileSync("/sys/fs/cgroup/cpu.max", "utf8")
+      .trim()
+      .split(" ");
+    if (quota !== "max") {
+      return Math.max(1, Math.ceil(Number(quota) / Number(period)));
+    }
+  } catch (e) {}
+  try {
+    const quota = Number(
+      fs.readFileSync("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "utf8")
+    );
+    const period = Number(
+      fs.readFileSync("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "utf8")
+    );
+    if (quota > 0 && period > 0) {
+      return Math.max(1, Math.ceil(quota / period));
+    }
+  } catch (e) {}
+  return os.cpus().length || 1;
+}
+
+function proxyRequest(req, res, upstream) {
+  http
+    .get(upstream + req.url, (response) => {
+      res.writeHead(response.statusCode, response.headers);
+      response.pipe(res);
+    })
+    .on("error", () => {
+      res.writeHead(502);
+      res.end();
+    });
+}
+
+function routeThumbnails(upstream, redirect) {
+  const emit = http.Server.prototype.emit;
+  http.Server.prototype.emit = function (event, req, res) {
+    if (event !== "request" || (req.method !== "GET" && req.method !== "HEAD")) {
+      return emit.apply(this, arguments);
+    }
+    if (req.url.startsWith(THUMBNAIL_ROUTE)) {
+      proxyRequest(req, res, upstream);
+      return true;
+    }
+    // Sent by browsers loading an image embedded in a page
+    const pathname = req.url.split("?")[0];
+    if (
+      redirect &&
+      req.headers["sec-fetch-dest"] === "image" &&
+      pathname.startsWith(UPLOADS_ROUTE) &&
+      THUMBNAIL_SUFFIXES.includes(path.extname(pathname).toLowerCase())
+    ) {
+      const location = THUMBNAIL_ROUTE + req.url.slice(UPLOADS_ROUTE.length);
+      res.writeHead(302, Object.assign({ Location: location }, THUMBNAIL_REDIRECT_HEADERS));
+      res.end();
+      return true;
+    }
+    return emit.apply(this, arguments);
+  };
+}
+
+function routeUploads(root, upstream) {
+  root = path.resolve(root);
+  let syncing = null;
+  const sync = () => {
+    if (!syncing) {
+      syncing = setTimeout(() => {
+        syncing = null;
+        http
+          .request(upstream + "/sync", { method: "POST" })
+          .on("error", () => {})
+          .end();
+      }, UPLOADS_SYNC_DELAY_MS);
+    }
+  };
+  const emit = http.Server.prototype.emit;
+  http.Server.prototype.emit = function (event, req, res) {
+    if (event !== "request") {
+      return emit.apply(this, arguments);
+    }
+    if (req.method !== "GET" && req.method !== "HEAD") {
+      res.on("finish", () => {
+        if (res.statusCode < 400) {
+          sync();
+        }
+      });
+      return emit.apply(this, arguments);
+    }
+    if (!req.url.startsWith(UPLOADS_ROUTE)) {
+      return emit.apply(this, arguments);
+    }
+    let name;
+    try {
+      name = decodeURIComponent(req.url.split("?")[0].slice(UPLOADS_ROUTE.length));
+    } catch (e) {
+      name = "";
+    }
+    const file = path.join(root, name);
+    if (!file.startsWith(root + path.sep)) {
+      return emit.apply(this, arguments);
+    }
+    fs.stat(file, (err, stat) => {
+      if (err || !stat.isFile()) {
+        // Uploaded to another unit or evicted from this unit's cache
+        proxyRequest(req, res, upstream);
+      } else {
+        emit.call(this, event, req, res);
+      }
+    });
+    return true;
+  };
+}
+
+function acceptPreviousSecrets(secret, previous) {
+  const signatureError = (e) =>
+    e && e.name === "JsonWebTokenError" && e.message === "invalid signature";
+  const patched = new WeakSet();
+  const load = Module._load;
+  // Wrapped as the application loads it, before any module copies verify
+  Module._load = function (request) {
+    const jwt = load.apply(this, arguments);
+    if (request !== "jsonwebtoken" || patched.has(jwt)) {
+      return jwt;
+    }
+    patched.add(jwt);
+    const verify = jwt.verify;
+    const verifyPrevious = (token, options, error) => {
+      for (const key of previous) {
+        try {
+          return verify.call(jwt, token, key, options);
+        } catch (e) {}
+      }
+      throw error;
+    };
+    jwt.verify = function (token, key, options, callback) {
+      if (typeof options === "function") {
+        callback = options;
+        options = {};
+      }
+      if (key !== secret) {
+        return verify.apply(this, arguments);
+      }
+      if (!callback) {
+        try {
+          return verify.call(this, token, key, options);
+        } catch (e) {
+          if (!signatureError(e)) {
+            throw e;
+          }
+          return verifyPrevious(token, options, e);
+        }
+      }
+      return verify.call(this, token, key, options, (err, decoded) => {
+        if (!signatureError(err)) {
+          return callback(err, decoded);
+        }
+        try {
+          decoded = verifyPrevious(token, options, err);
+        } catch (e) {
+          return callback(e);
+        }
+        return callback(null, decoded);
+      });
+    };
+    return jwt;
+  };
+}
+
+function applyPragmas(pragmas) {
+  const statements = Object.entries(pragmas)
+    .filter(([name, value]) => /^\w+$/.test(name) && /^-?\w+$/.test(String(value)))
+    .map(([name, value]) => `PRAGMA ${name} = ${value};`)
+    .join(" ");
+  let sqlite3;
+  try {
+    sqlite3 = require(require.resolve("sqlite3", { paths: [APP_ROOT] }));
+  } catch (e) {
+    console.log(`Unable to apply SQLite pragmas: ${e.message}`);
+    return;
+  }
+  // Statements are queued until the connection is open, so the pragmas
+  // run before any query made by the application
+  sqlite3.Database = class extends sqlite3.Database {
+    constructor(...args) {
+      super(...args);
+      this.exec(statements, (err) => {
+        if (err) {
+          console.log(`Unable to apply SQLite pragmas: ${err.message}`);
+        }
+      });
+    }
+  };
+}
+
+function appConfig() {
+  try {
+    return JSON.parse(fs.readFileSync(path.join(APP_ROOT, "config.json"), "utf8"));
+  } catch (e) {
+    return {};
+  }
+}
+
+const workers = Number(process.env.APP_WORKERS) || availableCpus();
+const isPrimary =
+  cluster.isPrimary === undefined ? cluster.isMaster : cluster.isPrimary;
+
+function logShipper() {
+  const { LogShipper } = require("./logship");
+  const env = process.env;
+  return new LogShipper({
+    file: env.LOG_TARGET === "file" ? env.LOG_FILE : null,
+    maxSize: Number(env.LOG_MAX_SIZE) || 50 * 1024 * 1024,
+    interval: Number(env.LOG_ROTATE_INTERVAL) || 0,
+    backups: Number(env.LOG_BACKUPS) || 5,
+    bufferSize: Number(env.LOG_BUFFER_SIZE) || 1024 * 1024,
+  });
+}
+
+if (isPrimary) {
+  let stopping = false;
+  const shipper = process.env.LOG_TARGET ? logShipper() : null;
+  const exit = () => (shipper ? shipper.close(() => process.exit(0)) : process.exit(0));
+  if (shipper) {
+    // Worker output is piped to the wrapper rather than inherited
+    (cluster.setupPrimary || cluster.setupMaster).call(cluster, { silent: true });
+  }
+  let aggregator = null;
+  if (process.env.METRICS_PORT) {
+    const { MetricsAggregator } = require("./metrics");
+    aggregator = new MetricsAggregator(APP_ROOT, availableCpus());
+    aggregator.serve(Number(process.env.METRICS_PORT));
+  }
+  let reloading = Promise.resolve();
+  const started = new Map();
+  const retiring = new Set();
+  const warmup = process.env.WARMUP_ROUTES ? require("./warmup") : null;
+  const warmupStart = process.hrtime.bigint();
+  let warming = workers;
+
+  const fork = () => {
+    const worker = cluster.fork();
+    started.set(worker.id, Date.now());
+    if (warmup) {
+      worker.on("message", (message) => {
+        if (message && message.warmed !== undefined && warming > 0 && --warming === 0) {
+          const seconds = Number(process.hrtime.bigint() - warmupStart) / 1e9;
+          console.log(`Warmed up Open Apiary in ${seconds.toFixed(3)}s`);
+          if (aggregator) {
+            aggregator.warmedUp(seconds);
+          }
+        }
+      });
+    }
+    if (shipper) {
+      worker.process.stdout.on("data", (chunk) => shipper.write(chunk));
+      worker.process.stderr.on("data", (chunk) => shipper.write(chunk));
+    }
+    if (aggregator) {
+      worker.on("message", (message) => {
+        if (message && message.metrics) {
+          aggregator.update(worker.id, message.metrics);
+        }
+      });
+    }
+    return worker;
+  };
+
+  const listening = (worker, callback) => {
+    if (!warmup) {
+      worker.once("listening", callback);
+      return;
+    }
+    // Workers listen on their private warm-up port first
+    const warmed = (message) => {
+      if (message && message.warmed !== undefined) {
+        worker.removeListener("message", warmed);
+        worker.once("listening", callback);
+      }
+    };
+    worker.on("message", warmed);
+  };
+
+  const replace = (worker) =>
+    new Promise((resolve) => {
+      const replacement = fork();
+      const done = () => {
+        // Stop accepting connections and let in-flight requests finish
+        retiring.add(worker.id);
+        worker.disconnect();
+        setTimeout(() => worker.kill("SIGTERM"), RETIRE_TIMEOUT_MS).unref();
+        resolve();
+      };
+      listening(replacement, done);
+      replacement.once("exit", resolve);
+    });
+
+  const forkWorkers = () => {
+    console.log(`Starting ${workers} Open Apiary worker(s)`);
+    for (let i = 0; i < workers; i++) {
+      fork();
+    }
+  };
+  if (warmup) {
+    const files = (process.env.WARMUP_FILES || "").split(",").filter(Boolean);
+    warmup.readFiles(files, warmupTimeout()).then(forkWorkers);
+  } else {
+    forkWorkers();
+  }
+
+  cluster.on("exit", (worker, code, signal) => {
+    const uptime = Date.now() - started.get(worker.id);
+    started.delete(worker.id);
+    if (aggregator) {
+      aggregator.retire(worker.id);
+    }
+    if (stopping) {
+      if (Object.keys(cluster.workers).length === 0) {
+        exit();
+      }
+      return;
+    }
+    if (retiring.delete(worker.id)) {
+      return;
+    }
+    console.log(
+      `Worker ${worker.process.pid} exited (${signal || code}), restarting`
+    );
+    setTimeout(fork, uptime < MIN_UPTIME_MS ? MIN_UPTIME_MS : 0);
+  });
+
+  process.on("SIGHUP", () => {
+    console.log("Reloading Open Apiary workers");
+    reloading = reloading.then(async () => {
+      for (const worker of Object.values(cluster.workers)) {
+        if (!stopping && !retiring.has(worker.id)) {
+          await replace(worker);
+        }
+      }
+    });
+  });
+
+  for (const sig of ["SIGTERM", "SIGINT"]) {
+    process.on(sig, () => {
+      stopping = true;
+      // Exit once every worker has exited rather than disconnecting, which
+      // fails writing to the channels of workers already gone
+      if (Object.keys(cluster.workers).length === 0) {
+        exit();
+      }
+      for (const id in cluster.workers) {
+        cluster.workers[id].process.kill(sig);
+      }
+    });
+  }
+} else {
+  if (process.env.UPLOADS_URL) {
+    routeUploads(process.env.UPLOAD_PATH || "/uploads", process.env.UPLOADS_URL);
+  }
+  if (process.env.THUMBNAIL_URL) {
+    // Wraps the uploads route so embedded photos are redirected first
+    routeThumbnails(process.env.THUMBNAIL_URL, Boolean(process.env.THUMBNAIL_REDIRECT));
+  }
+  if (process.env.WEATHER_PROXY_URL) {
+    require("./weather").routeWeather(
+      process.env.WEATHER_HOST || "api.openweathermap.org",
+      process.env.WEATHER_PROXY_URL
+    );
+  }
+  const config = appConfig();
+  if (config.db && config.db.type === "sqlite" && config.db.pragmas) {
+    applyPragmas(config.db.pragmas);
+  }
+  const jwt = config.jwt || {};
+  if (jwt.secret && jwt.previousSecrets && jwt.previousSecrets.length) {
+    acceptPreviousSecrets(jwt.secret, jwt.previousSecrets);
+  }
+  if (process.env.WARMUP_ROUTES) {
+    require("./warmup").warmWorker({
+      routes: process.env.WARMUP_ROUTES.split(",").filter(Boolean),
+      concurrency: Number(process.env.WARMUP_CONCURRENCY) || 1,
+      timeout: warmupTimeout(),
+    });
+  }
+  if (process.env.METRICS_PORT) {
+    // Wraps the thumbnail route so thumbnail requests are measured too
+    require("./metrics").instrumentWorker(
+      Number(process.env.METRICS_INTERVAL) || METRICS_INTERVAL_MS
+    );
+  }
+  process.chdir(APP_ROOT);
+  require(APP_ROOT);
+}
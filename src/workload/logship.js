@@ -0,0 +1,149 @@
+// Copyright 2021 James Page
+// See LICENSE file for licensing details.
+//
+// Log shipping for the Open Apiary cluster wrapper, pushed into the
+// workload container by the open-apiary charm.
+//
+// Workers log to their stdout, which the cluster wrapper reads and hands
+// to a LogShipper. Output is queued in a buffer bounded to bufferSize
+// bytes and written out asynchronously, so slow log I/O never blocks the
+// workers; when the buffer is full the oldest output is dropped and the
+// number of bytes dropped noted in the log.
+//
+// Log files are rotated once they reach maxSize bytes or every interval
+// milliseconds, keeping backups gzip compressed copies.
+
+"use strict";
+
+const fs = require("fs");
+const zlib = require("zlib");
+
+class LogShipper {
+  constructor({ file, maxSize, interval, backups, bufferSize, output }) {
+    this.file = file;
+    this.maxSize = maxSize;
+    this.backups = backups;
+    this.bufferSize = bufferSize;
+    this.queue = [];
+    this.queued = 0;
+    this.dropped = 0;
+    this.busy = false;
+    this.closing = null;
+    if (file) {
+      try {
+        this.size = fs.statSync(file).size;
+      } catch (e) {
+        this.size = 0;
+      }
+      this.output = fs.createWriteStream(file, { flags: "a" });
+      if (interval) {
+        this.timer = setInterval(() => {
+          if (this.size > 0) {
+            this.rotateNext = true;
+            this._flush();
+          }
+        }, interval);
+        this.timer.unref();
+      }
+    } else {
+      this.output = output || process.stdout;
+    }
+  }
+
+  write(chunk) {
+    this.queue.push(chunk);
+    this.queued += chunk.length;
+    while (this.queued > this.bufferSize && this.queue.length > 1) {
+      const oldest = this.queue.shift();
+      this.queued -= oldest.length;
+      this.dropped += oldest.length;
+    }
+    this._flush();
+  }
+
+  _flush() {
+    if (this.busy) {
+      return;
+    }
+    if (this.rotateNext || (this.file && this.size >= this.maxSize)) {
+      this.busy = true;
+      this.rotateNext = false;
+      this._rotate(() => {
+        this.busy = false;
+        this._flush();
+      });
+      return;
+    }
+    if (this.queue.length === 0) {
+      if (this.closing) {
+        const done = this.closing;
+        this.closing = null;
+        if (this.file) {
+          this.output.end(done);
+        } else {
+          done();
+        }
+      }
+      return;
+    }
+    const chunks = this.queue;
+    if (this.dropped) {
+      chunks.unshift(
+        Buffer.from(`[log buffer full, dropped ${this.dropped} bytes]\n`)
+      );
+      this.dropped = 0;
+    }
+    const data = Buffer.concat(chunks);
+    this.queue = [];
+    this.queued = 0;
+    this.busy = true;
+    this.output.write(data, () => {
+      this.size += data.length;
+      this.busy = false;
+      this._flush();
+    });
+  }
+
+  _rotate(done) {
+    const file = this.file;
+    const rotated = `${file}.rotating`;
+    this.output.end(() => {
+      try {
+        fs.renameSync(file, rotated);
+      } catch (e) {
+        // Nothing written since the last rotation
+      }
+      this.output = fs.createWriteStream(file, { flags: "a" });
+      this.size = 0;
+      for (let index = this.backups - 1; index >= 1; index--) {
+        try {
+          fs.renameSync(`${file}.${index}.gz`, `${file}.${index + 1}.gz`);
+        } catch (e) {}
+      }
+      try {
+        fs.unlinkSync(`${file}.${this.backups + 1}.gz`);
+      } catch (e) {}
+      if (!fs.existsSync(rotated)) {
+        done();
+        return;
+      }
+      fs.createReadStream(rotated)
+        .pipe(zlib.createGzip())
+        .pipe(fs.createWriteStream(`${file}.1.gz`))
+        .on("finish", () => {
+          fs.unlink(rotated, () => done());
+        })
+        .on("error", () => done());
+    });
+  }
+
+  close(done) {
+    if (this.timer) {
+      clearInterval(this.timer);
+    }
+    this.closing = done;
+    this._flush();
+  }
+}
+
+module.exports = { LogShipper };
@@ -0,0 +1,224 @@
+// Copyright 2021 James Page
+// See LICENSE file for licensing details.
+//
+// Workload metrics for the Open Apiary cluster wrapper, pushed into the
+// workload container by the open-apiary charm.
+//
+// Each worker times the requests it handles and samples its event loop
+// lag, heap and CPU usage, reporting them to the wrapper every interval
+// milliseconds. The wrapper aggregates the reports, keeping the counters
+// of workers which have exited so that they only ever increase, and
+// serves them in the Prometheus text format on localhost for the metrics
+// exporter in the tools container.
+
+"use strict";
+
+const fs = require("fs");
+const http = require("http");
+const path = require("path");
+const { monitorEventLoopDelay } = require("perf_hooks");
+
+const BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10];
+
+// Pool size used by the MySQL driver when not configured
+const DEFAULT_POOL_SIZE = 10;
+
+function newCounters() {
+  return {
+    requests: {},
+    buckets: BUCKETS.map(() => 0),
+    durationSum: 0,
+    durationCount: 0,
+    cpuSeconds: 0,
+  };
+}
+
+function instrumentWorker(interval) {
+  const counters = newCounters();
+  const lag = monitorEventLoopDelay({ resolution: 10 });
+  lag.enable();
+
+  const emit = http.Server.prototype.emit;
+  http.Server.prototype.emit = function (event, req, res) {
+    if (event === "request") {
+      const start = process.hrtime.bigint();
+      res.once("finish", () => {
+        const seconds = Number(process.hrtime.bigint() - start) / 1e9;
+        const code = `${Math.floor(res.statusCode / 100)}xx`;
+        counters.requests[code] = (counters.requests[code] || 0) + 1;
+        BUCKETS.forEach((bound, index) => {
+          if (seconds <= bound) {
+            counters.buckets[index] += 1;
+          }
+        });
+        counters.durationSum += seconds;
+        counters.durationCount += 1;
+      });
+    }
+    return emit.apply(this, arguments);
+  };
+
+  setInterval(() => {
+    if (!process.connected) {
+      return;
+    }
+    const cpu = process.cpuUsage();
+    const memory = process.memoryUsage();
+    counters.cpuSeconds = (cpu.user + cpu.system) / 1e6;
+    process.send({
+      metrics: {
+        counters,
+        heapUsed: memory.heapUsed,
+        rss: memory.rss,
+        lag: lag.percentile(99) / 1e9,
+      },
+    });
+    lag.reset();
+  }, interval).unref();
+}
+
+function dbConnections(port) {
+  // Established TCP connections to the database port from the pod
+  let count = 0;
+  for (const table of ["/proc/net/tcp", "/proc/net/tcp6"]) {
+    let lines;
+    try {
+      lines = fs.readFileSync(table, "utf8").trim().split("\n").slice(1);
+    } catch (e) {
+      continue;
+    }
+    for (const line of lines) {
+      const fields = line.trim().split(/\s+/);
+      const remotePort = parseInt(fields[2].split(":")[1], 16);
+      if (remotePort === port && fields[3] === "01") {
+        count += 1;
+      }
+    }
+  }
+  return count;
+}
+
+class MetricsAggregator {
+  constructor(appRoot, cpus) {
+    this.configFile = path.join(appRoot, "config.json");
+    this.packageFile = path.join(appRoot, "package.json");
+    this.cpus = cpus;
+    this.warmup = null;
+    this.workers = new Map();
+    this.retired = newCounters();
+  }
+
+  update(id, metrics) {
+    this.workers.set(id, metrics);
+  }
+
+  warmedUp(seconds) {
+    let version = "";
+    try {
+      version = JSON.parse(fs.readFileSync(this.packageFile, "utf8")).version || "";
+    } catch (e) {}
+    this.warmup = { seconds, version };
+  }
+
+  retire(id) {
+    const metrics = this.workers.get(id);
+    this.workers.delete(id);
+    if (metrics) {
+      this._add(this.retired, metrics.counters);
+    }
+  }
+
+  _add(total, counters) {
+    for (const [code, count] of Object.entries(counters.requests)) {
+      total.requests[code] = (total.requests[code] || 0) + count;
+    }
+    counters.buckets.forEach((count, index) => {
+      total.buckets[index] += count;
+    });
+    total.durationSum += counters.durationSum;
+    total.durationCount += counters.durationCount;
+    total.cpuSeconds += counters.cpuSeconds;
+  }
+
+  _database() {
+    try {
+      const { db } = JSON.parse(fs.readFileSync(this.configFile, "utf8"));
+      if (db.type === "mysql") {
+        const poolSize = (db.extra && db.extra.connectionLimit) || DEFAULT_POOL_SIZE;
+        return { port: Number(db.port), poolSize };
+      }
+    } catch (e) {}
+    return null;
+  }
+
+  render() {
+    const total = newCounters();
+    this._add(total, this.retired);
+    let heapUsed = 0;
+    let rss = 0;
+    let lag = 0;
+    for (const metrics of this.workers.values()) {
+      this._add(total, metrics.counters);
+      heapUsed += metrics.heapUsed;
+      rss += metrics.rss;
+      lag = Math.max(lag, metrics.lag);
+    }
+    const lines = [
+      "# TYPE open_apiary_workers gauge",
+      `open_apiary_workers ${this.workers.size}`,
+      "# TYPE open_apiary_http_requests_total counter",
+    ];
+    for (const [code, count] of Object.entries(total.requests).sort()) {
+      lines.push(`open_apiary_http_requests_total{code="${code}"} ${count}`);
+    }
+    lines.push("# TYPE open_apiary_http_request_duration_seconds histogram");
+    BUCKETS.forEach((bound, index) => {
+      lines.push(
+        `open_apiary_http_request_duration_seconds_bucket{le="${bound}"} ${total.buckets[index]}`
+      );
+    });
+    lines.push(
+      `open_apiary_http_request_duration_seconds_bucket{le="+Inf"} ${total.durationCount}`,
+      `open_apiary_http_request_duration_seconds_sum ${total.durationSum}`,
+      `open_apiary_http_request_duration_seconds_count ${total.durationCount}`,
+      "# TYPE open_apiary_event_loop_lag_seconds gauge",
+      `open_apiary_event_loop_lag_seconds ${lag}`,
+      "# TYPE open_apiary_heap_used_bytes gauge",
+      `open_apiary_heap_used_bytes ${heapUsed}`,
+      "# TYPE open_apiary_resident_memory_bytes gauge",
+      `open_apiary_resident_memory_bytes ${rss}`,
+      "# TYPE open_apiary_cpu_seconds_total counter",
+      `open_apiary_cpu_seconds_total ${total.cpuSeconds}`,
+      "# TYPE open_apiary_cpus gauge",
+      `open_apiary_cpus ${this.cpus}`
+    );
+    if (this.warmup) {
+      // Labelled with the application version to compare across images
+      lines.push(
+        "# TYPE open_apiary_warmup_seconds gauge",
+        `open_apiary_warmup_seconds{version="${this.warmup.version}"} ${this.warmup.seconds}`
+      );
+    }
+    const db = this._database();
+    if (db) {
+      lines.push(
+        "# TYPE open_apiary_db_connections gauge",
+        `open_apiary_db_connections ${dbConnections(db.port)}`,
+        "# TYPE open_apiary_db_pool_size gauge",
+        `open_apiary_db_pool_size ${db.poolSize * this.workers.size}`
+      );
+    }
+    return lines.join("\n") + "\n";
+  }
+
+  serve(port) {
+    http
+      .createServer((req, res) => {
+        res.writeHead(200, { "Content-Type": "text/plain; version=0.0.4" });
+        res.end(this.render());
+      })
+      .listen(port, "localhost");
+  }
+}
+
+module.exports = { instrumentWorker, MetricsAggregator };
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Prometheus exporter for Open Apiary
+
+Pushed into the tools container by the open-apiary charm and run as a
+Pebble service. Each scrape collects the workload metrics served by the
+cluster wrapper at WORKLOAD_METRICS_URL and appends the charm's own
+counters, which the charm writes to CHARM_METRICS in the Prometheus text
+format whenever they change.
+"""
+
+import http.server
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger("metrics-exporter")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Collector:
+    """Combine the workload and charm metrics into a single exposition"""
+
+    def __init__(self, workload_url: str, charm_metrics: str, timeout: float = 2.0):
+        self.workload_url = workload_url
+        self.charm_metrics = charm_metrics
+        self.timeout = timeout
+
+    def workload(self) -> str:
+        """Workload metrics, or an empty string if the wrapper is not serving"""
+        try:
+            with urllib.request.urlopen(self.workload_url, timeout=self.timeout) as response:
+                return response.read().decode()
+        except (urllib.error.URLError, OSError) as e:
+            logger.debug("Unable to scrape workload metrics: %s", e)
+            return ""
+
+    def charm(self) -> str:
+        try:
+            with open(self.charm_metrics) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def collect(self) -> str:
+        start = time.monotonic()
+        workload = self.workload()
+        lines = [
+            workload.rstrip("\n"),
+            self.charm().rstrip("\n"),
+            "# TYPE open_apiary_up gauge",
+            "open_apiary_up {}".format(1 if workload else 0),
+            "# TYPE open_apiary_scrape_duration_seconds gauge",
+            "open_apiary_scrape_duration_seconds {:.6f}".format(time.monotonic() - start),
+        ]
+        return "\n".join(line for line in lines if line) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the combined metrics at /metrics"""
+
+    collector = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.collector.collect().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    MetricsHandler.collector = Collector(
+        os.environ.get("WORKLOAD_METRICS_URL", "http://localhost:9101/metrics"),
+        os.environ.get("CHARM_METRICS", "/opt/charm/charm.prom"),
+    )
+    server = http.server.ThreadingHTTPServer(
+        ("", int(os.environ.get("METRICS_PORT", "9100"))), MetricsHandler
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
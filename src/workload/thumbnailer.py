@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Thumbnail service for Open Apiary uploads
+
+Pushed into the tools container by the open-apiary charm and run as a
+Pebble service. Thumbnails of photos uploaded to UPLOAD_PATH are
+generated into THUMBNAIL_PATH shortly after they are uploaded and served
+under /thumbnails/ on THUMBNAIL_HOST, which the ingress routes to
+directly; thumbnails not yet generated, or evicted, are generated on
+demand.
+
+The thumbnail cache is kept within THUMBNAIL_CACHE_SIZE MB by evicting
+the least recently used thumbnails, using the access time set when a
+thumbnail is served.
+
+When UPLOADS_URL is set, photos missing from UPLOAD_PATH because they were
+uploaded to another unit are fetched through the uploads service there.
+"""
+
+import http.server
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger("thumbnailer")
+
+ROUTE = "/thumbnails/"
+IMAGE_SUFFIXES = {".gif", ".jpeg", ".jpg", ".png", ".webp"}
+CACHE_CONTROL = "public, max-age=2592000"
+# Marks the time of the last scan for new uploads
+SCAN_MARKER = ".last-scan"
+
+
+class ThumbnailCache:
+    """Thumbnails of uploaded photos kept within a size quota"""
+
+    def __init__(self, uploads, cache, size: int, quota: int, fetch=None):
+        self.uploads = pathlib.Path(uploads)
+        self.cache = pathlib.Path(cache)
+        self.size = size
+        self.quota = quota
+        self.fetch = fetch
+        self.lock = threading.Lock()
+
+    def _relative(self, name: str) -> pathlib.PurePosixPath:
+        """Relative path of an upload, refusing paths outside the uploads"""
+        relative = pathlib.PurePosixPath(name.lstrip("/"))
+        if ".." in relative.parts or relative.suffix.lower() not in IMAGE_SUFFIXES:
+            raise KeyError(name)
+        return relative
+
+    def render(self, source: pathlib.Path, target: pathlib.Path) -> None:
+        """Write a thumbnail of source to target in the same image format"""
+        # Only available in the tools image
+        from PIL import Image
+
+        with Image.open(source) as image:
+            image_format = image.format
+            image.thumbnail((self.size, self.size))
+            image.save(target, format=image_format)
+
+    def generate(self, name: str) -> pathlib.Path:
+        """Thumbnail for the named upload, generated if missing or stale"""
+        relative = self._relative(name)
+        source = self.uploads / relative
+        target = self.cache / relative
+        if self.fetch and not source.exists():
+            self.fetch(relative.as_posix())
+        source_mtime = source.stat().st_mtime
+        try:
+            if target.stat().st_mtime >= source_mtime:
+                return target
+        except FileNotFoundError:
+            pass
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial = target.with_name(".{}.{}".format(target.name, threading.get_ident()))
+        try:
+            self.render(source, partial)
+            # Readers only ever see complete thumbnails
+            os.replace(partial, target)
+        finally:
+            if partial.exists():
+                partial.unlink()
+        logger.info("Generated thumbnail for %s", relative)
+        return target
+
+    def uploads_since(self, since: float):
+        """Names of uploaded photos modified after since"""
+        for root, dirs, files in os.walk(self.uploads):
+            path = pathlib.Path(root)
+            # The cache may live within the uploads
+            dirs[:] = [d for d in dirs if path / d != self.cache and not d.startswith(".")]
+            for name in files:
+                source = path / name
+                if source.suffix.lower() not in IMAGE_SUFFIXES:
+                    continue
+                if source.stat().st_mtime > since:
+                    yield source.relative_to(self.uploads).as_posix()
+
+    def scan(self) -> int:
+        """Generate thumbnails for uploads since the previous scan
+
+        Thumbnails evicted from the cache are not regenerated until they
+        are requested again.
+        """
+        marker = self.cache / SCAN_MARKER
+        try:
+            since = marker.stat().st_mtime
+        except FileNotFoundError:
+            since = 0.0
+        started = time.time()
+        generated = 0
+        for name in self.uploads_since(since):
+            try:
+                self.generate(name)
+                generated += 1
+            except Exception as e:
+                logger.warning("Unable to generate thumbnail for %s: %s", name, e)
+        self.cache.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+        os.utime(marker, (started, started))
+        return generated
+
+    def evict(self) -> int:
+        """Remove least recently used thumbnails until within the quota"""
+        with self.lock:
+            thumbnails = []
+            total = 0
+            for root, _, files in os.walk(self.cache):
+                for name in files:
+                    if name.startswith("."):
+                        continue
+                    stat = os.stat(os.path.join(root, name))
+                    thumbnails.append((stat.st_atime, stat.st_size, os.path.join(root, name)))
+                    total += stat.st_size
+            evicted = 0
+            for _, size, path in sorted(thumbnails):
+                if total <= self.quota:
+                    break
+                os.unlink(path)
+                total -= size
+                evicted += 1
+            if evicted:
+                logger.info("Evicted %d thumbnail(s) from the cache", evicted)
+            return evicted
+
+
+class ThumbnailHandler(http.server.BaseHTTPRequestHandler):
+    """Serve thumbnails, generating any missing from the cache"""
+
+    cache = None
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith(ROUTE):
+            self.send_error(404)
+            return
+        try:
+            thumbnail = self.cache.generate(urllib.parse.unquote(path[len(ROUTE):]))
+            body = thumbnail.read_bytes()
+            # The access time orders thumbnails for eviction from the cache
+            os.utime(thumbnail, (time.time(), thumbnail.stat().st_mtime))
+        except (KeyError, OSError):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(thumbnail.name)[0])
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", CACHE_CONTROL)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def maintain(cache: ThumbnailCache, interval: float, stop: threading.Event) -> None:
+    """Generate thumbnails for new uploads and keep the cache within quota"""
+    while not stop.is_set():
+        try:
+            cache.scan()
+            cache.evict()
+        except OSError as e:
+            logger.warning("Thumbnail cache maintenance failed: %s", e)
+        stop.wait(interval)
+
+
+def fetch_upload(url: str, name: str) -> None:
+    """Have the uploads service at url fetch the named upload from the bucket"""
+    try:
+        with urllib.request.urlopen(
+            "{}/uploads/{}".format(url, urllib.parse.quote(name)), timeout=30
+        ):
+            pass
+    except urllib.error.HTTPError as e:
+        e.close()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    uploads_url = os.environ.get("UPLOADS_URL")
+    cache = ThumbnailCache(
+        os.environ.get("UPLOAD_PATH", "/uploads"),
+        os.environ.get("THUMBNAIL_PATH", "/uploads/.thumbnails"),
+        int(os.environ.get("THUMBNAIL_SIZE", "320")),
+        int(os.environ.get("THUMBNAIL_CACHE_SIZE", "512")) * 1024 * 1024,
+        fetch=(lambda name: fetch_upload(uploads_url, name)) if uploads_url else None,
+    )
+    stop = threading.Event()
+    threading.Thread(
+        target=maintain,
+        args=(cache, float(os.environ.get("THUMBNAIL_SCAN_INTERVAL", "30")), stop),
+        daemon=True,
+    ).start()
+    ThumbnailHandler.cache = cache
+    server = http.server.ThreadingHTTPServer(
+        (
+            os.environ.get("THUMBNAIL_HOST", "localhost"),
+            int(os.environ.get("THUMBNAIL_PORT", "3001")),
+        ),
+        ThumbnailHandler,
+    )
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
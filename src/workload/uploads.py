@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Shared uploads backend for Open Apiary
+
+Pushed into the tools container by the open-apiary charm, along with the
+S3 client, and run as a Pebble service once the charm is related to
+S3-compatible object storage. Uploads written to UPLOAD_PATH are copied
+to the bucket every UPLOADS_SYNC_INTERVAL seconds, or as soon as the
+cluster wrapper reports a write, and uploads removed by the application
+are removed from the bucket.
+
+The cluster wrapper passes requests for uploads missing from UPLOAD_PATH
+to this service, which fetches them from the bucket into UPLOAD_PATH, so
+each unit's uploads storage is a read-through cache of the bucket. The
+cache is kept within UPLOADS_CACHE_SIZE MB by evicting the least recently
+used uploads, only ever evicting uploads already copied to the bucket.
+
+Uploads removed or replaced in the bucket by another unit are dropped
+from the cache at the next sync, by comparing the ETag recorded when each
+upload was copied or fetched with the bucket listing, so a replaced
+upload is fetched again when next requested.
+"""
+
+import http.server
+import json
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+import time
+import urllib.parse
+
+from s3 import S3Client, S3Error
+
+logger = logging.getLogger("uploads")
+
+ROUTE = "/uploads/"
+# Uploads known to be in the bucket, by name, with the size and mtime they
+# were copied or fetched with and their ETag in the bucket; evicted uploads
+# are recorded as None
+INDEX = ".uploads-index.json"
+
+
+class UploadCache:
+    """Local uploads kept in step with a bucket within a size quota"""
+
+    def __init__(self, uploads, client: S3Client, prefix: str, quota: int):
+        self.uploads = pathlib.Path(uploads)
+        self.client = client
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.wake = threading.Event()
+        try:
+            self.index = json.loads((self.uploads / INDEX).read_text())
+        except (OSError, ValueError):
+            self.index = {}
+
+    def _relative(self, name: str) -> str:
+        """Relative path of an upload, refusing paths outside the uploads"""
+        relative = pathlib.PurePosixPath(name.lstrip("/"))
+        if not relative.parts or any(part.startswith(".") for part in relative.parts):
+            raise KeyError(name)
+        return relative.as_posix()
+
+    def files(self) -> dict:
+        """Stat of each local upload by name, skipping hidden files"""
+        files = {}
+        for root, dirs, names in os.walk(self.uploads):
+            path = pathlib.Path(root)
+            # Hidden directories hold caches such as thumbnails
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if not name.startswith("."):
+                    stat = os.stat(path / name)
+                    files[(path / name).relative_to(self.uploads).as_posix()] = stat
+        return files
+
+    def _unchanged(self, name: str, stat: os.stat_result) -> bool:
+        """Whether an upload is as it was copied to or fetched from the bucket"""
+        entry = self.index.get(name)
+        return entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]
+
+    def save_index(self) -> None:
+        with self.lock:
+            index = json.dumps(self.index, sort_keys=True)
+        partial = self.uploads / (INDEX + ".partial")
+        partial.write_text(index)
+        os.replace(partial, self.uploads / INDEX)
+
+    def sync(self) -> tuple:
+        """Copy new and changed uploads to the bucket and remove deleted ones"""
+        copied = removed = 0
+        files = self.files()
+        for name, stat in files.items():
+            if self._unchanged(name, stat):
+                continue
+            data = (self.uploads / name).read_bytes()
+            etag = self.client.put(self.prefix + name, data)
+            with self.lock:
+                self.index[name] = [stat.st_size, stat.st_mtime_ns, etag]
+            copied += 1
+        for name, entry in list(self.index.items()):
+            if entry is None or name in files:
+                continue
+            with self.lock:
+                # Fetched since the uploads were listed
+                if (self.uploads / name).exists() or self.index.get(name) is None:
+                    continue
+                del self.index[name]
+            self.client.delete(self.prefix + name)
+            removed += 1
+        if copied or removed:
+            logger.info("Copied %d upload(s) to the bucket, removed %d", copied, removed)
+        return copied, removed
+
+    def refresh(self) -> int:
+        """Drop cached uploads removed or replaced in the bucket by other units
+
+        Replaced uploads are fetched again when next requested.  Returns the
+        number of uploads dropped.
+        """
+        etags = self.client.etags(self.prefix)
+        dropped = 0
+        with self.lock:
+            for name, entry in list(self.index.items()):
+                etag = etags.get(self.prefix + name)
+                if entry is None:
+                    if etag is None:
+                        del self.index[name]
+                    continue
+                if len(entry) < 3:
+                    # Indexed before ETags were recorded
+                    self.index[name] = entry[:2] + [etag]
+                    continue
+                if etag == entry[2]:
+                    continue
+                path = self.uploads / name
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    # Removed here too, and from the bucket by sync
+                    continue
+                # Changed here since, so copied to the bucket by sync
+                if not self._unchanged(name, stat):
+                    continue
+                path.unlink()
+                if etag is None:
+                    del self.index[name]
+                else:
+                    self.index[name] = None
+                dropped += 1
+        if dropped:
+            logger.info("Dropped %d upload(s) changed in the bucket", dropped)
+        return dropped
+
+    def fetch(self, name: str) -> pathlib.Path:
+        """Path of the named upload, fetched from the bucket if missing
+
+        Raises KeyError if the upload is in neither.
+        """
+        name = self._relative(name)
+        path = self.uploads / name
+        with self.lock:
+            fetching = self.fetching.setdefault(name, threading.Lock())
+        # Concurrent requests for the same upload wait for a single fetch
+        with fetching:
+            if not path.is_file():
+                try:
+                    data, etag = self.client.get_object(self.prefix + name)
+                except S3Error as e:
+                    if e.status == 404:
+                        raise KeyError(name)
+                    raise
+                path.parent.mkdir(parents=True, exist_ok=True)
+                partial = path.with_name(".{}.{}".format(path.name, threading.get_ident()))
+                partial.write_bytes(data)
+                os.replace(partial, path)
+                stat = path.stat()
+                with self.lock:
+                    self.index[name] = [stat.st_size, stat.st_mtime_ns, etag]
+                logger.info("Fetched %s from the bucket", name)
+        with self.lock:
+            self.fetching.pop(name, None)
+        return path
+
+    def evict(self) -> int:
+        """Remove least recently used uploads until within the quota"""
+        with self.lock:
+            total = 0
+            candidates = []
+            for name, stat in self.files().items():
+                total += stat.st_size
+                # Only uploads unchanged since being copied to the bucket
+                if self._unchanged(name, stat):
+                    candidates.append((stat.st_atime, stat.st_size, name))
+            evicted = 0
+            for _, size, name in sorted(candidates):
+                if total <= self.quota:
+                    break
+                os.unlink(self.uploads / name)
+                self.index[name] = None
+                total -= size
+                evicted += 1
+            if evicted:
+                logger.info("Evicted %d upload(s) from the cache", evicted)
+            return evicted
+
+
+class UploadsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve uploads from the cache, fetching any missing from the bucket"""
+
+    cache = None
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith(ROUTE):
+            self.send_error(404)
+            return
+        try:
+            upload = self.cache.fetch(urllib.parse.unquote(path[len(ROUTE):]))
+            body = upload.read_bytes()
+        except (KeyError, OSError):
+            self.send_error(404)
+            return
+        except S3Error as e:
+            logger.warning("Unable to fetch %s: %s", path, e)
+            self.send_error(502)
+            return
+        # The access time orders uploads for eviction from the cache
+        os.utime(upload, ns=(time.time_ns(), upload.stat().st_mtime_ns))
+        self.send_response(200)
+        self.send_header(
+            "Content-Type", mimetypes.guess_type(upload.name)[0] or "application/octet-stream"
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """Copy new uploads to the bucket without waiting for the interval"""
+        if urllib.parse.urlsplit(self.path).path != "/sync":
+            self.send_error(404)
+            return
+        self.cache.wake.set()
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def maintain(cache: UploadCache, interval: float, stop: threading.Event) -> None:
+    """Keep the bucket in step with the uploads and the cache within quota"""
+    while not stop.is_set():
+        try:
+            cache.sync()
+            cache.refresh()
+            cache.evict()
+            cache.save_index()
+        except (OSError, S3Error) as e:
+            logger.warning("Uploads maintenance failed: %s", e)
+        cache.wake.wait(interval)
+        cache.wake.clear()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    env = os.environ
+    client = S3Client(
+        env["S3_ENDPOINT"],
+        env["S3_BUCKET"],
+        env["S3_ACCESS_KEY"],
+        env["S3_SECRET_KEY"],
+        env.get("S3_REGION") or "us-east-1",
+    )
+    cache = UploadCache(
+        env.get("UPLOAD_PATH", "/uploads"),
+        client,
+        env.get("S3_PREFIX", ""),
+        int(env.get("UPLOADS_CACHE_SIZE", "10240")) * 1024 * 1024,
+    )
+    stop = threading.Event()
+    threading.Thread(
+        target=maintain,
+        args=(cache, float(env.get("UPLOADS_SYNC_INTERVAL", "30")), stop),
+        daemon=True,
+    ).start()
+    UploadsHandler.cache = cache
+    server = http.server.ThreadingHTTPServer(
+        ("localhost", int(env.get("UPLOADS_PORT", "3003"))), UploadsHandler
+    )
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        cache.wake.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+// Copyright 2021 James Page
+// See LICENSE file for licensing details.
+//
+// Warm-up for the Open Apiary cluster wrapper, pushed into the workload
+// container by the open-apiary charm.
+//
+// Before a worker starts, the wrapper reads the database file into the
+// page cache. Each worker then holds back the application's listen until
+// it has requested each warm-up route concurrently, compiling the routes
+// and templates and opening database connections. The requests are sent
+// to a private listener on loopback which hands them to the application,
+// so a worker only shares the listening port once it is warm, whether it
+// is started with the wrapper, replaced on reload or after a crash.
+
+"use strict";
+
+const EventEmitter = require("events");
+const fs = require("fs");
+const http = require("http");
+
+function readFile(file) {
+  return new Promise((resolve) => {
+    let bytes = 0;
+    fs.createReadStream(file, { highWaterMark: 1024 * 1024 })
+      .on("data", (chunk) => {
+        bytes += chunk.length;
+      })
+      .on("error", () => resolve(0))
+      .on("end", () => resolve(bytes));
+  });
+}
+
+function request(port, route) {
+  return new Promise((resolve) => {
+    http
+      .get({ host: "127.0.0.1", port, path: route, agent: false }, (res) => {
+        res.resume();
+        res.on("end", () => resolve(res.statusCode));
+      })
+      .on("error", () => resolve(0));
+  });
+}
+
+function withTimeout(promise, timeout, message) {
+  let timer;
+  return Promise.race([
+    promise,
+    new Promise((resolve) => {
+      timer = setTimeout(() => {
+        console.log(message);
+        resolve();
+      }, timeout);
+    }),
+  ]).finally(() => clearTimeout(timer));
+}
+
+function readFiles(files, timeout) {
+  const run = async () => {
+    for (const file of files) {
+      const bytes = await readFile(file);
+      console.log(`Warm-up read ${bytes} bytes of ${file}`);
+    }
+  };
+  return withTimeout(run(), timeout, `Warm-up reading incomplete after ${timeout}ms`);
+}
+
+async function warmUp({ port, routes, concurrency, timeout }) {
+  const start = process.hrtime.bigint();
+  const run = async () => {
+    for (const route of routes) {
+      const statuses = await Promise.all(
+        Array.from({ length: concurrency }, () => request(port, route))
+      );
+      const failed = statuses.filter((status) => !status || status >= 500).length;
+      if (failed) {
+        console.log(`Warm-up of ${route} failed for ${failed} request(s)`);
+      }
+    }
+  };
+  await withTimeout(run(), timeout, `Warm-up incomplete after ${timeout}ms`);
+  return Number(process.hrtime.bigint() - start) / 1e9;
+}
+
+function warmWorker({ routes, concurrency, timeout }) {
+  const listen = http.Server.prototype.listen;
+  http.Server.prototype.listen = function (...args) {
+    // Only the application's server is held back
+    http.Server.prototype.listen = listen;
+    const server = this;
+    const local = http.createServer();
+    const sockets = new Set();
+    // Requests go through the application's server, and the wrappers
+    // around it, exactly once
+    local.emit = function (event, ...rest) {
+      if (event === "request") {
+        return server.emit(event, ...rest);
+      }
+      if (event === "connection") {
+        const socket = rest[0];
+        sockets.add(socket);
+        socket.on("close", () => sockets.delete(socket));
+      }
+      return EventEmitter.prototype.emit.call(this, event, ...rest);
+    };
+    let started = false;
+    const start = (seconds) => {
+      if (started) {
+        return;
+      }
+      started = true;
+      // Joins the shared port even if warm-up failed
+      try {
+        local.close();
+        // closeAllConnections() is not available before Node 18.2
+        for (const socket of sockets) {
+          socket.destroy();
+        }
+        if (seconds !== undefined) {
+          console.log(`Warmed up worker ${process.pid} in ${seconds.toFixed(3)}s`);
+        }
+        process.send({ warmed: seconds || 0 });
+      } finally {
+        listen.apply(server, args);
+      }
+    };
+    local.on("error", (e) => {
+      console.log(`Warm-up of worker ${process.pid} failed: ${e.message}`);
+      start();
+    });
+    // Exclusive so the port is not shared with the other workers
+    listen.call(local, { host: "127.0.0.1", port: 0, exclusive: true }, () => {
+      warmUp({ port: local.address().port, routes, concurrency, timeout }).then(start, (e) => {
+        console.log(`Warm-up of worker ${process.pid} failed: ${e.message}`);
+        start();
+      });
+    });
+    return server;
+  };
+}
+
+module.exports = { readFiles, warmWorker };
@@ -0,0 +1,63 @@
+// Copyright 2021 James Page
+// See LICENSE file for licensing details.
+//
+// Weather API routing for the Open Apiary cluster wrapper, pushed into the
+// workload container by the open-apiary charm.
+//
+// Open Apiary calls the weather API directly over HTTPS. Workers replace
+// the https request functions so that requests for the weather API host
+// are sent to the caching proxy in the tools container instead, leaving
+// every other request untouched.
+
+"use strict";
+
+const http = require("http");
+const https = require("https");
+
+function requestOptions(input, options) {
+  if (typeof input === "string" || input instanceof URL) {
+    const url = new URL(input);
+    return Object.assign(
+      {
+        hostname: url.hostname,
+        port: url.port,
+        path: url.pathname + url.search,
+      },
+      options
+    );
+  }
+  return Object.assign({}, input);
+}
+
+function routeWeather(host, proxy) {
+  const target = new URL(proxy);
+  for (const name of ["request", "get"]) {
+    const original = https[name];
+    https[name] = function (input, options, callback) {
+      if (typeof options === "function") {
+        callback = options;
+        options = undefined;
+      }
+      const opts = requestOptions(input, options);
+      const hostname = opts.hostname || (opts.host || "").split(":")[0];
+      if (hostname !== host) {
+        return original.apply(this, arguments);
+      }
+      const routed = Object.assign({}, opts, {
+        protocol: "http:",
+        hostname: target.hostname,
+        port: target.port,
+        host: undefined,
+        agent: undefined,
+        headers: Object.assign({}, opts.headers, { host }),
+      });
+      const req = http.request(routed, callback);
+      if (name === "get") {
+        req.end();
+      }
+      return req;
+    };
+  }
+}
+
+module.exports = { routeWeather };
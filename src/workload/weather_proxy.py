@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Caching proxy for the Open Apiary weather integration
+
+Pushed into the tools container by the open-apiary charm and run as a
+Pebble service. The cluster wrapper in the open-apiary container routes
+the application's requests for the weather API here; they are passed on
+to WEATHER_UPSTREAM and successful responses cached for WEATHER_CACHE_TTL
+seconds.
+
+Requests are keyed on their location rounded to a grid of
+WEATHER_CACHE_GRID degrees, so apiaries close to one another share
+cached conditions, and concurrent requests for the same key are collapsed
+into a single upstream request. Responses up to WEATHER_STALE_TTL seconds
+old are served when the upstream fails, and at most WEATHER_CACHE_SIZE
+responses are kept, evicting the least recently used.
+"""
+
+import collections
+import http.server
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger("weather-proxy")
+
+# Query parameters holding the location of a request
+LOCATION_PARAMS = ("lat", "lon")
+
+Response = collections.namedtuple("Response", ["status", "content_type", "body", "fetched_at"])
+
+
+class UpstreamError(Exception):
+    """The upstream weather API failed to respond"""
+
+
+class Flight:
+    """An upstream request shared by concurrent requests for the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WeatherCache:
+    """Responses from the upstream weather API cached by rounded location"""
+
+    def __init__(self, upstream: str, ttl: float, grid: float, size: int, stale_ttl: float):
+        self.upstream = upstream.rstrip("/")
+        self.ttl = ttl
+        self.grid = grid
+        self.size = size
+        self.stale_ttl = stale_ttl
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def key(self, path: str) -> str:
+        """Request path with its location rounded to the grid"""
+        url = urllib.parse.urlsplit(path)
+        params = []
+        for name, value in urllib.parse.parse_qsl(url.query, keep_blank_values=True):
+            if name in LOCATION_PARAMS and self.grid:
+                try:
+                    value = "{:.4f}".format(round(float(value) / self.grid) * self.grid)
+                except ValueError:
+                    pass
+            params.append((name, value))
+        return "{}?{}".format(url.path, urllib.parse.urlencode(sorted(params)))
+
+    def fetch(self, key: str) -> Response:
+        """Request key from the upstream, raising UpstreamError on failure"""
+        try:
+            with urllib.request.urlopen(self.upstream + key, timeout=10) as response:
+                return Response(
+                    response.status,
+                    response.headers.get("Content-Type"),
+                    response.read(),
+                    time.time(),
+                )
+        except urllib.error.HTTPError as e:
+            with e:
+                if e.code >= 500:
+                    raise UpstreamError(e)
+                # Client errors, such as an invalid API key, are passed back
+                return Response(e.code, e.headers.get("Content-Type"), e.read(), time.time())
+        except (urllib.error.URLError, OSError) as e:
+            raise UpstreamError(e)
+
+    def _store(self, key: str, response: Response) -> None:
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, path: str) -> tuple:
+        """Response for path and whether it is stale
+
+        Raises UpstreamError if the upstream fails and there is no
+        response recent enough to serve in its place.
+        """
+        key = self.key(path)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached and time.time() - cached.fetched_at < self.ttl:
+                self.entries.move_to_end(key)
+                return cached, False
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Flight()
+        if not leader:
+            # Another request is already fetching this key
+            flight.done.wait()
+        else:
+            try:
+                flight.result = self._refresh(key)
+            except UpstreamError as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+                flight.done.set()
+        if flight.error:
+            raise flight.error
+        return flight.result
+
+    def _refresh(self, key: str) -> tuple:
+        """Fetch key from the upstream, falling back to a stale response"""
+        try:
+            response = self.fetch(key)
+        except UpstreamError as e:
+            return self._stale(key, e)
+        if response.status == 200:
+            with self.lock:
+                self._store(key, response)
+        return response, False
+
+    def _stale(self, key: str, error: Exception) -> tuple:
+        with self.lock:
+            cached = self.entries.get(key)
+        if cached and time.time() - cached.fetched_at < self.stale_ttl:
+            logger.warning("Serving stale weather for %s: %s", key, error)
+            return cached, True
+        raise error
+
+
+class WeatherHandler(http.server.BaseHTTPRequestHandler):
+    """Serve weather API requests from the cache"""
+
+    cache = None
+
+    def do_GET(self):
+        try:
+            response, stale = self.cache.get(self.path)
+        except UpstreamError as e:
+            logger.warning("Weather API unavailable: %s", e)
+            self.send_error(502)
+            return
+        self.send_response(response.status)
+        if response.content_type:
+            self.send_header("Content-Type", response.content_type)
+        self.send_header("Content-Length", str(len(response.body)))
+        self.send_header("Age", str(int(time.time() - response.fetched_at)))
+        if stale:
+            self.send_header("Warning", '110 - "Response is Stale"')
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    WeatherHandler.cache = WeatherCache(
+        os.environ.get("WEATHER_UPSTREAM", "https://api.openweathermap.org"),
+        ttl=float(os.environ.get("WEATHER_CACHE_TTL", "600")),
+        grid=float(os.environ.get("WEATHER_CACHE_GRID", "0.1")),
+        size=int(os.environ.get("WEATHER_CACHE_SIZE", "1000")),
+        stale_ttl=float(os.environ.get("WEATHER_STALE_TTL", "86400")),
+    )
+    server = http.server.ThreadingHTTPServer(
+        ("localhost", int(os.environ.get("WEATHER_PROXY_PORT", "3002"))), WeatherHandler
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Offline benchmarks for charm hook execution
+
+Drives the charm through a realistic sequence of hooks with the ops
+Harness, injecting latency into every Pebble and relation operation, and
+reports hook throughput and operation counts for each step as JSON.
+Start up of the charm is timed in fresh interpreters, both for an event
+the charm does not handle and for importing the charm in full.
+
+Run with ./run_benchmarks [--units 1,3,10] [--latency-ms 2] [--output FILE]
+"""
+
+import argparse
+import functools
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+from unittest.mock import patch
+
+from ops.testing import Harness
+
+from charm import OpenApiaryCharm
+from instrumentation import PEBBLE_OPERATIONS, RELATION_OPERATIONS, HookProfiler
+
+CHARM = pathlib.Path(__file__).parent.parent / "src" / "charm.py"
+
+PACKAGE_INFO = json.dumps({"name": "open-apiary", "version": "1.1.1"})
+
+MYSQL_DATA_BAG = {
+    "database": "apiary",
+    "host": "mysql-0",
+    "port": "3306",
+    "user": "apiary",
+    "password": "secret",
+}
+
+
+def inject_latency(obj, names, latency: float) -> None:
+    """Delay each call to the named methods of obj by latency seconds"""
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is None:
+            continue
+
+        @functools.wraps(method)
+        def delayed(*args, _method=method, **kwargs):
+            time.sleep(latency)
+            return _method(*args, **kwargs)
+
+        setattr(obj, name, delayed)
+
+
+class Scenario:
+    """A simulated deployment of the charm driven through the Harness"""
+
+    def __init__(self, units: int, leader: bool, latency: float):
+        self.units = units
+        self.leader = leader
+        self.harness = Harness(OpenApiaryCharm)
+        self.harness.begin()
+        container = self.harness.model.unit.get_container("open-apiary")
+        container.push("/opt/app/package.json", PACKAGE_INFO, make_dirs=True)
+        # Pebble checks are not implemented in the test harness, and it
+        # mishandles service names when sending signals
+        container.pebble.get_checks = lambda *args, **kwargs: {}
+        container.pebble.send_signal = lambda *args, **kwargs: None
+
+        self.profiler = HookProfiler("/dev/null")
+        for obj, names, prefix in (
+            (container.pebble, PEBBLE_OPERATIONS, "pebble"),
+            (self.harness._backend, RELATION_OPERATIONS, "relation"),
+        ):
+            inject_latency(obj, names, latency)
+            self.profiler.wrap(obj, names, prefix)
+
+        self.hooks = 0
+        self.framework_emit = self.harness.framework._emit
+
+        def counting_emit(event):
+            self.hooks += 1
+            return self.framework_emit(event)
+
+        self.harness.framework._emit = counting_emit
+
+    def step(self, name: str, action) -> dict:
+        """Run action, returning hook throughput and operation counts"""
+        before = {op: dict(stats) for op, stats in self.profiler.operations.items()}
+        hooks = self.hooks
+        start = time.monotonic()
+        action()
+        elapsed = time.monotonic() - start
+        hooks = self.hooks - hooks
+        operations = {}
+        for op, stats in self.profiler.operations.items():
+            count = stats["count"] - before.get(op, {}).get("count", 0)
+            if count:
+                operations[op] = count
+        return {
+            "step": name,
+            "events": hooks,
+            "seconds": round(elapsed, 6),
+            "events-per-second": round(hooks / elapsed, 2) if elapsed else None,
+            "pebble-operations": sum(
+                n for op, n in operations.items() if op.startswith("pebble.")
+            ),
+            "relation-operations": sum(
+                n for op, n in operations.items() if op.startswith("relation.")
+            ),
+            "operations": operations,
+        }
+
+    def run(self, config_changes: int, token_changes: int) -> list:
+        """Run the hook sequence for this deployment"""
+        harness = self.harness
+        steps = [self.step("install", harness.charm.on.install.emit)]
+
+        def elect():
+            self.peers = harness.add_relation("apiary", "open-apiary")
+            for unit in range(1, self.units):
+                harness.add_relation_unit(self.peers, "open-apiary/{}".format(unit))
+            harness.add_relation("ingress", "nginx-ingress-integrator")
+            harness.set_leader(self.leader)
+            harness.charm.on.config_changed.emit()
+
+        steps.append(self.step("leader-elected", elect))
+
+        def db():
+            relation_id = harness.add_relation("mysql-database", "mysql")
+            harness.add_relation_unit(relation_id, "mysql/0")
+            harness.update_relation_data(relation_id, "mysql/0", MYSQL_DATA_BAG)
+
+        steps.append(self.step("db-joined-changed", db))
+
+        def config():
+            for change in range(config_changes):
+                harness.update_config({"debug": bool(change % 2)})
+
+        steps.append(self.step("config-changed", config))
+
+        def tokens():
+            for change in range(token_changes):
+                if self.leader:
+                    harness.charm._rotate_jwt_token()
+                else:
+                    harness.update_relation_data(
+                        self.peers,
+                        "open-apiary",
+                        {"jwt-token": "token-{}".format(change)},
+                    )
+
+        steps.append(self.step("peer-token-changed", tokens))
+        return steps
+
+
+def run(units: list, latency_ms: float, config_changes: int, token_changes: int) -> dict:
+    """Run the benchmark scenarios, returning machine readable results"""
+    results = []
+    # The readiness probe would otherwise wait on a real web application
+    with patch("charm.probe_http", return_value=True):
+        for count in units:
+            for leader in (True, False):
+                scenario = Scenario(count, leader, latency_ms / 1000.0)
+                try:
+                    steps = scenario.run(config_changes, token_changes)
+                finally:
+                    scenario.harness.cleanup()
+                events = sum(s["events"] for s in steps)
+                seconds = sum(s["seconds"] for s in steps)
+                results.append(
+                    {
+                        "units": count,
+                        "role": "leader" if leader else "follower",
+                        "events": events,
+                        "seconds": round(seconds, 6),
+                        "events-per-second": round(events / seconds, 2),
+                        "pebble-operations": sum(s["pebble-operations"] for s in steps),
+                        "relation-operations": sum(
+                            s["relation-operations"] for s in steps
+                        ),
+                        "steps": steps,
+                    }
+                )
+    return {
+        "latency-ms": latency_ms,
+        "config-changes": config_changes,
+        "token-changes": token_changes,
+        "scenarios": results,
+    }
+
+
+def startup(runs: int = 5) -> dict:
+    """Time charm start up in fresh interpreters, reporting the fastest run"""
+
+    def fastest(args, env) -> float:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(args, env=env, check=True)
+            times.append(time.perf_counter() - start)
+        return round(min(times), 6)
+
+    return {
+        "runs": runs,
+        "unhandled-event-seconds": fastest(
+            [sys.executable, str(CHARM)], dict(os.environ, JUJU_DISPATCH_PATH="hooks/install")
+        ),
+        "import-seconds": fastest([sys.executable, "-c", "import charm"], os.environ),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--units", default="1,3,10", help="unit counts to simulate")
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--config-changes", type=int, default=20)
+    parser.add_argument("--token-changes", type=int, default=5)
+    parser.add_argument("--startup-runs", type=int, default=10)
+    parser.add_argument("--output", help="write results to file rather than stdout")
+    args = parser.parse_args(argv)
+
+    results = run(
+        [int(u) for u in args.units.split(",")],
+        args.latency_ms,
+        args.config_changes,
+        args.token_changes,
+    )
+    results["startup"] = startup(args.startup_runs)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+"""Local stand-in for an S3-compatible object store used by the tests
+
+Objects are kept in memory in a single bucket. Requests must carry a
+Signature Version 4 Authorization header for the expected access key, and
+object listings are split into pages of page_size keys so continuation
+tokens are exercised.
+"""
+
+import hashlib
+import http.server
+import threading
+import urllib.parse
+from xml.sax.saxutils import escape
+
+NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class S3StandInHandler(http.server.BaseHTTPRequestHandler):
+    def _key(self):
+        url = urllib.parse.urlsplit(self.path)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip("/").partition("/")
+        return bucket, key, dict(urllib.parse.parse_qsl(url.query))
+
+    def _authorised(self, bucket: str) -> bool:
+        server = self.server
+        authorization = self.headers.get("Authorization", "")
+        credential = "Credential={}/".format(server.access_key)
+        with server.lock:
+            server.requests.append((self.command, self.path))
+        if not authorization.startswith("AWS4-HMAC-SHA256 ") or credential not in authorization:
+            self._respond(403)
+            return False
+        if bucket != server.bucket:
+            self._respond(404)
+            return False
+        return True
+
+    def _etag(self, key: str) -> str:
+        return '"{}"'.format(hashlib.md5(self.server.objects[key]).hexdigest())
+
+    def _respond(
+        self, status: int, body: bytes = b"", content_type: str = None, etag: str = None
+    ):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        bucket, key, _ = self._key()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self._authorised(bucket):
+            self.server.objects[key] = body
+            self._respond(200, etag=self._etag(key))
+
+    def do_GET(self):
+        bucket, key, params = self._key()
+        if not self._authorised(bucket):
+            return
+        if not key and params.get("list-type") == "2":
+            self._list(params)
+        elif key in self.server.objects:
+            self._respond(
+                200, self.server.objects[key], "application/octet-stream", self._etag(key)
+            )
+        else:
+            self._respond(404)
+
+    def do_HEAD(self):
+        bucket, key, _ = self._key()
+        if self._authorised(bucket):
+            if key in self.server.objects:
+                self._respond(200, etag=self._etag(key))
+            else:
+                self._respond(404)
+
+    def do_DELETE(self):
+        bucket, key, _ = self._key()
+        if self._authorised(bucket):
+            self.server.objects.pop(key, None)
+            self._respond(204)
+
+    def _list(self, params: dict):
+        keys = sorted(k for k in self.server.objects if k.startswith(params.get("prefix", "")))
+        start = params.get("continuation-token", "")
+        keys = [k for k in keys if k > start]
+        page, more = keys[: self.server.page_size], len(keys) > self.server.page_size
+        body = '<ListBucketResult xmlns="{}">'.format(NAMESPACE)
+        body += "".join(
+            "<Contents><Key>{}</Key><ETag>{}</ETag></Contents>".format(
+                escape(k), escape(self._etag(k))
+            )
+            for k in page
+        )
+        if more:
+            body += "<NextContinuationToken>{}</NextContinuationToken>".format(escape(page[-1]))
+        body += "</ListBucketResult>"
+        self._respond(200, body.encode(), "application/xml")
+
+    def log_message(self, *args):
+        pass
+
+
+def start(bucket: str = "backups", access_key: str = "access", page_size: int = 1000):
+    """Serve a stand-in store on localhost, returning the server"""
+    server = http.server.ThreadingHTTPServer(("localhost", 0), S3StandInHandler)
+    server.bucket = bucket
+    server.access_key = access_key
+    server.page_size = page_size
+    server.objects = {}
+    server.requests = []
+    server.lock = threading.Lock()
+    server.endpoint = "http://localhost:{}".format(server.server_port)
+    threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    return server
@@ -0,0 +1,147 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+from backup import Backup, BackupError, DirectoryStore, S3Store, open_store, restore
+from s3 import S3Client
+from tests import s3_stand_in
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = pathlib.Path(tmpdir.name)
+        self.data = self.tmpdir / "data"
+        self.uploads = self.tmpdir / "uploads"
+        (self.uploads / ".thumbnails").mkdir(parents=True)
+        self.data.mkdir()
+        self.database = sqlite3.connect(str(self.data / "db.sql"))
+        self.addCleanup(self.database.close)
+        self.database.execute("PRAGMA journal_mode=wal")
+        self.database.execute("CREATE TABLE hive (id integer PRIMARY KEY, name varchar)")
+        self.database.executemany(
+            "INSERT INTO hive VALUES (?, ?)", [(n, "hive") for n in range(1, 101)]
+        )
+        self.database.commit()
+        (self.data / "open-apiary.log").write_text("GET /\n")
+        (self.uploads / "hive.jpg").write_bytes(os.urandom(3000))
+        # Same content as hive.jpg so its chunks are shared
+        (self.uploads / "copy.jpg").write_bytes((self.uploads / "hive.jpg").read_bytes())
+        (self.uploads / "notes.txt").write_text("queen spotted\n" * 200)
+        (self.uploads / ".thumbnails" / "hive.jpg").write_bytes(b"thumbnail")
+        self.store = DirectoryStore(str(self.tmpdir / "backups"))
+
+    def _backup(self, store=None) -> Backup:
+        backup = Backup(store or self.store, chunk_size=1024)
+        backup.run(
+            {"data": self.data, "uploads": self.uploads},
+            exclude={"data": ["open-apiary.log*"], "uploads": [".thumbnails"]},
+            database=("data", "db.sql"),
+        )
+        return backup
+
+    def test_backup(self):
+        """files are stored as deduplicated chunks listed in a manifest"""
+        backup = self._backup()
+        (manifest,) = self.store.list("manifests/")
+        manifest = json.loads(self.store.get(manifest))
+        self.assertEqual(sorted(manifest["storages"]["data"]), ["db.sql"])
+        self.assertEqual(
+            sorted(manifest["storages"]["uploads"]), ["copy.jpg", "hive.jpg", "notes.txt"]
+        )
+        uploads = manifest["storages"]["uploads"]
+        self.assertEqual(uploads["copy.jpg"]["chunks"], uploads["hive.jpg"]["chunks"])
+        self.assertEqual(len(uploads["hive.jpg"]["chunks"]), 3)
+        # Repeated text compresses, random photos are stored as they are
+        notes = self.store.get("chunks/{0[0]:.2}/{0[0]}".format(uploads["notes.txt"]["chunks"]))
+        self.assertEqual(notes[:1], b"z")
+        self.assertLess(len(notes), 100)
+        photo = self.store.get("chunks/{0[0]:.2}/{0[0]}".format(uploads["hive.jpg"]["chunks"]))
+        self.assertEqual(photo[:1], b"r")
+        self.assertEqual(backup.stats["files"], 4)
+        self.assertEqual(backup.stats["changed"], 4)
+
+    def test_incremental(self):
+        """only files changed since the last backup are read"""
+        self._backup()
+        (self.uploads / "new.jpg").write_bytes(os.urandom(500))
+        backup = self._backup()
+        # The new photo and the database snapshot
+        self.assertEqual(backup.stats["changed"], 2)
+        self.assertEqual(backup.stats["chunks"], 1)
+        self.assertEqual(len(self.store.list("manifests/")), 2)
+
+    def test_restore(self):
+        """storages are restored from the latest backup"""
+        self._backup()
+        self.database.execute("DELETE FROM hive")
+        self.database.commit()
+        self.database.close()
+        (self.uploads / "hive.jpg").write_bytes(b"damaged")
+        original = (self.uploads / "copy.jpg").read_bytes()
+        os.utime(self.uploads / "notes.txt", ns=(0, 0))
+
+        stats = restore(self.store, {"data": self.data, "uploads": self.uploads})
+        self.assertEqual(stats["files"], 4)
+        self.assertEqual(stats["restored"], 3)
+        self.assertEqual((self.uploads / "hive.jpg").read_bytes(), original)
+        database = sqlite3.connect(str(self.data / "db.sql"))
+        self.addCleanup(database.close)
+        self.assertEqual(database.execute("SELECT COUNT(*) FROM hive").fetchone(), (100,))
+        # Files not in the backup are kept
+        self.assertTrue((self.uploads / ".thumbnails" / "hive.jpg").exists())
+
+    def test_restore_corrupt_chunk(self):
+        """chunks are verified against their hash when restored"""
+        self._backup()
+        manifest = json.loads(self.store.get(self.store.list("manifests/")[0]))
+        digest = manifest["storages"]["uploads"]["notes.txt"]["chunks"][0]
+        chunk = self.tmpdir / "backups" / "chunks" / digest[:2] / digest
+        chunk.write_bytes(b"r" + b"corrupt")
+        os.unlink(self.uploads / "notes.txt")
+        with self.assertRaises(BackupError):
+            restore(self.store, {"uploads": self.uploads})
+        # Nothing is left behind by the failed restore
+        self.assertEqual(sorted(os.listdir(self.uploads)), [".thumbnails", "copy.jpg", "hive.jpg"])
+
+    def test_restore_without_backups(self):
+        """restoring from a target without backups fails"""
+        with self.assertRaises(BackupError):
+            restore(self.store, {"uploads": self.uploads})
+
+    def test_s3_store(self):
+        """backups are written to and restored from S3-compatible stores"""
+        server = s3_stand_in.start(page_size=3)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        store = open_store(
+            "s3://backups/open-apiary",
+            endpoint=server.endpoint,
+            access_key="access",
+            secret_key="secret",
+        )
+        self.assertIsInstance(store, S3Store)
+        self._backup(store)
+        self.assertTrue(all(key.startswith("open-apiary/") for key in server.objects))
+        os.unlink(self.uploads / "hive.jpg")
+        stats = restore(store, {"uploads": self.uploads})
+        self.assertEqual(stats["restored"], 1)
+        self.assertTrue((self.uploads / "hive.jpg").exists())
+
+    def test_open_store(self):
+        """targets are directories or s3:// URLs with an endpoint"""
+        self.assertIsInstance(open_store("/srv/backups"), DirectoryStore)
+        with self.assertRaises(BackupError):
+            open_store("backups")
+        with self.assertRaises(BackupError):
+            open_store("s3://bucket/prefix")
+        store = open_store("s3://bucket", endpoint="http://localhost:9000")
+        self.assertIsInstance(store.client, S3Client)
+        self.assertEqual(store.prefix, "")
@@ -0,0 +1,40 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+
+from tests import benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_benchmark_smoke(self):
+        """benchmark scenarios run and report machine readable results"""
+        results = benchmarks.run(
+            units=[1, 3], latency_ms=0, config_changes=2, token_changes=1
+        )
+        json.dumps(results)
+        self.assertEqual(
+            [(s["units"], s["role"]) for s in results["scenarios"]],
+            [(1, "leader"), (1, "follower"), (3, "leader"), (3, "follower")],
+        )
+        for scenario in results["scenarios"]:
+            steps = {step["step"]: step for step in scenario["steps"]}
+            self.assertEqual(
+                list(steps),
+                [
+                    "install",
+                    "leader-elected",
+                    "db-joined-changed",
+                    "config-changed",
+                    "peer-token-changed",
+                ],
+            )
+            self.assertGreater(steps["config-changed"]["events"], 0)
+            self.assertGreater(steps["config-changed"]["pebble-operations"], 0)
+
+    def test_startup(self):
+        """unhandled events exit well before the charm could be imported"""
+        results = benchmarks.startup(runs=3)
+        json.dumps(results)
+        self.assertLess(results["unhandled-event-seconds"], results["import-seconds"])
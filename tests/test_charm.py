@@ -5,16 +5,25 @@
 # peer relation testing
 # ingress testing and configuration option for hostname
 
+import http.server
 import io
 import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
 import unittest
 
-from unittest.mock import MagicMock, ANY
+from unittest.mock import MagicMock, ANY, PropertyMock, call, patch
 
-from charm import OpenApiaryCharm
-from ops.model import ActiveStatus
+from charm import CLUSTER_WRAPPER, OpenApiaryCharm
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
+from ops.pebble import CheckInfo, CheckLevel, CheckStatus
 from ops.testing import Harness
 
+from migration import SQLiteDatabase
+
 
 # Partial test fixture only
 NODE_VERSION_INFO = """
@@ -42,8 +51,33 @@ INCOMPLETE_MYSQL_DATA_BAG = {
 }
 
 
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the Open Apiary web application"""
+
+    status = 200
+
+    def do_GET(self):
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
 class TestCharm(unittest.TestCase):
     def setUp(self):
+        # Local HTTP stand-in for the workload readiness probe
+        self.server = http.server.HTTPServer(("localhost", 0), StandInHandler)
+        self.server.status = 200
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        ).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        port_patch = patch("charm.APP_PORT", self.server.server_port)
+        port_patch.start()
+        self.addCleanup(port_patch.stop)
+
         self.harness = Harness(OpenApiaryCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
@@ -55,6 +89,9 @@ class TestCharm(unittest.TestCase):
         # Use of a lambda here just makes sure everytime the pull method is
         # executed a new StringIO reader is created.
         container.pull.side_effect = lambda *args: io.StringIO(NODE_VERSION_INFO)
+        # Pebble checks are not implemented in test harness
+        container.get_checks = MagicMock(return_value={})
+        container.send_signal = MagicMock()
         self.addCleanup(container.push)
         self.addCleanup(container.pull)
         self.maxDiff = None
@@ -69,17 +106,28 @@ class TestCharm(unittest.TestCase):
                 "open-apiary": {
                     "override": "replace",
                     "summary": "open-apiary",
-                    "command": "/usr/local/bin/npm start",
+                    "command": "/usr/local/bin/node /opt/charm/cluster.js",
                     "startup": "enabled",
                     "environment": {
-                        "PORT": "3000",
+                        "PORT": str(self.server.server_port),
                         "DATA_PATH": "/data",
                         "UPLOAD_PATH": "/uploads",
-                        "LOG_DESTINATION": "/data/open-apiary.log",
+                        "LOG_DESTINATION": "/dev/stdout",
+                        "LOG_TARGET": "file",
+                        "LOG_FILE": "/data/open-apiary.log",
+                        "LOG_MAX_SIZE": "52428800",
+                        "LOG_ROTATE_INTERVAL": "86400000",
+                        "LOG_BACKUPS": "5",
+                        "LOG_BUFFER_SIZE": "1048576",
+                        "METRICS_PORT": "9101",
+                        "WARMUP_ROUTES": "/",
+                        "WARMUP_CONCURRENCY": "4",
+                        "WARMUP_TIMEOUT": "20000",
+                        "WARMUP_FILES": "/data/db.sql",
                         "LOG_LEVEL": "debug" if debug else "info",
                         "WEATHER_API_KEY": weather_token or "",
-                        "CONFIG_CHECKSUM": ANY,
                     },
+                    "on-check-failure": {"open-apiary-alive": "restart"},
                 }
             }
         }
@@ -97,16 +145,26 @@ class TestCharm(unittest.TestCase):
         updated_plan = self.harness.get_container_pebble_plan("open-apiary").to_dict()
         # Check we've got the plan we expected
         self.assertEqual(expected_plan, updated_plan)
-        # Check configuration file pushed to container
-        container.push.assert_called_once_with(
-            "/opt/app/config.json",
-            json.dumps(
-                self.harness.charm._open_apiary_config(),
-                sort_keys=True,
-                indent=2,
-            ),
-            make_dirs=True,
+        # Check configuration file and cluster wrapper pushed to container
+        container.push.assert_has_calls(
+            [
+                call(
+                    "/opt/app/config.json",
+                    json.dumps(
+                        self.harness.charm._open_apiary_config(),
+                        sort_keys=True,
+                        indent=2,
+                    ),
+                    make_dirs=True,
+                ),
+                call(CLUSTER_WRAPPER, ANY, make_dirs=True),
+                call("/opt/charm/logship.js", ANY, make_dirs=True),
+                call("/opt/charm/metrics.js", ANY, make_dirs=True),
+                call("/opt/charm/weather.js", ANY, make_dirs=True),
+                call("/opt/charm/warmup.js", ANY, make_dirs=True),
+            ]
         )
+        self.assertEqual(container.push.call_count, 6)
 
         # Check the service was started
         service = container.get_service("open-apiary")
@@ -125,6 +183,7 @@ class TestCharm(unittest.TestCase):
 
     def test_mysql_relation(self):
         """mysql-database relation test"""
+        self._lead_peers()
         relation_id = self.harness.add_relation("mysql-database", "mysql")
         self.harness.add_relation_unit(relation_id, "mysql/0")
 
@@ -133,7 +192,15 @@ class TestCharm(unittest.TestCase):
             relation_id, "mysql/0", INCOMPLETE_MYSQL_DATA_BAG
         )
         expected_oa_config = {
-            "db": {"database": "/data/db.sql", "type": "sqlite"},
+            "db": {
+                "database": "/data/db.sql",
+                "type": "sqlite",
+                "pragmas": {
+                    "busy_timeout": 5000,
+                    "journal_mode": "WAL",
+                    "synchronous": "NORMAL",
+                },
+            },
             "jwt": {"secret": ANY},
         }
         self.assertEqual(expected_oa_config, self.harness.charm._open_apiary_config())
@@ -158,3 +225,1324 @@ class TestCharm(unittest.TestCase):
         # TODO(jamespage)
         # write relation removal tests once Harness supports this
         # https://github.com/canonical/operator/pull/460
+
+    def test_reconcile_skips_unchanged_state(self):
+        """repeated hooks with no changes skip Pebble operations"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": True})
+        self.assertEqual(container.push.call_count, 6)
+        container.add_layer = MagicMock()
+        container.stop = MagicMock()
+
+        self.harness.charm.on.config_changed.emit()
+        self.assertEqual(container.push.call_count, 6)
+        container.add_layer.assert_not_called()
+        container.stop.assert_not_called()
+        self.assertIn("get-plan", self.harness.charm.reconciler.skipped)
+        self.assertIn(
+            "push:/opt/app/config.json", self.harness.charm.reconciler.skipped
+        )
+
+    def test_reconcile_applies_changed_state(self):
+        """only the components which changed are re-applied"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": False})
+        self.harness.update_config({"debug": True})
+        self.assertEqual(container.push.call_count, 6)
+        plan = self.harness.get_container_pebble_plan("open-apiary").to_dict()
+        self.assertEqual(
+            plan["services"]["open-apiary"]["environment"]["LOG_LEVEL"], "debug"
+        )
+        self.assertTrue(container.get_service("open-apiary").is_running())
+
+    def test_pebble_ready_invalidates_snapshot(self):
+        """a replaced container gets the full state pushed again"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": True})
+        self.harness.charm.on.open_apiary_pebble_ready.emit(container)
+        self.assertEqual(container.push.call_count, 12)
+
+    def test_workload_version_cached(self):
+        """package.json is only read after a restart or container change"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": True})
+        self.assertEqual(self.harness.get_workload_version(), "1.1.1")
+        package_pulls = [
+            c for c in container.pull.call_args_list
+            if c == call("/opt/app/package.json")
+        ]
+        self.assertEqual(len(package_pulls), 1)
+
+        container.pull.reset_mock()
+        self.harness.charm.on.config_changed.emit()
+        container.pull.assert_not_called()
+        self.assertIn(
+            "pull-package-info", self.harness.charm.reconciler.skipped
+        )
+
+        # A new image brings a new version
+        container.pull.side_effect = lambda *args: io.StringIO(
+            json.dumps({"name": "open-apiary", "version": "1.2.0"})
+        )
+        self.harness.charm.on.open_apiary_pebble_ready.emit(container)
+        container.pull.assert_any_call("/opt/app/package.json")
+        self.assertEqual(self.harness.get_workload_version(), "1.2.0")
+
+    def test_managed_files_unchanged_remote(self):
+        """files matching the container copy are not pushed again"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": True})
+        files = self.harness.charm._managed_files(
+            self.harness.charm._open_apiary_config()
+        )
+        contents = {f.path: f.content for f in files}
+        container.pull.side_effect = lambda path=None, *args: io.StringIO(
+            contents.get(path, NODE_VERSION_INFO)
+        )
+        container.push.reset_mock()
+        self.harness.charm.on.open_apiary_pebble_ready.emit(container)
+        container.push.assert_not_called()
+        self.assertIn(
+            "push:/opt/app/config.json", self.harness.charm.reconciler.skipped
+        )
+
+    def test_config_file_change_reloads(self):
+        """config file changes reload the workers rather than restarting"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": True})
+        container.stop = MagicMock()
+        container.start = MagicMock()
+        self.harness.update_config({"weather-api-token": "mytoken"})
+        container.stop.assert_called_once()
+        container.stop.reset_mock()
+
+        # Rotating the JWT secret only touches config.json
+        self._add_peers()
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.charm._rotate_jwt_token()
+        container.stop.assert_not_called()
+        container.send_signal.assert_called_with("SIGHUP", "open-apiary")
+
+    def test_config_file_change_restarts_npm(self):
+        """npm start cannot reload so config file changes restart"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"npm-start": True})
+        container.stop = MagicMock()
+        container.start = MagicMock()
+        self._add_peers()
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.charm._rotate_jwt_token()
+        container.stop.assert_called_once()
+        container.send_signal.assert_not_called()
+
+    def test_mysql_replicas(self):
+        """mysql-database units beyond the primary are used as read replicas"""
+        self._lead_peers()
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        for unit, host in (("mysql/0", "mysql-0"), ("mysql/1", "mysql-1")):
+            self.harness.add_relation_unit(relation_id, unit)
+            self.harness.update_relation_data(
+                relation_id, unit, dict(COMPLETE_MYSQL_DATA_BAG, host=host)
+            )
+        # Primary is taken from the unit advertising the role
+        self.harness.update_relation_data(relation_id, "mysql/1", {"role": "primary"})
+
+        db = self.harness.charm._open_apiary_config()["db"]
+        self.assertEqual(db["host"], "mysql-1")
+        self.assertEqual(db["replication"]["master"]["host"], "mysql-1")
+        self.assertEqual(
+            [r["host"] for r in db["replication"]["slaves"]], ["mysql-0"]
+        )
+
+        self.harness.remove_relation_unit(relation_id, "mysql/0")
+        db = self.harness.charm._open_apiary_config()["db"]
+        self.assertNotIn("replication", db)
+
+    def test_mysql_pool_options(self):
+        """connection pool options are rendered when configured"""
+        self._lead_peers()
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(relation_id, "mysql/0")
+        self.harness.update_relation_data(
+            relation_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG
+        )
+        self.harness.update_config(
+            {"db-pool-size": 20, "db-acquire-timeout": 10, "db-idle-timeout": 60}
+        )
+        db = self.harness.charm._open_apiary_config()["db"]
+        self.assertEqual(
+            db["extra"],
+            {"connectionLimit": 20, "acquireTimeout": 10000, "idleTimeout": 60000},
+        )
+
+    def test_sqlite_pragmas(self):
+        """SQLite tuning options are rendered as pragmas"""
+        self.harness.update_config(
+            {
+                "sqlite-synchronous": "full",
+                "sqlite-cache-size": 64,
+                "sqlite-mmap-size": 256,
+                "sqlite-busy-timeout": 10,
+            }
+        )
+        db = self.harness.charm._open_apiary_config()["db"]
+        self.assertEqual(
+            db["pragmas"],
+            {
+                "journal_mode": "WAL",
+                "synchronous": "FULL",
+                "cache_size": -65536,
+                "mmap_size": 268435456,
+                "busy_timeout": 10000,
+            },
+        )
+
+    def test_sqlite_invalid_config(self):
+        """invalid SQLite options block the unit"""
+        self.harness.update_config({"sqlite-journal-mode": "fast"})
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+        self.assertIn("sqlite-journal-mode", self.harness.model.unit.status.message)
+        self.assertNotIn(
+            "journal_mode", self.harness.charm._open_apiary_config()["db"]["pragmas"]
+        )
+
+    def test_sqlite_single_unit(self):
+        """units not owning the SQLite database stay out of service"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        peers_id = self._add_peers("open-apiary/1", database_unit="open-apiary/1")
+        self.harness.update_config({"debug": True})
+        self.assertFalse(container.get_service("open-apiary").is_running())
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+
+        # Scaling out is possible once a MySQL database is related and the
+        # leader has recorded that the SQLite data was migrated
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(relation_id, "mysql/0")
+        self.harness.update_relation_data(
+            relation_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG
+        )
+        self.assertFalse(container.get_service("open-apiary").is_running())
+        migration_key = self.harness.charm._migration_key
+        self.assertEqual(migration_key, "mysql/testdatabase")
+        with self.harness.hooks_disabled():
+            self.harness.update_relation_data(
+                peers_id,
+                "open-apiary",
+                {"mysql-migration": json.dumps({"database": migration_key, "migrated": True})},
+            )
+        # Harness does not emit relation-changed for the local application
+        relation = self.harness.model.get_relation("apiary", peers_id)
+        self.harness.charm.on["apiary"].relation_changed.emit(relation, relation.app)
+        self.assertTrue(container.get_service("open-apiary").is_running())
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_mysql_migration_shared(self):
+        """the leader records the migration reported by the database owner"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        relation_id = self._lead_peers("open-apiary/1", database_unit="open-apiary/1")
+        self.harness.update_relation_data(relation_id, "open-apiary/1", {"sqlite-data": "true"})
+        mysql_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(mysql_id, "mysql/0")
+        self.harness.update_relation_data(mysql_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG)
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        migration = json.loads(app_data["mysql-migration"])
+        self.assertFalse(migration["migrated"])
+        self.assertFalse(container.get_service("open-apiary").is_running())
+
+        # The owner migrates its data and every unit switches to MySQL
+        self.harness.update_relation_data(
+            relation_id, "open-apiary/1", {"mysql-migrated": migration["database"]}
+        )
+        self.assertTrue(json.loads(app_data["mysql-migration"])["migrated"])
+        self.assertEqual(
+            self.harness.charm._open_apiary_config()["db"]["type"], "mysql"
+        )
+        self.assertTrue(container.get_service("open-apiary").is_running())
+
+    def test_sqlite_database_owner_kept(self):
+        """the leader does not take over a database owned by a peer"""
+        relation_id = self._add_peers("open-apiary/1", database_unit="open-apiary/1")
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.update_config({"debug": True})
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+
+        # The owner has gone so the leader claims the database
+        self.harness.remove_relation_unit(relation_id, "open-apiary/1")
+        self.harness.update_config({"debug": False})
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "open-apiary")["database-unit"],
+            "open-apiary/0",
+        )
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def _mock_sqlite_exec(self, container) -> None:
+        """Mock Pebble exec and the database file size"""
+        container.exec = MagicMock()
+        container.list_files = MagicMock(
+            side_effect=[[MagicMock(size=4096)], [MagicMock(size=1024)]]
+        )
+
+    def test_sqlite_maintenance_action(self):
+        """VACUUM and ANALYZE are run on the SQLite database"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"debug": True})
+        self._mock_sqlite_exec(container)
+        event = MagicMock()
+        self.harness.charm._on_sqlite_maintenance_action(event)
+        command = container.exec.call_args[0][0]
+        self.assertEqual(command[0], "sqlite3")
+        self.assertEqual(command[-2:], ["/data/db.sql", "VACUUM; ANALYZE;"])
+        container.exec.return_value.wait_output.assert_called_once_with()
+        event.set_results.assert_called_once_with(
+            {"size-before": "4096", "size-after": "1024", "seconds": ANY}
+        )
+
+    def _sqlite_data(self) -> pathlib.Path:
+        """SQLite database holding records on the data storage"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = SQLiteDatabase.open(os.path.join(tmpdir.name, "db.sql"))
+        db.execute("CREATE TABLE hive (id integer PRIMARY KEY, name varchar)")
+        db.insert("hive", ["id", "name"], [(n, "hive") for n in range(1, 6)])
+        db.commit()
+        db.close()
+        path_patch = patch.object(
+            OpenApiaryCharm,
+            "_sqlite_path",
+            new_callable=PropertyMock,
+            return_value=pathlib.Path(tmpdir.name) / "db.sql",
+        )
+        path_patch.start()
+        self.addCleanup(path_patch.stop)
+        return pathlib.Path(tmpdir.name)
+
+    def test_migrate_to_mysql(self):
+        """SQLite data is migrated before Open Apiary switches to MySQL"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        data = self._sqlite_data()
+        self._lead_peers()
+        self.harness.update_config({"debug": True})
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(relation_id, "mysql/0")
+        self.harness.update_relation_data(
+            relation_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG
+        )
+        self.assertEqual(
+            self.harness.charm._open_apiary_config()["db"]["type"], "sqlite"
+        )
+        self.assertEqual(
+            self.harness.model.unit.status.message,
+            "Run migrate-to-mysql to move data to MySQL",
+        )
+
+        # A second SQLite database stands in for MySQL
+        target_path = str(data / "target.sql")
+        event = MagicMock()
+        event.params = {"chunk-size": 2, "batch-size": 2, "online": False}
+        container.stop = MagicMock(wraps=container.stop)
+        with patch(
+            "migration.MySQLDatabase.connect",
+            side_effect=lambda *args: SQLiteDatabase.open(target_path),
+        ) as connect:
+            self.harness.charm._on_migrate_to_mysql_action(event)
+        connect.assert_called_once_with(
+            "mysql-db-server", 3306, "testuser", "foobar", "testdatabase"
+        )
+        event.fail.assert_not_called()
+        event.set_results.assert_called_once_with(
+            {"rows": "5", "seconds": ANY, "rows-per-second": ANY}
+        )
+        self.assertEqual(event.log.call_count, 3)
+        container.stop.assert_called_once_with("open-apiary")
+        target = SQLiteDatabase.open(target_path)
+        self.addCleanup(target.close)
+        self.assertEqual(target.count("hive"), 5)
+
+        # Switched over to MySQL and restarted
+        self.assertEqual(
+            self.harness.charm._open_apiary_config()["db"]["type"], "mysql"
+        )
+        self.assertTrue(container.get_service("open-apiary").is_running())
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_migrated_stays_on_mysql(self):
+        """migrated data is not served from SQLite when the MySQL primary changes"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        data = self._sqlite_data()
+        self._lead_peers()
+        self.harness.update_config({"debug": True})
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        for unit, host in (("mysql/0", "mysql-0"), ("mysql/1", "mysql-1")):
+            self.harness.add_relation_unit(relation_id, unit)
+            self.harness.update_relation_data(
+                relation_id, unit, dict(COMPLETE_MYSQL_DATA_BAG, host=host)
+            )
+        event = MagicMock()
+        event.params = {"chunk-size": 2, "batch-size": 2, "online": False}
+        with patch(
+            "migration.MySQLDatabase.connect",
+            side_effect=lambda *args: SQLiteDatabase.open(str(data / "target.sql")),
+        ):
+            self.harness.charm._on_migrate_to_mysql_action(event)
+        event.fail.assert_not_called()
+
+        self.harness.remove_relation_unit(relation_id, "mysql/0")
+        db = self.harness.charm._open_apiary_config()["db"]
+        self.assertEqual((db["type"], db["host"]), ("mysql", "mysql-1"))
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+        # Without MySQL the unit stops rather than serving stale SQLite data
+        self.harness.remove_relation(relation_id)
+        self.assertFalse(container.get_service("open-apiary").is_running())
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("Data was migrated to MySQL mysql/testdatabase; relate to it to serve"),
+        )
+
+    def test_empty_sqlite_not_migrated(self):
+        """a SQLite database without rows does not need migrating"""
+        data = self._sqlite_data()
+        db = SQLiteDatabase.open(str(data / "db.sql"))
+        db.execute("DELETE FROM hive")
+        db.commit()
+        db.close()
+        self._lead_peers()
+        self.harness.update_config({"debug": True})
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(relation_id, "mysql/0")
+        self.harness.update_relation_data(relation_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG)
+        self.assertEqual(
+            self.harness.charm._open_apiary_config()["db"]["type"], "mysql"
+        )
+
+    def test_migrate_to_mysql_failure(self):
+        """Open Apiary carries on with SQLite when migration fails"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self._sqlite_data()
+        self._lead_peers()
+        self.harness.update_config({"debug": True})
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(relation_id, "mysql/0")
+        self.harness.update_relation_data(
+            relation_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG
+        )
+        event = MagicMock()
+        event.params = {"chunk-size": 2, "batch-size": 2, "online": True}
+        with patch("migration.MySQLDatabase.connect", side_effect=OSError("refused")):
+            self.harness.charm._on_migrate_to_mysql_action(event)
+        event.fail.assert_called_once_with("Migration to MySQL failed: refused")
+        self.assertEqual(
+            self.harness.charm._open_apiary_config()["db"]["type"], "sqlite"
+        )
+        self.assertTrue(container.get_service("open-apiary").is_running())
+
+    def test_sqlite_maintenance_action_mysql(self):
+        """maintenance is refused when using MySQL"""
+        self._lead_peers()
+        relation_id = self.harness.add_relation("mysql-database", "mysql")
+        self.harness.add_relation_unit(relation_id, "mysql/0")
+        self.harness.update_relation_data(
+            relation_id, "mysql/0", COMPLETE_MYSQL_DATA_BAG
+        )
+        event = MagicMock()
+        self.harness.charm._on_sqlite_maintenance_action(event)
+        event.fail.assert_called_once()
+
+    @patch("time.time")
+    def test_update_status_sqlite_maintenance(self, mock_time):
+        """maintenance runs during update-status once the interval passes"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        mock_time.return_value = 1000000.0
+        self.harness.update_config({"sqlite-maintenance-interval": 24})
+        self._mock_sqlite_exec(container)
+        self.harness.charm.on.update_status.emit()
+        container.exec.assert_called_once()
+
+        mock_time.return_value += 3600
+        self.harness.charm.on.update_status.emit()
+        container.exec.assert_called_once()
+
+    def _add_peers(self, *units: str, database_unit: str = "open-apiary/0") -> int:
+        """Add the apiary peer relation with the provided remote units
+
+        This unit owns the SQLite database unless database_unit says otherwise.
+        """
+        relation_id = self.harness.add_relation("apiary", "open-apiary")
+        with self.harness.hooks_disabled():
+            self.harness.update_relation_data(
+                relation_id, "open-apiary", {"database-unit": database_unit}
+            )
+        for unit in units:
+            self.harness.add_relation_unit(relation_id, unit)
+        return relation_id
+
+    def _lead_peers(self, *units: str, database_unit: str = "open-apiary/0") -> int:
+        """Add the apiary peer relation with this unit as leader
+
+        The leader records whether SQLite data must be migrated to MySQL.
+        """
+        relation_id = self._add_peers(*units, database_unit=database_unit)
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        return relation_id
+
+    def _backup_storages(self) -> dict:
+        """Data and uploads storages holding a database and a photo"""
+        paths = {}
+        for name in ("data", "uploads"):
+            self.harness.add_storage(name)
+            paths[name] = self.harness.model.storages[name][0].location
+            paths[name].mkdir(parents=True, exist_ok=True)
+        db = SQLiteDatabase.open(str(paths["data"] / "db.sql"))
+        db.execute("CREATE TABLE hive (id integer PRIMARY KEY, name varchar)")
+        db.insert("hive", ["id", "name"], [(n, "hive") for n in range(1, 6)])
+        db.commit()
+        db.close()
+        (paths["uploads"] / "hive.jpg").write_bytes(b"\xff\xd8photo")
+        return paths
+
+    def test_backup_action(self):
+        """storages are backed up without stopping Open Apiary"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self._backup_storages()
+        self.harness.update_config({"debug": True})
+        target = tempfile.TemporaryDirectory()
+        self.addCleanup(target.cleanup)
+        container.stop = MagicMock(wraps=container.stop)
+        event = MagicMock()
+        event.params = {
+            "target": target.name,
+            "storages": "data,uploads",
+            "chunk-size": 4096,
+            "compression": 6,
+        }
+        self.harness.charm._on_backup_action(event)
+        event.fail.assert_not_called()
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["files"], "2")
+        self.assertEqual(
+            os.listdir(os.path.join(target.name, "manifests")),
+            ["{}.json".format(results["backup"])],
+        )
+        container.stop.assert_not_called()
+
+        event.params["storages"] = "data,logs"
+        self.harness.charm._on_backup_action(event)
+        event.fail.assert_called_once_with("Unknown storage logs")
+
+    def test_restore_action(self):
+        """Open Apiary is stopped while the data storage is restored"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        paths = self._backup_storages()
+        self.harness.update_config({"debug": True})
+        target = tempfile.TemporaryDirectory()
+        self.addCleanup(target.cleanup)
+        event = MagicMock()
+        event.params = {
+            "target": target.name,
+            "storages": "data,uploads",
+            "chunk-size": 4096,
+            "compression": 6,
+        }
+        self.harness.charm._on_backup_action(event)
+
+        (paths["uploads"] / "hive.jpg").unlink()
+        (paths["data"] / "db.sql").write_bytes(b"damaged")
+        (paths["data"] / "db.sql-wal").write_bytes(b"stale")
+        container.stop = MagicMock(wraps=container.stop)
+        event = MagicMock()
+        event.params = {"target": target.name, "storages": "data,uploads"}
+        self.harness.charm._on_restore_action(event)
+        event.fail.assert_not_called()
+        event.set_results.assert_called_once_with(
+            {
+                "backup": ANY,
+                "files": "2",
+                "restored": "2",
+                "bytes-written": ANY,
+                "seconds": ANY,
+            }
+        )
+        container.stop.assert_called_once_with("open-apiary")
+        self.assertTrue(container.get_service("open-apiary").is_running())
+        self.assertEqual((paths["uploads"] / "hive.jpg").read_bytes(), b"\xff\xd8photo")
+        self.assertFalse((paths["data"] / "db.sql-wal").exists())
+        db = SQLiteDatabase.open(str(paths["data"] / "db.sql"))
+        self.addCleanup(db.close)
+        self.assertEqual(db.count("hive"), 5)
+
+        # Uploads are restored without stopping Open Apiary
+        event = MagicMock()
+        event.params = {"target": target.name, "storages": "uploads"}
+        self.harness.charm._on_restore_action(event)
+        event.fail.assert_not_called()
+        container.stop.assert_called_once()
+
+    def test_leader_grants_restart_slots(self):
+        """leader grants restart slots up to the configured concurrency"""
+        relation_id = self._add_peers("open-apiary/1", "open-apiary/2")
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        for unit in ("open-apiary/1", "open-apiary/2"):
+            self.harness.update_relation_data(
+                relation_id, unit, {"restart-request": "abc"}
+            )
+        grants = json.loads(
+            self.harness.get_relation_data(relation_id, "open-apiary")[
+                "restart-grants"
+            ]
+        )
+        self.assertEqual(grants, {"open-apiary/1": "abc"})
+
+        # Slot is released and handed to the next unit on completion
+        self.harness.update_relation_data(
+            relation_id, "open-apiary/1", {"restart-done": "abc"}
+        )
+        grants = json.loads(
+            self.harness.get_relation_data(relation_id, "open-apiary")[
+                "restart-grants"
+            ]
+        )
+        self.assertEqual(grants, {"open-apiary/2": "abc"})
+
+    def test_leader_keeps_minimum_units_available(self):
+        """no slots are granted when capacity would drop below the minimum"""
+        relation_id = self._add_peers("open-apiary/1", "open-apiary/2")
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.update_config({"min-available-units": 3})
+        self.harness.update_relation_data(
+            relation_id, "open-apiary/1", {"restart-request": "abc"}
+        )
+        self.assertNotIn(
+            "restart-grants",
+            self.harness.get_relation_data(relation_id, "open-apiary"),
+        )
+
+    def test_restart_waits_for_slot(self):
+        """running units wait for a restart slot before restarting"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        relation_id = self._add_peers("open-apiary/1")
+        self.harness.update_config({"debug": True})
+        self.assertTrue(container.get_service("open-apiary").is_running())
+
+        container.stop = MagicMock(wraps=container.stop)
+        self.harness.update_config({"debug": False})
+        container.stop.assert_not_called()
+        self.assertEqual(
+            self.harness.model.unit.status, WaitingStatus("Waiting for restart slot")
+        )
+        unit_data = self.harness.get_relation_data(relation_id, "open-apiary/0")
+        nonce = unit_data["restart-request"]
+
+        # Leader grants the slot to this unit
+        self.harness.update_relation_data(
+            relation_id,
+            "open-apiary",
+            {"restart-grants": json.dumps({"open-apiary/0": nonce})},
+        )
+        container.stop.assert_called_once_with("open-apiary")
+        self.assertEqual(unit_data["restart-done"], nonce)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_restart_debounce(self):
+        """a burst of changes is applied with a single restart once settled"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"restart-debounce": 60})
+        self.assertTrue(container.get_service("open-apiary").is_running())
+
+        container.stop = MagicMock(wraps=container.stop)
+        self.harness.update_config({"debug": True})
+        self.harness.update_config({"weather-api-token": "mytoken"})
+        self.harness.charm.on.update_status.emit()
+        container.stop.assert_not_called()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("Waiting for changes to settle before restarting"),
+        )
+
+        self.harness.charm._stored.restart_changed_at -= 60
+        self.harness.charm.on.update_status.emit()
+        container.stop.assert_called_once_with("open-apiary")
+        environment = self.harness.get_container_pebble_plan("open-apiary").to_dict()[
+            "services"
+        ]["open-apiary"]["environment"]
+        self.assertEqual(environment["WEATHER_API_KEY"], "mytoken")
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        self.assertEqual(
+            self.harness.charm._stored.counters["restarts:config-changed"], 1
+        )
+
+    def test_reload_debounce(self):
+        """a burst of config file changes is applied with a single reload"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self._add_peers()
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.update_config({"restart-debounce": 60})
+        container.stop = MagicMock(wraps=container.stop)
+        self.harness.charm._rotate_jwt_token()
+        self.harness.charm._rotate_jwt_token()
+        self.harness.charm.on.update_status.emit()
+        container.send_signal.assert_not_called()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("Waiting for changes to settle before reloading"),
+        )
+
+        self.harness.charm._stored.restart_changed_at -= 60
+        self.harness.charm.on.update_status.emit()
+        container.send_signal.assert_called_once_with("SIGHUP", "open-apiary")
+        container.stop.assert_not_called()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_load_reported_to_peers(self):
+        """each unit publishes its load at most once per interval"""
+        relation_id = self._add_peers("open-apiary/1")
+        self.harness.update_config({"debug": True})
+        now = time.time()
+        baseline = {"at": now - 120, "requests": 0, "buckets": [[0.1, 0]], "cpu": 0.0}
+        current = {"at": now, "requests": 600, "buckets": [[0.1, 600]], "cpu": 60.0}
+        samples = [dict(baseline, cpus=1.0, lag=0.0), dict(current, cpus=1.0, lag=0.005)]
+        unit_data = self.harness.get_relation_data(relation_id, "open-apiary/0")
+        with patch("load.fetch_sample", side_effect=samples) as fetch_sample:
+            # The first sample is the baseline for the next report
+            self.harness.charm.on.update_status.emit()
+            self.assertNotIn("load", unit_data)
+            self.harness.charm.on.update_status.emit()
+            report = json.loads(unit_data["load"])
+            self.assertEqual(report["rps"], 5.0)
+            self.assertEqual(report["p95"], 100.0)
+            self.assertEqual(report["cpu"], 50.0)
+            self.assertEqual(report["lag"], 5.0)
+            # Not sampled again within the interval
+            self.harness.charm.on.update_status.emit()
+            self.assertEqual(fetch_sample.call_count, 2)
+
+    @patch("time.time")
+    def test_load_published_on_change(self, mock_time):
+        """unchanged load is not republished until it grows old"""
+        mock_time.return_value = 1000000.0
+        relation_id = self._add_peers("open-apiary/1")
+        unit_data = self.harness.get_relation_data(relation_id, "open-apiary/0")
+        load = {"rps": 5.0, "p95": 100.0, "cpu": 50.0, "lag": 5.0}
+        self.harness.charm.apiary.set_load(load, refresh=450)
+        published = unit_data["load"]
+
+        mock_time.return_value += 60
+        self.harness.charm.apiary.set_load(dict(load, rps=5.2, cpu=53.0), refresh=450)
+        self.assertEqual(unit_data["load"], published)
+        self.harness.charm.apiary.set_load(dict(load, rps=8.0), refresh=450)
+        self.assertEqual(json.loads(unit_data["load"])["rps"], 8.0)
+        published = unit_data["load"]
+
+        mock_time.return_value += 450
+        self.harness.charm.apiary.set_load(dict(load, rps=8.0), refresh=450)
+        self.assertNotEqual(unit_data["load"], published)
+
+    def test_token_available_on_change(self):
+        """peers only reconcile when the JWT token changes"""
+        relation_id = self._add_peers("open-apiary/1")
+        self.harness.update_config({"debug": True})
+        with self.harness.hooks_disabled():
+            self.harness.update_relation_data(
+                relation_id, "open-apiary", {"jwt-token": "mytoken"}
+            )
+        with patch.object(OpenApiaryCharm, "_reconcile") as reconcile:
+            self.harness.update_relation_data(relation_id, "open-apiary/1", {"load": "{}"})
+            reconcile.assert_called()
+            self.assertEqual(self.harness.charm._stored.jwt_token, "mytoken")
+            # Load reports from peers do not cause a reconcile
+            reconcile.reset_mock()
+            self.harness.update_relation_data(relation_id, "open-apiary/1", {"load": "{ }"})
+            reconcile.assert_not_called()
+
+    def test_scaling_recommendation(self):
+        """the leader recommends scaling once the load persists"""
+        relation_id = self._add_peers("open-apiary/1", "open-apiary/2")
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.update_config({"debug": True, "scale-hysteresis": 2})
+
+        def report(rps):
+            load = {"rps": rps, "p95": 50.0, "cpu": 10.0, "lag": 1.0, "at": time.time()}
+            with self.harness.hooks_disabled():
+                for unit in ("open-apiary/1", "open-apiary/2"):
+                    self.harness.update_relation_data(
+                        relation_id, unit, {"load": json.dumps(load)}
+                    )
+            self.harness.charm.on.update_status.emit()
+
+        with patch("load.fetch_sample", return_value=None):
+            report(80.0)
+            self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+            report(80.0)
+            self.assertEqual(
+                self.harness.model.unit.status, ActiveStatus("Load high: scale to 4 unit(s)")
+            )
+            # A single evaluation within the thresholds keeps the recommendation
+            report(40.0)
+            self.assertEqual(
+                self.harness.model.unit.status, ActiveStatus("Load high: scale to 4 unit(s)")
+            )
+            report(40.0)
+            self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+            report(5.0)
+            report(5.0)
+            self.assertEqual(
+                self.harness.model.unit.status, ActiveStatus("Load low: scale to 2 unit(s)")
+            )
+
+        event = MagicMock()
+        self.harness.charm._on_scaling_recommendation_action(event)
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["recommendation"], "down")
+        self.assertEqual(results["suggested-units"], "2")
+        self.assertEqual(json.loads(results["load"])["rps"], 5.0)
+        self.assertEqual(
+            sorted(json.loads(results["reports"])), ["open-apiary/1", "open-apiary/2"]
+        )
+
+        # Without thresholds there is nothing to recommend scaling against
+        self.harness.update_config(
+            {"scale-up-rps": 0, "scale-up-latency": 0, "scale-up-cpu": 0, "scale-up-lag": 0}
+        )
+        with patch("load.fetch_sample", return_value=None):
+            report(5.0)
+            report(5.0)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def _elect_leader(self) -> int:
+        """Elect this unit leader with the peer and ingress relations in place"""
+        relation_id = self._add_peers("open-apiary/1")
+        self.harness.add_relation("ingress", "nginx-ingress-integrator")
+        self.harness.set_leader(True)
+        return relation_id
+
+    def test_leader_elected_keeps_jwt_token(self):
+        """leadership changes share but do not regenerate the JWT token"""
+        jwt_token = self.harness.charm._stored.jwt_token
+        relation_id = self._elect_leader()
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertEqual(app_data["jwt-token"], jwt_token)
+
+        self.harness.set_leader(False)
+        self.harness.set_leader(True)
+        self.assertEqual(app_data["jwt-token"], jwt_token)
+        self.assertNotIn("jwt-token-previous", app_data)
+
+    def test_rotate_jwt_secret_action(self):
+        """rotation retains the previous token for the overlap window"""
+        jwt_token = self.harness.charm._stored.jwt_token
+        self._elect_leader()
+        event = MagicMock()
+        self.harness.charm._on_rotate_jwt_secret_action(event)
+        event.set_results.assert_called_once_with({"rotated-at": ANY})
+
+        jwt_config = self.harness.charm._open_apiary_config()["jwt"]
+        self.assertNotEqual(jwt_config["secret"], jwt_token)
+        self.assertEqual(jwt_config["previousSecrets"], [jwt_token])
+
+    def test_rotate_jwt_secret_npm_start(self):
+        """npm-start reports that sessions end on rotation"""
+        self._elect_leader()
+        self.harness.update_config({"npm-start": True})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        with self.assertLogs(level="WARNING"):
+            self.harness.charm._on_rotate_jwt_secret_action(MagicMock())
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("Sessions signed before the JWT rotation need to log in again"),
+        )
+
+    def test_rotate_jwt_secret_action_not_leader(self):
+        """rotation is refused on non-leader units"""
+        event = MagicMock()
+        self.harness.charm._on_rotate_jwt_secret_action(event)
+        event.fail.assert_called_once()
+
+    @patch("time.time")
+    def test_update_status_expires_previous_token(self, mock_time):
+        """previous token is dropped once the overlap window has passed"""
+        mock_time.return_value = 1000.0
+        relation_id = self._elect_leader()
+        self.harness.charm._on_rotate_jwt_secret_action(MagicMock())
+
+        self.harness.charm.on.update_status.emit()
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertIn("jwt-token-previous", app_data)
+
+        mock_time.return_value = 1000.0 + 24 * 3600
+        self.harness.charm.on.update_status.emit()
+        self.assertNotIn("jwt-token-previous", app_data)
+        self.assertNotIn("previousSecrets", self.harness.charm._open_apiary_config()["jwt"])
+
+    @patch("time.time")
+    def test_update_status_scheduled_rotation(self, mock_time):
+        """JWT token is rotated once the rotation interval has elapsed"""
+        mock_time.return_value = 1000.0
+        relation_id = self._elect_leader()
+        self.harness.update_config({"jwt-rotation-interval": 1})
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        jwt_token = app_data["jwt-token"]
+
+        mock_time.return_value = 1000.0 + 3600
+        self.harness.charm.on.update_status.emit()
+        self.assertNotEqual(app_data["jwt-token"], jwt_token)
+        self.assertEqual(app_data["jwt-token-previous"], jwt_token)
+
+    def test_layer_node_tuning(self):
+        """node runtime tuning options are rendered into the layer"""
+        self.harness.update_config(
+            {
+                "node-workers": 4,
+                "node-max-old-space-size": 512,
+                "uv-threadpool-size": 16,
+            }
+        )
+        service = self.harness.charm._open_apiary_layer()["services"]["open-apiary"]
+        self.assertEqual(service["command"], "/usr/local/bin/node /opt/charm/cluster.js")
+        self.assertEqual(service["environment"]["APP_WORKERS"], "4")
+        self.assertEqual(
+            service["environment"]["NODE_OPTIONS"], "--max-old-space-size=512"
+        )
+        self.assertEqual(service["environment"]["UV_THREADPOOL_SIZE"], "16")
+
+    def test_layer_logging(self):
+        """logs are shipped to stdout when configured"""
+        self.harness.update_config({"log-target": "stdout", "log-max-size": 10})
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertEqual(environment["LOG_DESTINATION"], "/dev/stdout")
+        self.assertEqual(environment["LOG_TARGET"], "stdout")
+        self.assertEqual(environment["LOG_MAX_SIZE"], "10485760")
+
+        self.harness.update_config({"npm-start": True})
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertEqual(environment["LOG_DESTINATION"], "/dev/stdout")
+        self.assertNotIn("LOG_TARGET", environment)
+
+    def test_layer_warmup(self):
+        """warm-up is configured in the layer and disabled without routes"""
+        self.harness.update_config(
+            {"warmup-routes": "/,/hives", "warmup-concurrency": 2, "warmup-timeout": 5}
+        )
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertEqual(environment["WARMUP_ROUTES"], "/,/hives")
+        self.assertEqual(environment["WARMUP_CONCURRENCY"], "2")
+        self.assertEqual(environment["WARMUP_TIMEOUT"], "5000")
+        self.assertEqual(environment["WARMUP_FILES"], "/data/db.sql")
+
+        self.harness.update_config({"warmup-routes": ""})
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertFalse([name for name in environment if name.startswith("WARMUP_")])
+
+    def test_log_invalid_config(self):
+        """invalid logging options block the unit"""
+        self.harness.update_config({"log-target": "syslog"})
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("Invalid log config: log-target must be one of file, stdout"),
+        )
+
+    def test_layer_npm_start(self):
+        """npm start runs a single process without the cluster wrapper"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        self.harness.update_config({"npm-start": True, "node-workers": 4})
+        service = self.harness.charm._open_apiary_layer()["services"]["open-apiary"]
+        self.assertEqual(service["command"], "/usr/local/bin/npm start")
+        self.assertNotIn("APP_WORKERS", service["environment"])
+        container.push.assert_called_once()
+
+    def test_layer_checks(self):
+        """layer defines tunable readiness and liveness checks"""
+        self.harness.update_config({"check-period": 5, "check-threshold": 2})
+        checks = self.harness.charm._open_apiary_layer()["checks"]
+        self.assertEqual(checks["open-apiary-ready"]["level"], "ready")
+        self.assertEqual(checks["open-apiary-ready"]["period"], "5s")
+        self.assertEqual(checks["open-apiary-ready"]["threshold"], 2)
+        self.assertEqual(
+            checks["open-apiary-ready"]["http"]["url"],
+            "http://localhost:{}/".format(self.server.server_port),
+        )
+        self.assertEqual(
+            checks["open-apiary-alive"]["tcp"]["port"], self.server.server_port
+        )
+
+    def test_waiting_until_ready(self):
+        """unit waits until the web application responds"""
+        self.server.status = 503
+        self.harness.update_config({"debug": True})
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("Waiting for Open Apiary to be ready"),
+        )
+
+        self.server.status = 200
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_waiting_on_failed_pebble_check(self):
+        """unit waits while a Pebble readiness check is down"""
+        container = self.harness.model.unit.get_container("open-apiary")
+        container.get_checks.return_value = {
+            "open-apiary-ready": CheckInfo(
+                "open-apiary-ready", CheckLevel.READY, CheckStatus.DOWN
+            )
+        }
+        self.harness.update_config({"debug": True})
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("Waiting for Open Apiary to be ready"),
+        )
+
+    def test_blocked_when_not_ready_after_timeout(self):
+        """a unit not ready long after its restart is reported as blocked"""
+        self.server.status = 503
+        self.harness.update_config({"readiness-timeout": 30})
+        self.assertIsInstance(self.harness.model.unit.status, WaitingStatus)
+        self.harness.charm._stored.restarted_at -= 60
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("Open Apiary not ready 60s after restart"),
+        )
+
+    def test_update_status_without_pebble(self):
+        """update-status waits for Pebble rather than failing"""
+        self.harness.update_config({"debug": True})
+        container = self.harness.model.unit.get_container("open-apiary")
+        container.can_connect = MagicMock(return_value=False)
+        container.get_checks.side_effect = ConnectionError
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("Waiting for Pebble in workload container"),
+        )
+
+    def test_restart_slot_held_until_ready(self):
+        """restart slot is only released once the unit is ready"""
+        relation_id = self._add_peers("open-apiary/1")
+        self.harness.update_config({"debug": True})
+        unit_data = self.harness.get_relation_data(relation_id, "open-apiary/0")
+        self.assertEqual(unit_data["ready"], "true")
+
+        self.server.status = 503
+        self.harness.update_config({"debug": False})
+        nonce = unit_data["restart-request"]
+        self.harness.update_relation_data(
+            relation_id,
+            "open-apiary",
+            {"restart-grants": json.dumps({"open-apiary/0": nonce})},
+        )
+        self.assertEqual(unit_data["ready"], "false")
+        self.assertNotIn("restart-done", unit_data)
+
+        self.server.status = 200
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(unit_data["ready"], "true")
+        self.assertEqual(unit_data["restart-done"], nonce)
+
+    def test_leader_counts_ready_units(self):
+        """units which are not ready do not count towards available capacity"""
+        relation_id = self._add_peers("open-apiary/1", "open-apiary/2")
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        self.harness.update_config({"min-available-units": 2})
+        self.harness.update_relation_data(
+            relation_id, "open-apiary/2", {"ready": "false"}
+        )
+        self.harness.update_relation_data(
+            relation_id, "open-apiary/1", {"restart-request": "abc"}
+        )
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "open-apiary").get(
+                "restart-grants", "{}"
+            ),
+            "{}",
+        )
+
+        self.harness.update_relation_data(
+            relation_id, "open-apiary/2", {"ready": "true"}
+        )
+        grants = json.loads(
+            self.harness.get_relation_data(relation_id, "open-apiary")[
+                "restart-grants"
+            ]
+        )
+        self.assertEqual(grants, {"open-apiary/1": "abc"})
+
+    def test_ingress_performance_profile(self):
+        """ingress relation carries the configured performance profile"""
+        self._elect_leader()
+        relation_id = self.harness.model.get_relation("ingress").id
+        self.harness.update_config(
+            {"ingress-limit-rps": 50, "ingress-path-routes": "/,/static,/uploads"}
+        )
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertEqual(app_data["service-hostname"], "open-apiary.juju")
+        self.assertEqual(app_data["max-body-size"], "20")
+        self.assertEqual(app_data["limit-rps"], "50")
+        self.assertEqual(app_data["path-routes"], "/,/static,/uploads")
+        # Peers are present so sessions are sticky
+        self.assertEqual(app_data["session-cookie-max-age"], "3600")
+
+    def test_thumbnails(self):
+        """thumbnails are generated in the tools container and routed"""
+        self._elect_leader()
+        relation_id = self.harness.model.get_relation("ingress").id
+        tools = self.harness.model.unit.get_container("tools")
+        self.harness.update_config({"debug": True})
+        self.assertFalse(tools.get_service("thumbnailer").is_running())
+
+        self.harness.update_config({"thumbnails": True, "thumbnail-cache-size": 64})
+        self.assertTrue(tools.get_service("thumbnailer").is_running())
+        plan = self.harness.get_container_pebble_plan("tools").to_dict()
+        self.assertEqual(
+            plan["services"]["thumbnailer"]["environment"]["THUMBNAIL_CACHE_SIZE"], "64"
+        )
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertEqual(environment["THUMBNAIL_URL"], "http://localhost:3001")
+        self.assertEqual(environment["THUMBNAIL_REDIRECT"], "1")
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertEqual(app_data["path-routes"], "/,/thumbnails")
+
+        self.harness.update_config({"ingress-path-routes": "/,/static"})
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertEqual(app_data["path-routes"], "/,/static,/thumbnails")
+
+        # The thumbnails ingress routes /thumbnails to the thumbnail service
+        thumbnails_id = self.harness.add_relation("thumbnails-ingress", "thumbnails-ingress")
+        self.harness.add_relation_unit(thumbnails_id, "thumbnails-ingress/0")
+        self.assertEqual(
+            self.harness.get_relation_data(thumbnails_id, "open-apiary"),
+            {
+                "service-hostname": "open-apiary.juju",
+                "service-name": "open-apiary-thumbnails",
+                "service-port": "3001",
+                "path-routes": "/thumbnails",
+            },
+        )
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "open-apiary")["path-routes"],
+            "/,/static",
+        )
+        self.assertEqual(
+            plan["services"]["thumbnailer"]["environment"]["THUMBNAIL_HOST"], "0.0.0.0"
+        )
+        self.harness.remove_relation(thumbnails_id)
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "open-apiary")["path-routes"],
+            "/,/static,/thumbnails",
+        )
+
+        self.harness.update_config({"thumbnail-redirect": False})
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertNotIn("THUMBNAIL_REDIRECT", environment)
+
+        self.harness.update_config({"thumbnails": False})
+        self.assertFalse(tools.get_service("thumbnailer").is_running())
+
+    def test_weather_cache(self):
+        """weather API requests are routed through the caching proxy"""
+        tools = self.harness.model.unit.get_container("tools")
+        self.harness.update_config({"weather-cache": True})
+        # Nothing to cache without an API token
+        self.assertFalse(tools.get_service("weather-proxy").is_running())
+
+        self.harness.update_config({"weather-api-token": "mytoken", "weather-cache-ttl": 300})
+        self.assertTrue(tools.get_service("weather-proxy").is_running())
+        plan = self.harness.get_container_pebble_plan("tools").to_dict()
+        self.assertEqual(
+            plan["services"]["weather-proxy"]["environment"]["WEATHER_CACHE_TTL"], "300"
+        )
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertEqual(environment["WEATHER_HOST"], "api.openweathermap.org")
+        self.assertEqual(environment["WEATHER_PROXY_URL"], "http://localhost:3002")
+
+        self.harness.update_config({"weather-cache": False})
+        self.assertFalse(tools.get_service("weather-proxy").is_running())
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertNotIn("WEATHER_PROXY_URL", environment)
+
+    def test_object_storage(self):
+        """uploads are shared through the related bucket"""
+        tools = self.harness.model.unit.get_container("tools")
+        self.harness.update_config({"thumbnails": True, "uploads-cache-size": 2048})
+        self.assertFalse(tools.get_service("uploads").is_running())
+
+        relation_id = self.harness.add_relation("object-storage", "s3-integrator")
+        self.harness.add_relation_unit(relation_id, "s3-integrator/0")
+        self.harness.update_relation_data(
+            relation_id, "s3-integrator", {"bucket": "open-apiary", "access-key": "access"}
+        )
+        # Waits for complete connection details
+        self.assertFalse(tools.get_service("uploads").is_running())
+        self.harness.update_relation_data(
+            relation_id,
+            "s3-integrator",
+            {"endpoint": "http://minio:9000", "secret-key": "secret", "path": "photos"},
+        )
+        self.assertTrue(tools.get_service("uploads").is_running())
+        plan = self.harness.get_container_pebble_plan("tools").to_dict()
+        environment = plan["services"]["uploads"]["environment"]
+        self.assertEqual(environment["S3_ENDPOINT"], "http://minio:9000")
+        self.assertEqual(environment["S3_BUCKET"], "open-apiary")
+        self.assertEqual(environment["S3_PREFIX"], "photos")
+        self.assertEqual(environment["S3_REGION"], "")
+        self.assertEqual(environment["UPLOADS_CACHE_SIZE"], "2048")
+        self.assertEqual(
+            plan["services"]["thumbnailer"]["environment"]["UPLOADS_URL"],
+            "http://localhost:3003",
+        )
+        self.assertEqual(
+            tools.pull("/opt/charm/s3.py").read(),
+            (pathlib.Path(__file__).parent.parent / "src" / "s3.py").read_text(),
+        )
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertEqual(environment["UPLOADS_URL"], "http://localhost:3003")
+
+        self.harness.remove_relation(relation_id)
+        self.assertFalse(tools.get_service("uploads").is_running())
+        environment = self.harness.charm._open_apiary_layer()["services"]["open-apiary"][
+            "environment"
+        ]
+        self.assertNotIn("UPLOADS_URL", environment)
+
+    def test_metrics_endpoint(self):
+        """the scrape job is published and the exporter started once related"""
+        tools = self.harness.model.unit.get_container("tools")
+        with self.harness.hooks_disabled():
+            self.harness.set_leader(True)
+        with patch("socket.getfqdn") as getfqdn:
+            self.harness.update_config({"debug": True})
+            getfqdn.assert_not_called()
+        self.assertFalse(tools.get_service("metrics-exporter").is_running())
+
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus")
+        self.harness.add_relation_unit(relation_id, "prometheus/0")
+        self.assertTrue(tools.get_service("metrics-exporter").is_running())
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertEqual(
+            json.loads(app_data["scrape_jobs"]),
+            [{"metrics_path": "/metrics", "static_configs": [{"targets": ["*:9100"]}]}],
+        )
+        self.assertEqual(json.loads(app_data["scrape_metadata"])["application"], "open-apiary")
+        unit_data = self.harness.get_relation_data(relation_id, "open-apiary/0")
+        self.assertEqual(unit_data["prometheus_scrape_unit_name"], "open-apiary/0")
+        self.assertIn("prometheus_scrape_unit_address", unit_data)
+
+    def test_charm_metrics(self):
+        """restarts, reloads and time not ready are counted for the exporter"""
+        tools = self.harness.model.unit.get_container("tools")
+        self.harness.update_config({"debug": True})
+        self.harness.update_config({"debug": False})
+        self.harness.update_config({"weather-api-token": "mytoken"})
+        # Changes to config.json are picked up with a reload
+        self.harness.charm._stored.jwt_token = "rotated"
+        self.harness.charm._reconcile()
+
+        self.server.status = 503
+        self.harness.charm.on.update_status.emit()
+        self.harness.charm._stored.not_ready_since -= 60
+        self.harness.charm.on.update_status.emit()
+        metrics = tools.pull("/opt/charm/charm.prom").read()
+        self.assertIn('open_apiary_charm_restarts_total{cause="config-changed"} 2\n', metrics)
+        self.assertIn("open_apiary_charm_reloads_total 1\n", metrics)
+        self.assertIn("open_apiary_charm_not_ready_seconds_total 60\n", metrics)
+        self.assertIn("open_apiary_charm_ready 0\n", metrics)
+
+    def test_ingress_invalid_config(self):
+        """invalid ingress config blocks the unit and is not written"""
+        self._elect_leader()
+        relation_id = self.harness.model.get_relation("ingress").id
+        self.harness.update_config({"ingress-path-routes": "uploads"})
+        app_data = self.harness.get_relation_data(relation_id, "open-apiary")
+        self.assertNotIn("path-routes", app_data)
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("Invalid ingress config: path-routes must start with /"),
+        )
+
+    def test_ingress_writes_changed_keys_only(self):
+        """only ingress keys whose values changed are written"""
+        self._elect_leader()
+        relation_id = self.harness.model.get_relation("ingress").id
+        backend = self.harness._backend
+        backend.relation_set = MagicMock(wraps=backend.relation_set)
+
+        self.harness.update_config({"external-hostname": "apiary.example.com"})
+        backend.relation_set.assert_called_once_with(
+            relation_id, "service-hostname", "apiary.example.com", True
+        )
+
+        # Unchanged fields are not re-written
+        backend.relation_set.reset_mock()
+        self.harness.charm._update_ingress(self.harness.charm._ingress_config())
+        backend.relation_set.assert_not_called()
+        self.assertEqual(
+            self.harness.charm.ingress.config_dict, self.harness.charm._ingress_config()
+        )
+
+        # Nor when the ingress relation changes
+        self.harness.update_relation_data(
+            relation_id, "nginx-ingress-integrator", {"ingress": "ready"}
+        )
+        backend.relation_set.assert_not_called()
+
+    def test_hook_profiling(self):
+        """enabled profiling records Pebble and relation operations"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profile = os.path.join(tmpdir, "profile.jsonl")
+            with patch("instrumentation.PROFILE_FILE", profile):
+                harness = Harness(OpenApiaryCharm)
+                self.addCleanup(harness.cleanup)
+                harness.update_config({"hook-profiling": True})
+                harness.begin()
+                container = harness.model.unit.get_container("open-apiary")
+                container.push(
+                    "/opt/app/package.json", NODE_VERSION_INFO, make_dirs=True
+                )
+                container.pebble.get_checks = MagicMock(return_value={})
+                harness.charm.on.config_changed.emit()
+                harness.framework.commit()
+
+                event = MagicMock()
+                harness.charm._on_profile_hooks_action(event)
+                results = event.set_results.call_args[0][0]
+                self.assertEqual(results["hooks"], "1")
+                profile = json.loads(results["profile"])
+                operations = profile["unknown"]["operations"]
+                self.assertEqual(operations["pebble.get_plan"]["calls-per-hook"], 1)
+                self.assertIn("pebble.pull", operations)
+                self.assertIn("relation.relation_ids", operations)
+
+    def test_hook_profiling_disabled(self):
+        """profiling is off by default and wraps nothing"""
+        self.assertIsNone(self.harness.charm.profiler)
+        event = MagicMock()
+        with patch("instrumentation.PROFILE_FILE", "/nonexistent/profile.jsonl"):
+            self.harness.charm._on_profile_hooks_action(event)
+        event.fail.assert_called_once()
@@ -0,0 +1,54 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import os
+import subprocess
+import sys
+import unittest
+
+from unittest.mock import patch
+
+from ops.testing import Harness
+
+import dispatch
+from charm import OpenApiaryCharm
+from tests.benchmarks import CHARM
+
+
+class TestDispatch(unittest.TestCase):
+    def test_dispatched_event(self):
+        """hooks and actions are named as ops names their events"""
+        for path, kind in (
+            ("hooks/update-status", "update_status"),
+            ("hooks/apiary-relation-changed", "apiary_relation_changed"),
+            ("actions/rotate-jwt-secret", "rotate_jwt_secret_action"),
+        ):
+            with patch.dict(os.environ, {"JUJU_DISPATCH_PATH": path}):
+                self.assertEqual(dispatch.dispatched_event(), kind)
+        with patch.dict(os.environ, {"JUJU_DISPATCH_PATH": ""}):
+            with patch.object(sys, "argv", ["/var/lib/juju/charm/hooks/install"]):
+                self.assertEqual(dispatch.dispatched_event(), "install")
+                self.assertFalse(dispatch.handled())
+
+    def test_handled_events_observed(self):
+        """the handled events are exactly those the charm observes"""
+        harness = Harness(OpenApiaryCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        emitter = harness.charm.on.handle.path
+        observed = {
+            kind for _, _, path, kind in harness.framework._observers if path == emitter
+        }
+        self.assertEqual(observed, dispatch.HANDLED_EVENTS)
+
+    def test_unhandled_event_skips_imports(self):
+        """unhandled events exit without importing ops"""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", str(CHARM)],
+            env=dict(os.environ, JUJU_DISPATCH_PATH="hooks/install"),
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        modules = [line.split("|")[-1].strip() for line in result.stderr.decode().splitlines()]
+        self.assertIn("dispatch", modules)
+        self.assertNotIn("ops", modules)
@@ -0,0 +1,71 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+
+from unittest.mock import MagicMock, patch
+
+import instrumentation
+
+
+class TestHookProfiler(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "profile.jsonl")
+
+    def test_wrap_counts_operations(self):
+        """wrapped methods are counted and timed"""
+        profiler = instrumentation.HookProfiler(self.path)
+        client = MagicMock()
+        client.push.return_value = "pushed"
+        profiler.wrap(client, ("push", "pull"), "pebble")
+
+        self.assertEqual(client.push("/a"), "pushed")
+        client.push("/b")
+        client.pull("/c")
+        record = profiler.record(hook="config-changed", skipped=3)
+        self.assertEqual(record["operations"]["pebble.push"]["count"], 2)
+        self.assertEqual(record["operations"]["pebble.pull"]["count"], 1)
+        self.assertEqual(record["skipped"], 3)
+        self.assertEqual(instrumentation.load_records(self.path), [record])
+
+    def test_rotation(self):
+        """profile file is rotated once it exceeds the maximum size"""
+        with patch.object(instrumentation, "PROFILE_MAX_BYTES", 1):
+            for _ in range(4):
+                instrumentation.HookProfiler(self.path).record(hook="update-status")
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        # Records beyond the retained backups are discarded
+        self.assertEqual(len(instrumentation.load_records(self.path)), 3)
+
+    def test_aggregate(self):
+        """records are aggregated into p50/p95 per hook type"""
+        records = [
+            {
+                "hook": "config-changed",
+                "duration": float(i),
+                "operations": {"pebble.push": {"count": 2, "duration": 0.5}},
+            }
+            for i in range(1, 21)
+        ]
+        summary = instrumentation.aggregate(records)["config-changed"]
+        self.assertEqual(summary["count"], 20)
+        self.assertEqual(summary["p50"], 10.0)
+        self.assertEqual(summary["p95"], 19.0)
+        self.assertEqual(summary["operations"]["pebble.push"]["calls-per-hook"], 2)
+
+    def test_hook_name(self):
+        """hook name is taken from the dispatch path"""
+        with patch.dict(os.environ, {"JUJU_DISPATCH_PATH": "hooks/config-changed"}):
+            self.assertEqual(instrumentation.hook_name(), "config-changed")
+
+    def test_profile_path(self):
+        """profiles are kept in the unit state directory, not the charm"""
+        path = instrumentation.profile_path("/var/lib/juju/agents/unit-open-apiary-0/charm")
+        self.assertEqual(
+            str(path), "/var/lib/juju/agents/unit-open-apiary-0/state/.hook-profile.jsonl"
+        )
@@ -0,0 +1,56 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import unittest
+
+from load import load_report, parse_metrics
+
+METRICS = """# TYPE open_apiary_http_requests_total counter
+open_apiary_http_requests_total{code="2xx"} 190
+open_apiary_http_requests_total{code="5xx"} 10
+open_apiary_http_request_duration_seconds_bucket{le="0.1"} 150
+open_apiary_http_request_duration_seconds_bucket{le="+Inf"} 200
+open_apiary_cpus 2
+"""
+
+
+def sample(at, requests, buckets, cpu, lag=0.0):
+    return {
+        "at": at,
+        "requests": requests,
+        "buckets": buckets,
+        "cpu": cpu,
+        "cpus": 2.0,
+        "lag": lag,
+    }
+
+
+class TestLoad(unittest.TestCase):
+    def test_parse_metrics(self):
+        """samples are keyed by name and labels, skipping comments"""
+        metrics = parse_metrics(METRICS)
+        self.assertEqual(metrics['open_apiary_http_requests_total{code="5xx"}'], 10)
+        self.assertEqual(metrics["open_apiary_cpus"], 2)
+        self.assertEqual(len(metrics), 5)
+
+    def test_load_report(self):
+        """load is reported over the interval between samples"""
+        previous = sample(100, 1000, [[0.1, 900], [0.5, 990], [1.0, 1000]], 10.0)
+        current = sample(110, 1200, [[0.1, 1000], [0.5, 1180], [1.0, 1200]], 15.0, 0.02)
+        self.assertEqual(
+            load_report(previous, current),
+            {"rps": 20.0, "p95": 500.0, "cpu": 25.0, "lag": 20.0},
+        )
+
+    def test_load_report_idle(self):
+        """no requests in the interval reports a p95 latency of zero"""
+        previous = sample(100, 1000, [[0.1, 1000]], 10.0)
+        current = sample(160, 1000, [[0.1, 1000]], 10.6)
+        self.assertEqual(load_report(previous, current)["p95"], 0.0)
+        self.assertEqual(load_report(previous, current)["cpu"], 0.5)
+
+    def test_load_report_after_restart(self):
+        """counters reset by a workload restart do not produce a report"""
+        previous = sample(100, 1000, [[0.1, 1000]], 10.0)
+        current = sample(110, 20, [[0.1, 20]], 0.5)
+        self.assertIsNone(load_report(previous, current))
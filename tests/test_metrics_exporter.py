@@ -0,0 +1,76 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import http.server
+import importlib.util
+import pathlib
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+SOURCE = pathlib.Path(__file__).parent.parent / "src" / "workload" / "metrics_exporter.py"
+spec = importlib.util.spec_from_file_location("metrics_exporter", SOURCE)
+metrics_exporter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(metrics_exporter)
+
+WORKLOAD_METRICS = """# TYPE open_apiary_workers gauge
+open_apiary_workers 2
+"""
+
+CHARM_METRICS = """# TYPE open_apiary_charm_reloads_total counter
+open_apiary_charm_reloads_total 3
+"""
+
+
+class WorkloadHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the metrics served by the cluster wrapper"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(WORKLOAD_METRICS.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def _serve(self, handler) -> str:
+        server = http.server.HTTPServer(("localhost", 0), handler)
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://localhost:{}/metrics".format(server.server_port)
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.charm_metrics = pathlib.Path(tmpdir.name) / "charm.prom"
+
+    def test_scrape(self):
+        """workload and charm metrics are combined in a single scrape"""
+        self.charm_metrics.write_text(CHARM_METRICS)
+        metrics_exporter.MetricsHandler.collector = metrics_exporter.Collector(
+            self._serve(WorkloadHandler), str(self.charm_metrics)
+        )
+        url = self._serve(metrics_exporter.MetricsHandler)
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+            self.assertEqual(response.headers["Content-Type"], metrics_exporter.CONTENT_TYPE)
+        self.assertIn("open_apiary_workers 2\n", body)
+        self.assertIn("open_apiary_charm_reloads_total 3\n", body)
+        self.assertIn("open_apiary_up 1\n", body)
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url.replace("/metrics", "/"))
+        self.assertEqual(e.exception.code, 404)
+
+    def test_workload_down(self):
+        """the workload is reported down when the wrapper is not serving"""
+        collector = metrics_exporter.Collector(
+            "http://localhost:1/metrics", str(self.charm_metrics), timeout=0.5
+        )
+        body = collector.collect()
+        self.assertIn("open_apiary_up 0\n", body)
+        self.assertNotIn("open_apiary_workers", body)
@@ -0,0 +1,163 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import MagicMock
+
+from migration import Column, MigrationError, MySQLDatabase, SQLiteDatabase, migrate, verify
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.source = SQLiteDatabase.open(os.path.join(self.tmpdir, "db.sql"))
+        self.addCleanup(self.source.close)
+        # Declared as by the application's ORM
+        self.source.execute(
+            "CREATE TABLE apiary (id varchar PRIMARY KEY, name varchar NOT NULL, "
+            "created datetime NOT NULL DEFAULT (datetime('now')))"
+        )
+        self.source.execute(
+            "CREATE TABLE hive (id integer PRIMARY KEY AUTOINCREMENT, "
+            "apiary varchar REFERENCES apiary (id) ON DELETE CASCADE, "
+            "weight real DEFAULT 0, photo blob)"
+        )
+        self.source.execute("CREATE INDEX IDX_hive_apiary ON hive (apiary)")
+        for index in range(10):
+            self.source.insert("apiary", ["id", "name"], [("a{}".format(index), "Apiary")])
+        self.source.insert(
+            "hive",
+            ["id", "apiary", "weight", "photo"],
+            [(index, "a1", index / 2.0, b"\x00\x01") for index in range(1, 26)],
+        )
+        self.source.commit()
+        # A second SQLite database stands in for MySQL
+        self.target = SQLiteDatabase.open(os.path.join(self.tmpdir, "target.sql"))
+        self.addCleanup(self.target.close)
+
+    def test_migrate(self):
+        """every row is copied in chunks and verified"""
+        reports = []
+        copied, _ = migrate(
+            self.source,
+            self.target,
+            chunk_size=4,
+            batch_size=3,
+            progress=lambda *args: reports.append(args[:3]),
+        )
+        self.assertEqual(copied, 35)
+        self.assertEqual(verify(self.source, self.target), [])
+        self.assertEqual(reports[0], ("apiary", 4, 10))
+        self.assertEqual(reports[-1], ("hive", 25, 25))
+        self.assertEqual(
+            self.target.execute("SELECT * FROM hive WHERE id = 3").fetchone(),
+            (3, "a1", 1.5, b"\x00\x01"),
+        )
+
+    def test_migrate_resumes(self):
+        """an interrupted migration carries on without duplicating rows"""
+
+        def interrupt(table, done, total, rate):
+            if table == "hive" and done >= 10:
+                raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            migrate(self.source, self.target, chunk_size=5, progress=interrupt)
+        self.assertEqual(self.target.count("hive"), 10)
+        self.assertEqual(verify(self.source, self.target), [("hive", 25, 10)])
+
+        copied, _ = migrate(self.source, self.target, chunk_size=5)
+        self.assertEqual(copied, 15)
+        self.assertEqual(verify(self.source, self.target), [])
+
+        # Rows inserted since are picked up by another run
+        self.source.insert("hive", ["id", "apiary"], [(26, "a2")])
+        self.source.commit()
+        copied, _ = migrate(self.source, self.target)
+        self.assertEqual(copied, 1)
+        self.assertEqual(verify(self.source, self.target), [])
+
+    def test_mysql_column_types(self):
+        """SQLite column types are mapped to MySQL types"""
+        mysql = MySQLDatabase(None)
+        self.assertEqual(
+            [
+                mysql.column_type(column)
+                for column in self.source.columns("apiary") + self.source.columns("hive")
+            ],
+            [
+                "VARCHAR(255)",
+                "VARCHAR(255)",
+                "DATETIME",
+                "BIGINT",
+                "VARCHAR(255)",
+                "DOUBLE",
+                "LONGBLOB",
+            ],
+        )
+        self.assertEqual(mysql.column_type(Column("notes", "text", 0)), "LONGTEXT")
+
+    def test_mysql_schema(self):
+        """tables are created in MySQL with their keys, constraints and indexes"""
+        mysql = MySQLDatabase(MagicMock())
+        for table in ("apiary", "hive"):
+            mysql.create_table(
+                table,
+                self.source.columns(table),
+                self.source.indexes(table),
+                self.source.foreign_keys(table),
+            )
+        mysql.create_table(
+            "note",
+            [Column("text", "text", 0, default="'none'")],
+            [self.source.indexes("hive")[0]._replace(name="IDX_note", columns=["text"])],
+        )
+        statements = [
+            c.args[0] for c in mysql.connection.cursor.return_value.execute.call_args_list
+        ]
+        self.assertEqual(
+            statements,
+            [
+                "CREATE TABLE `apiary` (`id` VARCHAR(255) NOT NULL, "
+                "`name` VARCHAR(255) NOT NULL, "
+                "`created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "PRIMARY KEY (`id`))",
+                "CREATE TABLE `hive` (`id` BIGINT NOT NULL AUTO_INCREMENT, "
+                "`apiary` VARCHAR(255), `weight` DOUBLE DEFAULT 0, `photo` LONGBLOB, "
+                "PRIMARY KEY (`id`), FOREIGN KEY (`apiary`) REFERENCES `apiary` (`id`) "
+                "ON UPDATE NO ACTION ON DELETE CASCADE)",
+                "CREATE INDEX `IDX_hive_apiary` ON `hive` (`apiary`)",
+                "CREATE TABLE `note` (`text` LONGTEXT DEFAULT ('none'))",
+                "CREATE INDEX `IDX_note` ON `note` (`text`(255))",
+            ],
+        )
+
+    def test_schema_copied(self):
+        """indexes, foreign keys and defaults are created in the target"""
+        migrate(self.source, self.target)
+        self.assertEqual(self.target.indexes("hive"), self.source.indexes("hive"))
+        self.assertEqual(self.target.foreign_keys("hive"), self.source.foreign_keys("hive"))
+        self.assertEqual(self.target.columns("apiary"), self.source.columns("apiary"))
+        # The integer primary key keeps being assigned on insert
+        self.target.execute("INSERT INTO hive (apiary) VALUES ('a1')")
+        self.assertEqual(self.target.execute("SELECT MAX(id) FROM hive").fetchone(), (26,))
+
+    def test_has_rows(self):
+        """databases holding only empty tables have no rows to migrate"""
+        self.assertTrue(self.source.has_rows())
+        self.assertFalse(self.target.has_rows())
+        self.target.create_table("hive", self.source.columns("hive"))
+        self.assertFalse(self.target.has_rows())
+
+    def test_existing_table_refused(self):
+        """tables holding rows the migration did not copy are not reused"""
+        self.target.execute("CREATE TABLE hive (id integer PRIMARY KEY)")
+        self.target.insert("hive", ["id"], [(1,)])
+        self.target.commit()
+        with self.assertRaises(MigrationError):
+            migrate(self.source, self.target)
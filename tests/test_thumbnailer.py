@@ -0,0 +1,143 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import http.server
+import importlib.util
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+SOURCE = pathlib.Path(__file__).parent.parent / "src" / "workload" / "thumbnailer.py"
+spec = importlib.util.spec_from_file_location("thumbnailer", SOURCE)
+thumbnailer = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(thumbnailer)
+
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+
+class CopyingCache(thumbnailer.ThumbnailCache):
+    """Thumbnail cache copying uploads rather than resizing them"""
+
+    def render(self, source, target):
+        shutil.copyfile(source, target)
+
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.uploads = pathlib.Path(tmpdir.name)
+        self.cache = CopyingCache(
+            self.uploads, self.uploads / ".thumbnails", size=64, quota=250
+        )
+
+    def _upload(self, name: str, size: int = 100, mtime: float = None) -> pathlib.Path:
+        path = self.uploads / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_scan_generates_new_uploads(self):
+        """thumbnails are generated for photos uploaded since the last scan"""
+        self._upload("hive-1.jpg")
+        self._upload("inspections/hive-2.png")
+        self._upload("notes.txt")
+        self.assertEqual(self.cache.scan(), 2)
+        self.assertTrue((self.uploads / ".thumbnails" / "inspections" / "hive-2.png").exists())
+        self.assertFalse((self.uploads / ".thumbnails" / "notes.txt").exists())
+
+        # Evicted thumbnails are only regenerated on request
+        (self.uploads / ".thumbnails" / "hive-1.jpg").unlink()
+        self._upload("hive-3.jpg", mtime=time.time() + 10)
+        self.assertEqual(self.cache.scan(), 1)
+        self.assertFalse((self.uploads / ".thumbnails" / "hive-1.jpg").exists())
+
+    def test_generate_refreshes_stale(self):
+        """replaced uploads get a new thumbnail"""
+        upload = self._upload("hive.jpg", size=10, mtime=1000)
+        thumbnail = self.cache.generate("hive.jpg")
+        self.assertEqual(thumbnail.read_bytes(), b"x" * 10)
+        upload.write_bytes(b"y" * 10)
+        self.assertEqual(self.cache.generate("hive.jpg").read_bytes(), b"y" * 10)
+
+    def test_generate_refuses_other_paths(self):
+        """only photos within the uploads are thumbnailed"""
+        for name in ("../secret.jpg", "notes.txt"):
+            with self.assertRaises(KeyError):
+                self.cache.generate(name)
+
+    def test_generate_fetches_missing_uploads(self):
+        """photos uploaded to another unit are fetched before thumbnailing"""
+        fetched = []
+
+        def fetch(name):
+            fetched.append(name)
+            self._upload(name, size=10)
+
+        self.cache.fetch = fetch
+        self.assertEqual(self.cache.generate("inspections/hive.jpg").read_bytes(), b"x" * 10)
+        self.cache.generate("inspections/hive.jpg")
+        self.assertEqual(fetched, ["inspections/hive.jpg"])
+
+    def test_evict_least_recently_used(self):
+        """the least recently served thumbnails are evicted over quota"""
+        for index, name in enumerate(("a.jpg", "b.jpg", "c.jpg")):
+            self._upload(name)
+            thumbnail = self.cache.generate(name)
+            os.utime(thumbnail, (1000 + index, 1000))
+        # a.jpg was served most recently
+        os.utime(self.uploads / ".thumbnails" / "a.jpg", (2000, 1000))
+        self.assertEqual(self.cache.evict(), 1)
+        remaining = sorted(p.name for p in (self.uploads / ".thumbnails").iterdir())
+        self.assertEqual(remaining, ["a.jpg", "c.jpg"])
+
+    @unittest.skipUnless(PIL, "Pillow not installed")
+    def test_render(self):
+        """photos are resized within the thumbnail size"""
+        from PIL import Image
+
+        Image.new("RGB", (640, 480)).save(self.uploads / "hive.jpg")
+        cache = thumbnailer.ThumbnailCache(
+            self.uploads, self.uploads / ".thumbnails", size=64, quota=1024
+        )
+        with Image.open(cache.generate("hive.jpg")) as image:
+            self.assertEqual(image.size, (64, 48))
+            self.assertEqual(image.format, "JPEG")
+
+    def test_handler(self):
+        """thumbnails are served with cache headers and generated on demand"""
+        self._upload("hive.jpg")
+        thumbnailer.ThumbnailHandler.cache = self.cache
+        server = http.server.HTTPServer(("localhost", 0), thumbnailer.ThumbnailHandler)
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://localhost:{}".format(server.server_port)
+
+        with urllib.request.urlopen(url + "/thumbnails/hive.jpg") as response:
+            self.assertEqual(response.read(), b"x" * 100)
+            self.assertEqual(response.headers["Content-Type"], "image/jpeg")
+            self.assertEqual(response.headers["Cache-Control"], "public, max-age=2592000")
+        # Access time is updated for eviction
+        thumbnail = self.uploads / ".thumbnails" / "hive.jpg"
+        os.utime(thumbnail, (1000, thumbnail.stat().st_mtime))
+        request = urllib.request.Request(url + "/thumbnails/hive.jpg", method="HEAD")
+        with urllib.request.urlopen(request) as response:
+            self.assertEqual(response.read(), b"")
+            self.assertEqual(response.headers["Content-Length"], "100")
+        self.assertGreater(thumbnail.stat().st_atime, 1000)
+        for path in ("/thumbnails/missing.jpg", "/thumbnails/../hive.jpg", "/hive.jpg"):
+            with self.assertRaises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(url + path)
+            self.assertEqual(e.exception.code, 404)
@@ -0,0 +1,162 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import http.server
+import importlib.util
+import os
+import pathlib
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from s3 import S3Client
+from tests import s3_stand_in
+
+SOURCE = pathlib.Path(__file__).parent.parent / "src" / "workload" / "uploads.py"
+spec = importlib.util.spec_from_file_location("uploads", SOURCE)
+uploads = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(uploads)
+
+
+class TestUploadCache(unittest.TestCase):
+    def setUp(self):
+        self.server = s3_stand_in.start(bucket="uploads")
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.caches = [self._cache() for _ in range(2)]
+
+    def _cache(self, quota: int = 250) -> "uploads.UploadCache":
+        """Uploads cache of a unit sharing the bucket"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        client = S3Client(self.server.endpoint, "uploads", "access", "secret")
+        return uploads.UploadCache(tmpdir.name, client, "open-apiary", quota)
+
+    def _upload(self, cache, name: str, size: int = 100, atime: float = None) -> pathlib.Path:
+        path = cache.uploads / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode().ljust(size, b"x"))
+        if atime is not None:
+            os.utime(path, ns=(int(atime * 1e9), path.stat().st_mtime_ns))
+        return path
+
+    def test_shared_between_units(self):
+        """uploads to one unit are fetched from the bucket by the others"""
+        first, second = self.caches
+        self._upload(first, "hive.jpg")
+        self._upload(first, "inspections/1.jpg")
+        self._upload(first, ".thumbnails/hive.jpg")
+        self.assertEqual(first.sync(), (2, 0))
+        self.assertEqual(
+            sorted(self.server.objects), ["open-apiary/hive.jpg", "open-apiary/inspections/1.jpg"]
+        )
+        # Unchanged uploads are not copied again
+        self.assertEqual(first.sync(), (0, 0))
+
+        path = second.fetch("inspections/1.jpg")
+        self.assertEqual(path.read_bytes(), (first.uploads / "inspections/1.jpg").read_bytes())
+        with self.assertRaises(KeyError):
+            second.fetch("missing.jpg")
+        with self.assertRaises(KeyError):
+            second.fetch("../hive.jpg")
+        # Fetched uploads are not copied back
+        self.assertEqual(second.sync(), (0, 0))
+
+    def test_removed_uploads(self):
+        """uploads removed by the application are removed from the bucket"""
+        cache = self.caches[0]
+        self._upload(cache, "hive.jpg").unlink()
+        self._upload(cache, "apiary.jpg")
+        cache.sync()
+        (cache.uploads / "apiary.jpg").unlink()
+        self.assertEqual(cache.sync(), (0, 1))
+        self.assertEqual(self.server.objects, {})
+
+    def test_changed_by_other_units(self):
+        """uploads removed or replaced in the bucket are dropped from the cache"""
+        first, second = self.caches
+        self._upload(first, "hive.jpg")
+        self._upload(first, "apiary.jpg")
+        self._upload(first, "notes.jpg")
+        first.sync()
+        for name in ("hive.jpg", "apiary.jpg", "notes.jpg"):
+            second.fetch(name)
+        self.assertEqual(second.refresh(), 0)
+
+        # Replaced and removed on the first unit
+        self._upload(first, "hive.jpg", size=120)
+        (first.uploads / "apiary.jpg").unlink()
+        self.assertEqual(first.sync(), (1, 1))
+        # Changed on the second unit before it saw the replacement
+        self._upload(second, "notes.jpg", size=80)
+        self._upload(first, "notes.jpg", size=90)
+        first.sync()
+        self.assertEqual(second.refresh(), 2)
+        self.assertEqual(sorted(os.listdir(second.uploads)), ["notes.jpg"])
+        self.assertIsNone(second.index["hive.jpg"])
+        self.assertNotIn("apiary.jpg", second.index)
+        self.assertEqual(second.fetch("hive.jpg").stat().st_size, 120)
+        self.assertEqual(second.refresh(), 0)
+        # The change on the second unit is copied to the bucket
+        self.assertEqual(second.sync(), (1, 0))
+        self.assertEqual(len(self.server.objects["open-apiary/notes.jpg"]), 80)
+
+    def test_index_without_etags(self):
+        """uploads indexed before ETags were recorded are not dropped"""
+        cache = self.caches[0]
+        self._upload(cache, "hive.jpg")
+        cache.sync()
+        cache.index["hive.jpg"] = cache.index["hive.jpg"][:2]
+        self.assertEqual(cache.refresh(), 0)
+        self.assertEqual(cache.index["hive.jpg"][2], cache.client.etags()["open-apiary/hive.jpg"])
+        self.assertTrue((cache.uploads / "hive.jpg").exists())
+
+    def test_evict_least_recently_used(self):
+        """only uploads already in the bucket are evicted, oldest first"""
+        cache = self.caches[0]
+        self._upload(cache, "old.jpg", atime=1000)
+        self._upload(cache, "recent.jpg", atime=3000)
+        cache.sync()
+        self._upload(cache, "new.jpg", atime=0)
+        self.assertEqual(cache.evict(), 1)
+        self.assertEqual(sorted(os.listdir(cache.uploads)), ["new.jpg", "recent.jpg"])
+        # Evicted uploads stay in the bucket and are fetched on demand
+        self.assertEqual(cache.sync(), (1, 0))
+        self.assertIn("open-apiary/old.jpg", self.server.objects)
+        self.assertTrue(cache.fetch("old.jpg").exists())
+
+    def test_index_saved(self):
+        """uploads already copied are remembered across restarts"""
+        cache = self.caches[0]
+        self._upload(cache, "hive.jpg")
+        cache.sync()
+        cache.save_index()
+        restarted = uploads.UploadCache(cache.uploads, cache.client, "open-apiary", 250)
+        self.assertEqual(restarted.sync(), (0, 0))
+
+    def test_handler(self):
+        """uploads are served from the bucket and syncs requested"""
+        first, second = self.caches
+        self._upload(first, "hive photo.jpg")
+        first.sync()
+        uploads.UploadsHandler.cache = second
+        handler = http.server.ThreadingHTTPServer(("localhost", 0), uploads.UploadsHandler)
+        threading.Thread(target=handler.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(handler.server_close)
+        self.addCleanup(handler.shutdown)
+        url = "http://localhost:{}".format(handler.server_port)
+
+        with urllib.request.urlopen(url + "/uploads/hive%20photo.jpg") as response:
+            self.assertEqual(response.read(), b"hive photo.jpg".ljust(100, b"x"))
+            self.assertEqual(response.headers["Content-Type"], "image/jpeg")
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + "/uploads/missing.jpg")
+        self.assertEqual(e.exception.code, 404)
+        e.exception.close()
+
+        request = urllib.request.Request(url + "/sync", method="POST")
+        with urllib.request.urlopen(request) as response:
+            self.assertEqual(response.status, 202)
+        self.assertTrue(second.wake.is_set())
@@ -0,0 +1,133 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import http.server
+import importlib.util
+import pathlib
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+SOURCE = pathlib.Path(__file__).parent.parent / "src" / "workload" / "weather_proxy.py"
+spec = importlib.util.spec_from_file_location("weather_proxy", SOURCE)
+weather_proxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(weather_proxy)
+
+
+class StubWeatherHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the upstream weather API"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        time.sleep(server.delay)
+        self.send_response(server.status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write('{{"path": "{}"}}'.format(self.path).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWeatherCache(unittest.TestCase):
+    def _serve(self, handler) -> http.server.HTTPServer:
+        server = http.server.ThreadingHTTPServer(("localhost", 0), handler)
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def setUp(self):
+        self.upstream = self._serve(StubWeatherHandler)
+        self.upstream.lock = threading.Lock()
+        self.upstream.requests = []
+        self.upstream.status = 200
+        self.upstream.delay = 0
+        self.cache = weather_proxy.WeatherCache(
+            "http://localhost:{}".format(self.upstream.server_port),
+            ttl=60,
+            grid=0.1,
+            size=2,
+            stale_ttl=3600,
+        )
+
+    def test_cached_by_grid(self):
+        """nearby locations share a cached response until it expires"""
+        response, stale = self.cache.get("/weather?lat=51.501&lon=-0.121&appid=x")
+        self.assertEqual(response.status, 200)
+        self.assertFalse(stale)
+        self.cache.get("/weather?appid=x&lat=51.52&lon=-0.08")
+        self.assertEqual(self.upstream.requests, ["/weather?appid=x&lat=51.5000&lon=-0.1000"])
+
+        self.cache.get("/weather?lat=52.0&lon=-0.1&appid=x")
+        self.assertEqual(len(self.upstream.requests), 2)
+        self.cache.ttl = 0
+        self.cache.get("/weather?lat=51.5&lon=-0.1&appid=x")
+        self.assertEqual(len(self.upstream.requests), 3)
+
+    def test_concurrent_requests_collapsed(self):
+        """concurrent requests for the same key make one upstream request"""
+        self.upstream.delay = 0.2
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache.get("/weather?lat=1")))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.upstream.requests), 1)
+        self.assertEqual(len({response.body for response, _ in results}), 1)
+
+    def test_stale_on_error(self):
+        """expired responses are served while the upstream is failing"""
+        fresh, _ = self.cache.get("/weather?lat=1")
+        self.cache.ttl = 0
+        self.upstream.status = 503
+        response, stale = self.cache.get("/weather?lat=1")
+        self.assertTrue(stale)
+        self.assertEqual(response.body, fresh.body)
+
+        self.cache.stale_ttl = 0
+        with self.assertRaises(weather_proxy.UpstreamError):
+            self.cache.get("/weather?lat=1")
+
+    def test_client_errors_not_cached(self):
+        """client errors are passed back without being cached"""
+        self.upstream.status = 401
+        response, _ = self.cache.get("/weather?lat=1")
+        self.assertEqual(response.status, 401)
+        self.cache.get("/weather?lat=1")
+        self.assertEqual(len(self.upstream.requests), 2)
+
+    def test_size_bounded(self):
+        """the least recently used responses are evicted"""
+        for lat in (1, 2, 1, 3):
+            self.cache.get("/weather?lat={}".format(lat))
+        self.assertEqual(
+            list(self.cache.entries), ["/weather?lat=1.0000", "/weather?lat=3.0000"]
+        )
+
+    def test_handler(self):
+        """the proxy serves cached responses, marking stale ones"""
+        weather_proxy.WeatherHandler.cache = self.cache
+        proxy = self._serve(weather_proxy.WeatherHandler)
+        url = "http://localhost:{}/weather?lat=1".format(proxy.server_port)
+        with urllib.request.urlopen(url) as response:
+            body = response.read()
+            self.assertEqual(response.headers["Content-Type"], "application/json")
+            self.assertIsNone(response.headers["Warning"])
+        self.cache.ttl = 0
+        self.upstream.status = 500
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(response.read(), body)
+            self.assertEqual(response.headers["Warning"], '110 - "Response is Stale"')
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url.replace("lat=1", "lat=2"))
+        self.assertEqual(e.exception.code, 502)
+        e.exception.close()
@@ -0,0 +1,513 @@
+# Copyright 2021 James Page
+# See LICENSE file for licensing details.
+
+import gzip
+import http.server
+import json
+import os
+import pathlib
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+WORKLOAD = pathlib.Path(__file__).parent.parent / "src" / "workload"
+
+# Minimal stand-in for the Open Apiary application entrypoint
+STAND_IN_APP = """
+const http = require("http");
+http
+  .createServer((req, res) => {
+    console.log(`${process.pid} GET ${req.url}`);
+    res.end(String(process.pid));
+  })
+  .listen(process.env.PORT);
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+@unittest.skipUnless(shutil.which("node"), "node not installed")
+class TestClusterWrapper(unittest.TestCase):
+    def setUp(self):
+        self.app_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_root)
+        with open(os.path.join(self.app_root, "package.json"), "w") as f:
+            json.dump({"name": "open-apiary", "main": "./server.js"}, f)
+        with open(os.path.join(self.app_root, "server.js"), "w") as f:
+            f.write(STAND_IN_APP)
+        self.port = free_port()
+
+    def _start(self, workers: int, **extra) -> subprocess.Popen:
+        env = dict(
+            os.environ,
+            APP_ROOT=self.app_root,
+            APP_WORKERS=str(workers),
+            PORT=str(self.port),
+            **extra
+        )
+        proc = subprocess.Popen(
+            ["node", str(WORKLOAD / "cluster.js")],
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        return proc
+
+    def _pids(self, requests: int) -> set:
+        url = "http://localhost:{}/".format(self.port)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                urllib.request.urlopen(url, timeout=1).read()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        # Allow all workers to start listening
+        time.sleep(0.5)
+        return {
+            urllib.request.urlopen(url, timeout=1).read() for _ in range(requests)
+        }
+
+    def test_workers_share_port(self):
+        """requests are spread across the configured number of workers"""
+        proc = self._start(workers=2)
+        self.assertEqual(len(self._pids(10)), 2)
+        proc.terminate()
+        self.assertEqual(proc.wait(timeout=10), 0)
+
+    def test_single_worker(self):
+        """a single worker runs the application under the wrapper"""
+        proc = self._start(workers=1)
+        pids = self._pids(5)
+        self.assertEqual(len(pids), 1)
+        self.assertNotIn(str(proc.pid).encode(), pids)
+
+    def test_reload(self):
+        """workers are replaced on SIGHUP while requests keep being served"""
+        proc = self._start(workers=2)
+        before = self._pids(10)
+        proc.send_signal(signal.SIGHUP)
+        url = "http://localhost:{}/".format(self.port)
+        deadline = time.monotonic() + 10
+        seen = set()
+        while time.monotonic() < deadline:
+            # Every request succeeds throughout the reload
+            seen.add(urllib.request.urlopen(url, timeout=1).read())
+            if len(seen - before) == 2 and not (self._pids(10) & before):
+                break
+        self.assertFalse(self._pids(10) & before)
+
+    def test_sqlite_pragmas(self):
+        """SQLite pragmas are run on each connection the application opens"""
+        sqlite3 = os.path.join(self.app_root, "node_modules", "sqlite3")
+        os.makedirs(sqlite3)
+        with open(os.path.join(sqlite3, "index.js"), "w") as f:
+            f.write(
+                """
+class Database {
+  constructor(file) {
+    this.statements = [];
+  }
+  exec(sql, callback) {
+    this.statements.push(sql);
+    callback(null);
+  }
+}
+module.exports = { Database };
+"""
+            )
+        with open(os.path.join(self.app_root, "server.js"), "w") as f:
+            f.write(
+                """
+const http = require("http");
+const sqlite3 = require("sqlite3");
+http
+  .createServer((req, res) => res.end(new sqlite3.Database("db.sql").statements.join("")))
+  .listen(process.env.PORT);
+"""
+            )
+        with open(os.path.join(self.app_root, "config.json"), "w") as f:
+            json.dump(
+                {
+                    "db": {
+                        "type": "sqlite",
+                        "pragmas": {"journal_mode": "WAL", "cache_size": -2048},
+                    }
+                },
+                f,
+            )
+        self._start(workers=1)
+        (statements,) = self._pids(1)
+        self.assertEqual(statements, b"PRAGMA journal_mode = WAL; PRAGMA cache_size = -2048;")
+
+    def test_previous_jwt_secret(self):
+        """tokens signed with a previous secret are accepted by the application"""
+        # Stand-in for jsonwebtoken, as the application verifies its tokens
+        module = os.path.join(self.app_root, "node_modules", "jsonwebtoken")
+        os.makedirs(module)
+        with open(os.path.join(module, "index.js"), "w") as f:
+            f.write(
+                """
+class JsonWebTokenError extends Error {
+  constructor(message) {
+    super(message);
+    this.name = "JsonWebTokenError";
+  }
+}
+exports.verify = (token, key, options, callback) => {
+  const [, payload, signature] = token.split(".");
+  const error = signature === key ? null : new JsonWebTokenError("invalid signature");
+  const decoded = error ? undefined : JSON.parse(payload);
+  if (callback) {
+    return callback(error, decoded);
+  }
+  if (error) {
+    throw error;
+  }
+  return decoded;
+};
+"""
+            )
+        with open(os.path.join(self.app_root, "server.js"), "w") as f:
+            f.write(
+                """
+const http = require("http");
+const { verify } = require("jsonwebtoken");
+http
+  .createServer((req, res) => {
+    const token = (req.headers.cookie || "").replace("token=", "");
+    let result;
+    try {
+      result = JSON.stringify(verify(token, "current"));
+    } catch (e) {
+      result = e.message;
+    }
+    verify(token, "current", {}, (err, decoded) => {
+      res.end(`${result} ${err ? err.message : JSON.stringify(decoded)}`);
+    });
+  })
+  .listen(process.env.PORT);
+"""
+            )
+        with open(os.path.join(self.app_root, "config.json"), "w") as f:
+            json.dump({"jwt": {"secret": "current", "previousSecrets": ["previous"]}}, f)
+        self._start(workers=1)
+
+        def verified(signature):
+            request = urllib.request.Request(
+                "http://localhost:{}/".format(self.port),
+                headers={"Cookie": "token=header.{}.{}".format('{"id":1}', signature)},
+            )
+            return urllib.request.urlopen(request, timeout=1).read()
+
+        self._pids(1)
+        self.assertEqual(verified("previous"), b'{"id":1} {"id":1}')
+        self.assertEqual(verified("current"), b'{"id":1} {"id":1}')
+        self.assertEqual(verified("forged"), b"invalid signature invalid signature")
+
+    def test_thumbnails(self):
+        """thumbnails are passed to the thumbnail service and embedded photos redirected"""
+
+        class Upstream(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Cache-Control", "public, max-age=2592000")
+                self.end_headers()
+                self.wfile.write(self.path.encode())
+
+            def log_message(self, *args):
+                pass
+
+        upstream = http.server.HTTPServer(("localhost", 0), Upstream)
+        threading.Thread(target=upstream.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(upstream.server_close)
+        self.addCleanup(upstream.shutdown)
+
+        self._start(
+            workers=1,
+            THUMBNAIL_URL="http://localhost:{}".format(upstream.server_port),
+            THUMBNAIL_REDIRECT="1",
+        )
+        self._pids(1)
+        url = "http://localhost:{}".format(self.port)
+        with urllib.request.urlopen(url + "/thumbnails/hive.jpg") as response:
+            self.assertEqual(response.read(), b"/thumbnails/hive.jpg")
+            self.assertEqual(response.headers["Cache-Control"], "public, max-age=2592000")
+
+        # Photos embedded in a page are redirected to their thumbnails
+        opener = urllib.request.build_opener(NoRedirect)
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            opener.open(
+                urllib.request.Request(
+                    url + "/uploads/hives/hive.JPG?v=2", headers={"Sec-Fetch-Dest": "image"}
+                )
+            )
+        self.assertEqual(e.exception.code, 302)
+        self.assertEqual(e.exception.headers["Location"], "/thumbnails/hives/hive.JPG?v=2")
+        self.assertEqual(e.exception.headers["Vary"], "Sec-Fetch-Dest")
+        e.exception.close()
+        # Photos opened directly, and other uploads, are served by the application
+        for path, dest in (("/uploads/hive.jpg", "document"), ("/uploads/notes.pdf", "image")):
+            request = urllib.request.Request(url + path, headers={"Sec-Fetch-Dest": dest})
+            with opener.open(request) as response:
+                self.assertTrue(response.read().isdigit())
+        with urllib.request.urlopen(url + "/thumbnails.html") as response:
+            self.assertTrue(response.read().isdigit())
+
+    def test_shared_uploads(self):
+        """missing uploads are fetched by the uploads service, which syncs on writes"""
+        uploads = os.path.join(self.app_root, "uploads")
+        os.mkdir(uploads)
+        with open(os.path.join(uploads, "hive.jpg"), "wb") as f:
+            f.write(b"photo")
+        requests = []
+
+        class Upstream(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(("GET", self.path))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(self.path.encode())
+
+            def do_POST(self):
+                requests.append(("POST", self.path))
+                self.send_response(202)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        upstream = http.server.HTTPServer(("localhost", 0), Upstream)
+        threading.Thread(target=upstream.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(upstream.server_close)
+        self.addCleanup(upstream.shutdown)
+
+        self._start(
+            workers=1,
+            UPLOAD_PATH=uploads,
+            UPLOADS_URL="http://localhost:{}".format(upstream.server_port),
+        )
+        self._pids(1)
+        url = "http://localhost:{}".format(self.port)
+        # Uploads in the local cache are served by the application
+        with urllib.request.urlopen(url + "/uploads/hive.jpg") as response:
+            self.assertTrue(response.read().isdigit())
+        with urllib.request.urlopen(url + "/uploads/inspections/1.jpg") as response:
+            self.assertEqual(response.read(), b"/uploads/inspections/1.jpg")
+
+        # Writes are followed by a single request to sync
+        for _ in range(3):
+            urllib.request.urlopen(urllib.request.Request(url + "/hives", data=b"{}")).read()
+        deadline = time.monotonic() + 5
+        while ("POST", "/sync") not in requests and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(0.2)
+        self.assertEqual(
+            requests, [("GET", "/uploads/inspections/1.jpg"), ("POST", "/sync")]
+        )
+
+    def test_warmup(self):
+        """workers only share the port once the warm-up routes have been requested"""
+        with open(os.path.join(self.app_root, "package.json"), "w") as f:
+            json.dump({"name": "open-apiary", "version": "1.1.1", "main": "./server.js"}, f)
+        with open(os.path.join(self.app_root, "server.js"), "w") as f:
+            f.write(
+                """
+const http = require("http");
+let warmed = 0;
+http
+  .createServer((req, res) => {
+    if (req.url === "/slow") {
+      warmed++;
+      setTimeout(() => res.end(), 1000);
+    } else {
+      res.end(`${process.pid} ${warmed}`);
+    }
+  })
+  .listen(process.env.PORT);
+"""
+            )
+        metrics_port = free_port()
+        started = time.monotonic()
+        proc = self._start(
+            workers=2,
+            WARMUP_ROUTES="/slow,/",
+            WARMUP_FILES=os.path.join(self.app_root, "server.js"),
+            WARMUP_CONCURRENCY="2",
+            METRICS_PORT=str(metrics_port),
+        )
+        responses = self._pids(10)
+        self.assertGreaterEqual(time.monotonic() - started, 1.0)
+        self.assertEqual(len(responses), 2)
+        # Every worker served its warm-up requests before any other
+        self.assertEqual({r.split()[1] for r in responses}, {b"2"})
+        body = urllib.request.urlopen(
+            "http://localhost:{}/metrics".format(metrics_port), timeout=1
+        ).read().decode()
+        (line,) = [line for line in body.splitlines() if line.startswith("open_apiary_warmup")]
+        name, value = line.rsplit(" ", 1)
+        self.assertEqual(name, 'open_apiary_warmup_seconds{version="1.1.1"}')
+        self.assertGreaterEqual(float(value), 1.0)
+
+        # Workers replacing others on reload are warmed up before serving
+        proc.send_signal(signal.SIGHUP)
+        url = "http://localhost:{}/".format(self.port)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            response = urllib.request.urlopen(url, timeout=1).read()
+            self.assertEqual(response.split()[1], b"2")
+            if not self._pids(10) & responses:
+                break
+        self.assertFalse(self._pids(10) & responses)
+
+    def test_warmup_old_node(self):
+        """workers warm up on Node releases without closeAllConnections"""
+        preload = os.path.join(self.app_root, "old-node.js")
+        with open(preload, "w") as f:
+            f.write('delete require("http").Server.prototype.closeAllConnections;\n')
+        self._start(workers=2, WARMUP_ROUTES="/", NODE_OPTIONS="--require " + preload)
+        self.assertEqual(len(self._pids(10)), 2)
+
+    def test_log_rotation(self):
+        """worker output is written to a rotated and compressed log file"""
+        log_file = os.path.join(self.app_root, "open-apiary.log")
+        proc = self._start(
+            workers=2,
+            LOG_TARGET="file",
+            LOG_FILE=log_file,
+            LOG_MAX_SIZE="300",
+            LOG_BACKUPS="2",
+        )
+        self._pids(100)
+        proc.terminate()
+        self.assertEqual(proc.wait(timeout=10), 0)
+        self.assertTrue(os.path.exists(log_file + ".1.gz"))
+        self.assertTrue(os.path.exists(log_file + ".2.gz"))
+        self.assertFalse(os.path.exists(log_file + ".3.gz"))
+        with gzip.open(log_file + ".1.gz", "rt") as f:
+            self.assertIn("GET /", f.read())
+        self.assertLessEqual(os.path.getsize(log_file), 300 + 200)
+
+    def test_log_buffer_bounded(self):
+        """output is dropped rather than queued without limit"""
+        script = """
+const { Writable } = require("stream");
+const { LogShipper } = require("%s");
+let written = "";
+const output = new Writable({
+  write(chunk, encoding, done) {
+    written += chunk;
+    setTimeout(done, 50);
+  },
+});
+const shipper = new LogShipper({ bufferSize: 500, output });
+for (let i = 0; i < 100; i++) {
+  shipper.write(Buffer.from(`line ${i}`.padEnd(99) + "\\n"));
+}
+shipper.close(() => process.stdout.write(written));
+""" % (WORKLOAD / "logship.js")
+        output = subprocess.check_output(["node", "-e", script], timeout=10).decode()
+        lines = output.splitlines()
+        self.assertEqual(lines[0].strip(), "line 0")
+        # Only the most recent output fits in the buffer
+        self.assertEqual(lines[1], "[log buffer full, dropped 9400 bytes]")
+        self.assertEqual(
+            [line.strip() for line in lines[2:]],
+            ["line {}".format(i) for i in range(95, 100)],
+        )
+
+    def test_weather_routing(self):
+        """https requests for the weather API are sent to the caching proxy"""
+        paths = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                paths.append((self.path, self.headers["Host"]))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"cached")
+
+            def log_message(self, *args):
+                pass
+
+        proxy = http.server.HTTPServer(("localhost", 0), Handler)
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+        self.addCleanup(proxy.server_close)
+        self.addCleanup(proxy.shutdown)
+        script = """
+const https = require("https");
+const { routeWeather } = require("%s");
+routeWeather("weather.example", "http://localhost:%d");
+https.get("https://weather.example/data/2.5/weather?lat=1&lon=2", (res) => {
+  res.on("data", (chunk) => process.stdout.write(chunk));
+});
+""" % (WORKLOAD / "weather.js", proxy.server_port)
+        output = subprocess.check_output(["node", "-e", script], timeout=10).decode()
+        self.assertEqual(output, "cached")
+        self.assertEqual(paths, [("/data/2.5/weather?lat=1&lon=2", "weather.example")])
+
+    def test_metrics(self):
+        """request, process and database pool metrics are served on localhost"""
+        database = socket.socket()
+        database.bind(("localhost", 0))
+        database.listen()
+        self.addCleanup(database.close)
+        with open(os.path.join(self.app_root, "config.json"), "w") as f:
+            json.dump(
+                {
+                    "db": {
+                        "type": "mysql",
+                        "port": database.getsockname()[1],
+                        "extra": {"connectionLimit": 4},
+                    }
+                },
+                f,
+            )
+        # Stands in for a pooled connection to the database
+        connection = socket.create_connection(database.getsockname())
+        self.addCleanup(connection.close)
+
+        metrics_port = free_port()
+        self._start(workers=2, METRICS_PORT=str(metrics_port), METRICS_INTERVAL="100")
+        self._pids(20)
+        url = "http://localhost:{}/metrics".format(metrics_port)
+        deadline = time.monotonic() + 10
+        while True:
+            metrics = {}
+            body = urllib.request.urlopen(url, timeout=1).read().decode()
+            for line in body.splitlines():
+                if not line.startswith("#"):
+                    name, value = line.rsplit(" ", 1)
+                    metrics[name] = float(value)
+            requests = metrics.get('open_apiary_http_requests_total{code="2xx"}', 0)
+            if requests >= 21 or time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+        self.assertGreaterEqual(requests, 21)
+        self.assertEqual(metrics["open_apiary_workers"], 2)
+        self.assertEqual(
+            metrics['open_apiary_http_request_duration_seconds_bucket{le="+Inf"}'], requests
+        )
+        self.assertGreater(metrics["open_apiary_heap_used_bytes"], 0)
+        self.assertGreater(metrics["open_apiary_cpu_seconds_total"], 0)
+        self.assertEqual(metrics["open_apiary_db_pool_size"], 8)
+        self.assertGreaterEqual(metrics["open_apiary_db_connections"], 1)